@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""Time and memory-profile the pipeline scripts on synthetic GTDB-scale inputs.
+
+Each (benchmark, scale) pair runs in a fresh process. Wall time is the best of
+--repeat untraced runs; peak memory is measured in one more run with
+tracemalloc (allocations made during the run, including NumPy/pandas buffers),
+alongside the process's peak RSS. Results are written as JSON and can be
+compared with a previous run:
+
+    python benchmarks/run_benchmarks.py --scales 10000 100000 --out bench.json
+    python benchmarks/run_benchmarks.py --scales 10000 100000 --compare bench.json
+
+At a scale of N genomes the inputs are:
+- GTDB metadata with N genomes
+- N / 50 hits per query for --queries queries
+- --expressions nested expressions over those queries
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from os import path
+from queue import Empty
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+SCRIPTS_DIR = path.join(path.dirname(BENCH_DIR), 'scripts')
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, SCRIPTS_DIR)
+
+DEFAULT_SCALES = [10_000, 100_000]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+@contextlib.contextmanager
+def working_directory(dirname):
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+@contextlib.contextmanager
+def script_argv(*argv):
+    """Run a script's main() with the given command line, discarding its output."""
+    old_argv = sys.argv
+    sys.argv = ['benchmark'] + [str(a) for a in argv]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        sys.argv = old_argv
+
+
+def prepare_inputs(workdir, scale, n_queries, n_expressions, seed):
+    """Generate (once) the synthetic inputs for one scale and return their paths."""
+    import synthetic
+
+    scale_dir = path.join(workdir, f'scale_{scale}_q{n_queries}_e{n_expressions}_s{seed}')
+    annotree_dir = path.join(scale_dir, 'data', 'annotree')
+    inputs = dict(
+        dir=scale_dir,
+        metadata=path.join(scale_dir, 'bac120_metadata_r0.tsv.gz'),
+        manifest=path.join(annotree_dir, 'annotree_manifest.csv'),
+        expressions=path.join(annotree_dir, 'annotree_expressions.csv'),
+        genes_long=path.join(scale_dir, 'intermediate', 'genes_long.csv'),
+        genes_wide=path.join(scale_dir, 'intermediate', 'genes_by_organism.csv'),
+        outdir=path.join(scale_dir, 'intermediate'),
+    )
+    done = path.join(scale_dir, '.complete')
+    if path.exists(done):
+        return inputs
+
+    print(f'Generating inputs for scale {scale} in {scale_dir}')
+    os.makedirs(annotree_dir, exist_ok=True)
+    os.makedirs(inputs['outdir'], exist_ok=True)
+
+    metadata_df = synthetic.make_gtdb_metadata(scale, seed=seed)
+    synthetic.write_gtdb_metadata(metadata_df, inputs['metadata'])
+    synthetic.write_annotree_hits(annotree_dir, metadata_df['accession'].to_numpy(),
+                                  n_queries, max(1, scale // 50), seed=seed)
+    queries = synthetic.make_queries(n_queries)
+    synthetic.make_expressions(queries, n_expressions, seed=seed).to_csv(inputs['expressions'])
+
+    # The downstream benchmarks read the outputs of the tabulation stage
+    import tabulate_genes_by_organism
+    with working_directory(scale_dir), script_argv(
+            '--manifest', inputs['manifest'], '--out_long', inputs['genes_long'],
+            '--out_wide', inputs['genes_wide']):
+        tabulate_genes_by_organism.main()
+
+    open(done, 'w').close()
+    return inputs
+
+
+# Benchmarks: setup(inputs) imports the modules under test and returns the
+# arguments of run(), which is timed.
+
+def setup_metadata_counts(inputs):
+    import pandas as pd
+    import gtdb2stats
+    return (pd.read_csv(inputs['metadata'], sep='\t'),)
+
+
+def run_metadata_counts(metadata_df):
+    import gtdb2stats
+    gtdb2stats.metadata_phylogeny_counts(metadata_df)
+
+
+def setup_tabulate(inputs):
+    import tabulate_genes_by_organism
+    return (inputs,)
+
+
+def run_tabulate(inputs):
+    import tabulate_genes_by_organism
+    with working_directory(inputs['dir']), script_argv(
+            '--manifest', inputs['manifest'],
+            '--out_long', path.join(inputs['outdir'], 'bench_genes_long.csv'),
+            '--out_wide', path.join(inputs['outdir'], 'bench_genes_by_organism.csv')):
+        tabulate_genes_by_organism.main()
+
+
+def setup_apply_expressions(inputs):
+    import apply_expressions
+    return (inputs,)
+
+
+def run_apply_expressions(inputs):
+    import apply_expressions
+    outdir = path.join(inputs['outdir'], 'bench_expressions')
+    os.makedirs(outdir, exist_ok=True)
+    with script_argv('--input', inputs['genes_wide'], '--expressions', inputs['expressions'],
+                     '--outdir', outdir):
+        apply_expressions.main()
+
+
+def setup_hit_counts(inputs):
+    import pandas as pd
+    import hits2itol
+    from gtdb_metadata import load_gtdb_metadata
+    reps_df = load_gtdb_metadata(inputs['metadata'], use_cache=False,
+                                 representatives_only=True).set_index('accession')
+    hits = pd.read_csv(inputs['genes_wide'], index_col=0)
+    return hits, reps_df
+
+
+def run_hit_counts(hits, reps_df, agg_level='phylum'):
+    """Per-function count_hits/normalize_counts, as hits2itol did for each column."""
+    import hits2itol
+    for c in hits.columns:
+        gids = hits[hits[c] == True].index.to_list()
+        counts = hits2itol.count_hits(gids, reps_df, agg_level)
+        hits2itol.normalize_counts(counts, reps_df, agg_level)
+
+
+def run_hit_counts_all_levels(hits, reps_df):
+    import hits2itol
+    hits2itol.count_hits_all_levels(hits, reps_df, list(hits2itol.AGG_LEVELS))
+
+
+BENCHMARKS = {
+    'gtdb2stats.metadata_phylogeny_counts': (setup_metadata_counts, run_metadata_counts),
+    'tabulate_genes_by_organism.main': (setup_tabulate, run_tabulate),
+    'apply_expressions.main': (setup_apply_expressions, run_apply_expressions),
+    'hits2itol.count_hits+normalize_counts': (setup_hit_counts, run_hit_counts),
+    'hits2itol.count_hits_all_levels': (setup_hit_counts, run_hit_counts_all_levels),
+}
+
+
+def run_one(name, inputs, repeat, queue):
+    """Child process: set up, time run() repeat times, then trace its memory once."""
+    setup, run = BENCHMARKS[name]
+    args = setup(inputs)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    queue.put(dict(seconds=min(times), seconds_all=times,
+                   peak_traced_mb=peak / 1024 ** 2, peak_rss_mb=peak_rss_mb()))
+
+
+def run_benchmark(name, inputs, repeat, timeout=None):
+    """Run one benchmark in a fresh process.
+
+    Returns its measurements, or a dict with an error message if the process
+    exits without reporting (e.g. it raised or was killed for running out of
+    memory) or runs longer than timeout seconds.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_one, args=(name, inputs, repeat, queue))
+    proc.start()
+    start = time.monotonic()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not proc.is_alive():
+                # The result may have been queued just before the process exited
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    result = dict(error=f'process exited with code {proc.exitcode}')
+            elif timeout is not None and time.monotonic() - start > timeout:
+                proc.terminate()
+                result = dict(error=f'timed out after {timeout:g} s')
+    proc.join()
+    return result
+
+
+def environment():
+    import numpy
+    import pandas
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), numpy=numpy.__version__,
+                pandas=pandas.__version__, machine=platform.machine(),
+                processor=platform.processor(), cpu_count=os.cpu_count(),
+                timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def compare(results, baseline_fname):
+    """Print the speed and memory of results relative to a previous run."""
+    with open(baseline_fname) as fh:
+        baseline = {(r['benchmark'], r['scale']): r for r in json.load(fh)['results']}
+    print(f'\nComparison with {baseline_fname} (ratio < 1 is better):')
+    for r in results:
+        old = baseline.get((r['benchmark'], r['scale']))
+        if old is None or 'error' in old or 'error' in r:
+            continue
+        old_mb = old['peak_traced_mb']
+        memory_ratio = r['peak_traced_mb'] / old_mb if old_mb else float('nan')
+        print(f"  {r['benchmark']:45s} {r['scale']:>9d}  "
+              f"time x{r['seconds'] / old['seconds']:.2f}  memory x{memory_ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='Numbers of genomes to benchmark at.')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='Number of AnnoTree queries (hit files).')
+    parser.add_argument('--expressions', type=int, default=300,
+                        help='Number of synthetic expressions.')
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS), help='Benchmarks to run.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Timed repetitions per benchmark; the best is reported.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=str, default=path.join(tempfile.gettempdir(), 'pi_genes_bench'),
+                        help='Directory for the generated inputs, reused across runs.')
+    parser.add_argument('--out', type=str, default='benchmark_results.json',
+                        help='Output JSON file.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Previous results JSON to compare against.')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Seconds after which a benchmark is stopped and reported as failed.')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        inputs = prepare_inputs(args.workdir, scale, args.queries, args.expressions, args.seed)
+        for name in args.benchmarks:
+            result = run_benchmark(name, inputs, args.repeat, args.timeout)
+            result.update(benchmark=name, scale=scale)
+            results.append(result)
+            if 'error' in result:
+                print(f"{name:45s} {scale:>9d}  FAILED: {result['error']}")
+                continue
+            print(f"{name:45s} {scale:>9d}  {result['seconds']:8.3f} s  "
+                  f"{result['peak_traced_mb']:8.1f} MB")
+
+    report = dict(environment=environment(),
+                  parameters=dict(queries=args.queries, expressions=args.expressions,
+                                  seed=args.seed, repeat=args.repeat),
+                  results=results)
+    with open(args.out, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f'Results saved to {args.out}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Measure the start-up time of the pipeline scripts.
+
+Each script is run as a fresh interpreter with --help, which imports the script
+and its dependencies and exits after parsing the command line. That is the fixed
+cost every Snakemake job pays before touching any data. The slowest imports are
+listed from python -X importtime.
+
+    python benchmarks/startup.py --out startup.json
+    python benchmarks/startup.py --compare startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from os import path
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+SCRIPTS_DIR = path.join(path.dirname(BENCH_DIR), 'scripts')
+
+SCRIPTS = [
+    'tabulate_genes_by_organism.py',
+    'apply_expressions.py',
+    'hits2itol.py',
+    'gtdb2stats.py',
+    'fetch_gtdb.py',
+    'run_pipeline.py',
+    'phylo_signal.py',
+    'cooccurrence.py',
+    'hit_store.py',
+    'query_server.py',
+]
+
+
+def time_startup(script, repeat):
+    """Wall times in seconds of repeat runs of `python script --help`."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, path.join(SCRIPTS_DIR, script), '--help'],
+                       cwd=SCRIPTS_DIR, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def slowest_imports(script, n=5):
+    """Third-party and standard library packages with the largest cumulative
+    import time for a script, in seconds. The pipeline's own modules are left out."""
+    local = {path.splitext(f)[0] for f in os.listdir(SCRIPTS_DIR) if f.endswith('.py')}
+    module = path.splitext(script)[0]
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True)
+    totals = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        package = parts[2].strip().split('.')[0]
+        if package not in local:
+            totals[package] = max(totals.get(package, 0), int(parts[1]) / 1e6)
+    return sorted(totals.items(), key=lambda kv: -kv[1])[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scripts', type=str, nargs='+', default=SCRIPTS, choices=SCRIPTS,
+                        help='Scripts to time.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per script; the median and minimum are reported.')
+    parser.add_argument('--out', type=str, default='startup_results.json',
+                        help='Output JSON file.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Previous results JSON to compare against.')
+    args = parser.parse_args()
+
+    results = []
+    for script in args.scripts:
+        times = time_startup(script, args.repeat)
+        imports = slowest_imports(script)
+        results.append(dict(script=script, median_seconds=statistics.median(times),
+                            min_seconds=min(times), seconds_all=times,
+                            slowest_imports=imports))
+        print(f'{script:32s} {statistics.median(times):6.3f} s  (slowest imports: '
+              + ', '.join(f'{name} {seconds:.2f} s' for name, seconds in imports[:3]) + ')')
+
+    report = dict(environment=dict(python=platform.python_version(), machine=platform.machine(),
+                                   cpu_count=os.cpu_count(),
+                                   timestamp=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                  repeat=args.repeat, results=results)
+    with open(args.out, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f'Results saved to {args.out}')
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = {r['script']: r for r in json.load(fh)['results']}
+        print(f'\nComparison with {args.compare} (ratio < 1 is better):')
+        for r in results:
+            old = baseline.get(r['script'])
+            if old is not None:
+                print(f"  {r['script']:32s} x{r['median_seconds'] / old['median_seconds']:.2f}")
+
+
+if __name__ == '__main__':
+    main()
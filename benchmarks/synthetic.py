@@ -0,0 +1,161 @@
+"""Seeded generators of synthetic GTDB-scale pipeline inputs.
+
+- GTDB-style metadata tables with valid gtdb_taxonomy strings
+- AnnoTree per-query hit CSVs and a matching manifest
+- expression files with nested expressions that reference each other
+
+The same (size, seed) always produces the same data.
+"""
+
+import numpy as np
+import pandas as pd
+
+from os import path
+
+LEVEL_PREFIXES = ['d', 'p', 'c', 'o', 'f', 'g', 's']
+
+# Approximate number of children per taxon at each level below the domain,
+# loosely following GTDB: few phyla, many genera and species
+BRANCHING = {'p': 40, 'c': 3, 'o': 4, 'f': 4, 'g': 5}
+GENOMES_PER_SPECIES = 4
+
+
+def make_lineages(n_species, rng, domain='Bacteria'):
+    """Random taxonomy strings for n_species species."""
+    # Assign each species to a genus, each genus to a family, ... by integer division
+    # of shuffled ids, so that every level forms a proper tree.
+    n_genera = max(1, n_species // BRANCHING['g'])
+    genus = rng.integers(0, n_genera, n_species)
+    family = genus % max(1, n_genera // BRANCHING['f'])
+    order = family % max(1, n_genera // (BRANCHING['f'] * BRANCHING['o']))
+    klass = order % max(1, n_genera // (BRANCHING['f'] * BRANCHING['o'] * BRANCHING['c']))
+    phylum = klass % BRANCHING['p']
+
+    return np.array([
+        f'd__{domain};p__Phylum{p};c__Class{c};o__Order{o};f__Family{f};g__Genus{g};'
+        f's__Genus{g} sp{i}'
+        for i, (p, c, o, f, g) in enumerate(zip(phylum, klass, order, family, genus))
+    ], dtype=object)
+
+
+def make_gtdb_metadata(n_genomes, seed=0, domain='Bacteria', n_extra_columns=10):
+    """Synthetic GTDB metadata table.
+
+    Args:
+        n_genomes (int): number of genomes (rows).
+        seed (int): random seed.
+        domain (str): 'Bacteria' or 'Archaea'.
+        n_extra_columns (int): number of unused numeric columns, standing in for
+            the ~100 other columns of the real metadata.
+
+    Returns:
+        pd.DataFrame: with accession, gtdb_representative, gtdb_taxonomy and the
+            extra columns. The first genome of each species is its representative.
+    """
+    rng = np.random.default_rng(seed)
+    n_species = max(1, n_genomes // GENOMES_PER_SPECIES)
+    lineages = make_lineages(n_species, rng, domain)
+
+    # Skewed species sizes, every species has at least one genome
+    species = np.concatenate([np.arange(n_species),
+                              rng.zipf(1.5, n_genomes - n_species) % n_species])
+    rng.shuffle(species)
+    representative = np.zeros(n_genomes, dtype=bool)
+    _, first = np.unique(species, return_index=True)
+    representative[first] = True
+
+    prefix = 'GB_GCA_' if domain == 'Bacteria' else 'GB_GCA_9'
+    metadata_df = pd.DataFrame({
+        'accession': [f'{prefix}{i:09d}.1' for i in range(n_genomes)],
+        'gtdb_representative': np.where(representative, 't', 'f'),
+        'gtdb_taxonomy': lineages[species],
+    })
+    for i in range(n_extra_columns):
+        metadata_df[f'extra_{i}'] = rng.random(n_genomes)
+    return metadata_df
+
+
+def write_gtdb_metadata(metadata_df, fname):
+    """Write a metadata table as GTDB does: tab-separated, gzipped if fname ends in .gz."""
+    metadata_df.to_csv(fname, sep='\t', index=False)
+
+
+def make_queries(n_queries):
+    """KEGG-like query identifiers."""
+    return [f'K{i:05d}' for i in range(1, n_queries + 1)]
+
+
+def write_annotree_hits(outdir, genomes, n_queries, rows_per_query, seed=0):
+    """Write AnnoTree-style per-query hit CSVs and a manifest listing them.
+
+    Args:
+        outdir (str): directory for the {query}_bacteria.csv files.
+        genomes (array): genome accessions hits are drawn from.
+        n_queries (int): number of queries (files).
+        rows_per_query (int): mean number of hits per query. Hits include
+            genomes with several copies of a gene.
+        seed (int): random seed.
+
+    Returns:
+        pd.DataFrame: the manifest, also written to outdir/annotree_manifest.csv.
+    """
+    rng = np.random.default_rng(seed)
+    genomes = np.asarray(genomes)
+    queries = make_queries(n_queries)
+    gene_offset = 0
+    for query in queries:
+        n_rows = max(1, int(rng.poisson(rows_per_query)))
+        hit_genomes = genomes[rng.integers(0, len(genomes), n_rows)]
+        hits_df = pd.DataFrame({
+            'gtdbId': hit_genomes,
+            'geneId': [f'gene{i}' for i in range(gene_offset, gene_offset + n_rows)],
+            'SearchId': query,
+            'percentIdentity': rng.random(n_rows).round(3),
+            'eValue': rng.random(n_rows) * 1e-10,
+        })
+        gene_offset += n_rows
+        hits_df.to_csv(path.join(outdir, f'{query}_bacteria.csv'), index=False)
+
+    manifest = pd.DataFrame({
+        'name': queries,
+        'function': [f'function_{i % 50}' for i in range(n_queries)],
+        'function_type': 'synthetic',
+        'nutrient': [f'N{i % 4}' for i in range(n_queries)],
+        'query': queries,
+        'query_type': 'KEGG',
+        'domain': 'bacteria',
+    })
+    manifest.to_csv(path.join(outdir, 'annotree_manifest.csv'), index=False)
+    return manifest
+
+
+def make_expressions(queries, n_expressions, seed=0, max_depth=3, n_nutrients=4):
+    """Random nested expressions over queries and earlier expressions.
+
+    Returns:
+        pd.DataFrame: indexed by name with nutrient, for_display and
+            boolean_expression columns, like annotree_expressions.csv.
+    """
+    rng = np.random.default_rng(seed)
+    names = []
+
+    def term(depth):
+        r = rng.random()
+        if depth >= max_depth or r < 0.35:
+            # Leaf: mostly genes, sometimes an earlier function
+            if names and rng.random() < 0.2:
+                return names[rng.integers(len(names))]
+            return queries[rng.integers(len(queries))]
+        if r < 0.45:
+            return f'NOT {term(depth + 1)}'
+        op = ' AND ' if rng.random() < 0.5 else ' OR '
+        n_operands = rng.integers(2, 5)
+        return '(' + op.join(term(depth + 1) for _ in range(n_operands)) + ')'
+
+    rows = []
+    for i in range(n_expressions):
+        name = f'function_{i}'
+        rows.append(dict(name=name, nutrient=f'N{i % n_nutrients}',
+                         for_display=bool(rng.random() < 0.5), boolean_expression=term(0)))
+        names.append(name)
+    return pd.DataFrame(rows).set_index('name')
@@ -1,53 +1,251 @@
-from exp_parsing import BooleanExpressionParser
+from exp_parsing import BooleanExpressionParser, ExpressionGraph
+from hit_store import HitStore
+from presence_matrix import PresenceMatrix
+from profiling import add_profile_arguments
+from stage_cache import add_stage_cache_arguments, hash_bytes, hash_strings, open_stage_cache
+from table_io import TABLE_EXTENSIONS, add_format_argument, read_table, write_table
+from tabulate_genes_by_organism import counts_from_hits
+import numpy as np
 import pandas as pd
 import argparse
+import profiling
 from os import path
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Apply boolean expressions to gene rows.")
-    parser.add_argument('--input', type=str, required=True, help='Path to the input CSV file with gene data. Rows represent genomes and columns represent genes.')
-    parser.add_argument('--expressions', type=str, required=True, help='Path to the file containing boolean expressions')
-    parser.add_argument('--outdir', type=str, required=True, help='Path to the output directory')
-    args = parser.parse_args()
+def function_cache_keys(graph, presence):
+    """Stage cache key of every function of an expression graph over a presence matrix.
 
-    # Load the gene data
-    gene_data_df = pd.read_csv(args.input, index_col=0).dropna(how='all')
+    A key covers the function's normalized expression, the data of each gene
+    it references and the genomes, so editing one expression or changing one
+    query's hits changes only the keys of the functions that use them.
+    """
+    genomes_key = hash_strings(presence.genomes)
+    column_keys = {gene: hash_bytes(presence.column(gene)) if gene in presence else 'absent'
+                   for gene in graph.genes()}
+    return {name: hash_bytes(genomes_key,
+                             graph.canonical_form(name, lambda g: f'{g}@{column_keys[g]}'))
+            for name in graph.roots}
+
+
+def evaluate_cached(graph, presence, cache):
+    """Evaluate the graph over a presence matrix, reading unchanged functions
+    from the stage cache and caching the rest."""
+    keys = function_cache_keys(graph, presence)
+    names = list(graph.expressions)
+    bits = {name: cache.get_array('function', keys[name]) for name in names}
+    missing = [name for name in names if bits[name] is None]
+    if missing:
+        computed = graph.evaluate(presence, functions=missing)
+        for name, column in zip(computed.genes, computed.bits):
+            cache.put_array('function', keys[name], column)
+            bits[name] = column
+    print(f"Function columns: {len(names) - len(missing)} unchanged, {len(missing)} evaluated")
+    stacked = np.stack([bits[name] for name in names]) if names \
+        else np.zeros((0, presence.bits.shape[1]), dtype=np.uint8)
+    return PresenceMatrix(presence.genomes, names, stacked)
+
+
+def read_gene_counts(fname):
+    """Genome x query hit counts from a count table indexed by gtdbId
+    (tabulate_genes_by_organism.py --out_counts) or from the long hit table."""
+    df = read_table(fname)
+    if {'gtdbId', 'geneId', 'SearchId'}.issubset(df.columns):
+        return counts_from_hits(df)
+    return df.set_index(df.columns[0]).dropna(how='all')
 
-    # Load the expressions -- rows are functional categories with expressions to be 
-    # run in the same order as the file
-    expressions_df = pd.read_csv(args.expressions, index_col=0).dropna(how='all')
 
-    parser = BooleanExpressionParser()
-    for function_name, row in expressions_df.iterrows():
-        parsed = parser.parse_expression(row['boolean_expression'])
-        print(f"Applying expression for {function_name}: {row['boolean_expression']}")
-        print(f"Parsed expression: {parsed.as_list()}")
+def derive_functions(genes, expressions_df, row_wise=False, parser=None, cache=None,
+                     quantitative=False):
+    """Gene data with one column added per function in expressions_df.
+
+    Functions named like an input gene replace it in place; the others are
+    appended in the order of expressions_df.
+
+    Args:
+        genes (pd.DataFrame or PresenceMatrix): genomes x genes presence.
+        expressions_df (pd.DataFrame): expressions indexed by function name, with a
+            boolean_expression column. Expressions may refer to other functions.
+        row_wise (bool): evaluate one genome at a time, in file order (slow, for
+            checking). Only for DataFrame input.
+        parser (BooleanExpressionParser): parser to use; a new one by default.
+        cache (StageCache): if given, functions whose expression and input
+            columns are unchanged since a previous run are read from it.
+        quantitative (bool): genes holds per-genome gene counts (a DataFrame) and
+            functions are count-valued (ExpressionGraph.evaluate). The stage
+            cache is not used.
+
+    Returns:
+        pd.DataFrame or PresenceMatrix: same type as genes.
+    """
+    parser = parser or BooleanExpressionParser()
+    if row_wise:
+        # Legacy path: expressions run in the same order as the file
+        gene_data_df = genes.copy()
+        for function_name, row in expressions_df.iterrows():
+            parsed = parser.parse_expression(row['boolean_expression'])
+            print(f"Applying expression for {function_name}: {row['boolean_expression']}")
+            print(f"Parsed expression: {parsed.as_list()}")
+            with profiling.stage(f'evaluate {function_name}', rows=len(gene_data_df)):
+                gene_data_df[function_name] = gene_data_df.apply(
+                    lambda row: parser.evaluate(parsed, row), axis=1
+                )
+        return gene_data_df
+
+    with profiling.stage('build expression graph', rows=len(expressions_df)) as st:
+        graph = ExpressionGraph(expressions_df['boolean_expression'].to_dict(), parser=parser)
+        st.info.update(nodes=len(graph.nodes), expression_terms=graph.n_tree_nodes)
+    print(f"Built expression graph for {len(graph.roots)} functions: "
+          f"{len(graph.nodes)} unique nodes from {graph.n_tree_nodes} expression terms")
+    available = genes.genes if isinstance(genes, PresenceMatrix) else genes.columns
+    undefined = graph.undefined_names(available)
+    if undefined:
+        print(f"Warning: names not found in the gene data or expressions "
+              f"(treated as absent): {undefined}")
+
+    # Shared subexpressions are evaluated once for all functions, so the
+    # graph is timed as a whole rather than per expression
+    n_genomes = genes.n_genomes if isinstance(genes, PresenceMatrix) else len(genes)
+    with profiling.stage('evaluate expressions', rows=n_genomes, functions=len(graph.roots)):
+        if quantitative:
+            derived = graph.evaluate(genes, quantitative=True)
+        elif cache is not None:
+            presence = genes if isinstance(genes, PresenceMatrix) \
+                else PresenceMatrix.from_dataframe(genes == True)
+            derived = evaluate_cached(graph, presence, cache)
+            if not isinstance(genes, PresenceMatrix):
+                derived = pd.DataFrame(derived.to_dense(), index=genes.index,
+                                       columns=derived.genes)
+        else:
+            derived = graph.evaluate(genes)
+        if isinstance(genes, PresenceMatrix):
+            # Evaluated on the packed columns directly
+            return genes.with_columns(derived)
+        replaced = [c for c in derived.columns if c in genes.columns]
+        gene_data_df = genes.copy() if replaced else genes
+        if replaced:
+            gene_data_df[replaced] = derived[replaced]
+        appended = [c for c in derived.columns if c not in gene_data_df.columns]
+        return pd.concat([gene_data_df, derived[appended]], axis=1)
+
+
+def display_functions(expressions_df):
+    """Functions marked for display, grouped by nutrient.
+
+    Returns:
+        dict: nutrient -> list of function names, in the order of expressions_df.
+    """
+    expressions_for_display = expressions_df[expressions_df['for_display']]
+    return {nutrient: expressions_for_display[expressions_for_display['nutrient'] == nutrient].index.tolist()
+            for nutrient in expressions_for_display['nutrient'].unique()}
 
-        gene_data_df[function_name] = gene_data_df.apply(
-            lambda row: parser.evaluate(parsed, row), axis=1
-        )
 
-    # Save the results to the output file
-    full_output_path = path.join(args.outdir, 'gene_data_with_derived_functions.csv')
-    gene_data_df.to_csv(full_output_path)
+def write_functional_results(gene_data_df, expressions_df, outdir, table_format='csv'):
+    """Write the gene data with derived functions, the displayed functions and one
+    table of displayed functions per nutrient to outdir."""
+    ext = TABLE_EXTENSIONS[table_format]
+    full_output_path = path.join(outdir, f'gene_data_with_derived_functions{ext}')
+    with profiling.stage('write', rows=len(gene_data_df)):
+        write_table(gene_data_df, full_output_path, table_format)
     print(f"Results saved to {full_output_path}")
 
     # Retain only the columns marked as "for_display" in the expressions DataFrame
     display_columns = expressions_df[expressions_df['for_display']].index.tolist()
     display_df = gene_data_df[display_columns]
-    display_output_path = path.join(args.outdir, 'functional_results.csv')
-    display_df.to_csv(display_output_path)
+    display_output_path = path.join(outdir, f'functional_results{ext}')
+    with profiling.stage('write display', rows=len(display_df)):
+        write_table(display_df, display_output_path, table_format)
     print(f"Display results saved to {display_output_path}")
 
-    expressions_for_display = expressions_df[expressions_df['for_display']]
-    for nutrient in expressions_for_display['nutrient'].unique():
-        nutrient_exps = expressions_for_display[expressions_for_display['nutrient'] == nutrient].index.tolist()
+    for nutrient, nutrient_exps in display_functions(expressions_df).items():
         nutrient_df = display_df[nutrient_exps]
 
-        nutrient_output_path = path.join(args.outdir, f'{nutrient}_functional_results.csv')
-        nutrient_df.to_csv(nutrient_output_path)
+        nutrient_output_path = path.join(outdir, f'{nutrient}_functional_results{ext}')
+        with profiling.stage(f'write {nutrient}', rows=len(nutrient_df)):
+            write_table(nutrient_df, nutrient_output_path, table_format)
         print(f"Results for {nutrient}-related genetic functions saved to {nutrient_output_path}")
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply boolean expressions to gene rows.")
+    parser.add_argument('--input', type=str, required=True, help='Path to the input CSV file with gene data, a packed presence matrix (.npz) or a hit store directory (hit_store.py). Rows represent genomes and columns represent genes.')
+    parser.add_argument('--expressions', type=str, required=True, help='Path to the file containing boolean expressions')
+    parser.add_argument('--outdir', type=str, required=True, help='Path to the output directory')
+    parser.add_argument('--row_wise', action='store_true', default=False,
+                        help='Evaluate expressions one genome at a time instead of over whole columns (slow, for checking).')
+    parser.add_argument('--quantitative', action='store_true', default=False,
+                        help='Evaluate expressions over gene copy numbers: --input is a count table '
+                             '(tabulate_genes_by_organism.py --out_counts) or the long hit table, AND '
+                             'is the minimum, OR the sum and NOT is 1 where the count is 0. Functions '
+                             'are written as counts.')
+    add_format_argument(parser, default='csv')
+    add_stage_cache_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.quantitative and (args.row_wise or args.input.endswith('.npz') or HitStore.is_store(args.input)):
+        parser.error('--quantitative needs a count table or the long hit table as --input, '
+                     'and does not support --row_wise')
+    profiling.start('apply_expressions', args.profile_out, args.cprofile_out)
+
+    # Load the expressions -- rows are functional categories. Expressions may refer
+    # to other functions by name; these are resolved through the expression graph.
+    with profiling.stage('read expressions') as st:
+        expressions_df = pd.read_csv(args.expressions, index_col=0).dropna(how='all')
+        st.rows = len(expressions_df)
+
+    # Load the gene data
+    with profiling.stage('read gene data') as st:
+        if args.quantitative:
+            genes = read_gene_counts(args.input)
+        elif HitStore.is_store(args.input):
+            # Only the queries the expressions use are read from the store
+            genes = HitStore(args.input).presence_for_expressions(expressions_df)
+            if args.row_wise:
+                genes = genes.to_dataframe()
+        elif args.input.endswith('.npz'):
+            genes = PresenceMatrix.load(args.input)
+            if args.row_wise:
+                genes = genes.to_dataframe()
+        else:
+            genes = read_table(args.input, index_col=0).dropna(how='all')
+        st.rows = len(genes.genomes) if isinstance(genes, PresenceMatrix) else len(genes)
+
+    gene_data = derive_functions(genes, expressions_df, row_wise=args.row_wise,
+                                 cache=None if args.row_wise else open_stage_cache(args),
+                                 quantitative=args.quantitative)
+    if isinstance(gene_data, PresenceMatrix):
+        gene_data = gene_data.to_dataframe()
+
+    # Save the results to the output directory
+    write_functional_results(gene_data, expressions_df, args.outdir, args.table_format)
+    profiling.finish()
+
+
+# Unit testing
+import unittest
+
+class TestDeriveFunctions(unittest.TestCase):
+    def test_cache_recomputes_changed_functions(self):
+        import tempfile
+        from stage_cache import StageCache
+
+        rng = np.random.default_rng(0)
+        genes = pd.DataFrame(rng.random((40, 3)) < 0.5, columns=['K1', 'K2', 'K3'],
+                             index=pd.Index([f'genome{i}' for i in range(40)], name='gtdbId'))
+        expressions_df = pd.DataFrame({'boolean_expression': ['K1 AND K2', 'f1 OR K3', 'NOT K3']},
+                                      index=['f1', 'f2', 'f3'])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = StageCache(tmpdir)
+            expected = derive_functions(genes, expressions_df)
+            pd.testing.assert_frame_equal(derive_functions(genes, expressions_df, cache=cache), expected)
+            self.assertEqual(cache.misses, 3)
+
+            # f1 changes, and with it f2 which refers to it; f3 is reused
+            expressions_df.loc['f1', 'boolean_expression'] = 'K2 AND K1 AND NOT K3'
+            cache.hits = cache.misses = 0
+            derived = derive_functions(PresenceMatrix.from_dataframe(genes), expressions_df, cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            pd.testing.assert_frame_equal(derived.to_dataframe(),
+                                          derive_functions(genes, expressions_df))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
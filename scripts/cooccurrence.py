@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+"""Pairwise co-occurrence of queries and derived functions across genomes.
+
+For every pair of genes (queries or derived functions) a and b, counts the
+genomes with a, with b and with both, and tests whether they co-occur more or
+less often than expected if independent: the one-sided hypergeometric tail
+probabilities, i.e. Fisher's exact test of the 2x2 table.
+
+All joint counts come from one matrix product of the genes x genomes presence,
+accumulated over chunks of genomes unpacked from the packed presence matrix,
+so thousands of genes (millions of pairs) never need the full dense table or
+any per-pair filtering. With --stratify the counts and tests are per taxon,
+e.g. per phylum, to separate co-occurrence from shared ancestry.
+
+    python scripts/cooccurrence.py --in intermediate/annotree/gene_data_with_derived_functions.csv \\
+        --out output/cooccurrence.csv --genes CP_lyase
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import profiling
+
+from gtdb_metadata import add_cache_arguments
+from hits2itol import AGG_LEVELS, load_representatives
+from phylo_signal import benjamini_hochberg
+from presence_matrix import PresenceMatrix
+from profiling import add_profile_arguments
+from table_io import read_table, write_table
+
+# Genomes unpacked per step of the joint count product
+DEFAULT_CHUNK_GENOMES = 16384
+
+
+def joint_counts(presence, rows, genes_a=None, genes_b=None, chunk_genomes=DEFAULT_CHUNK_GENOMES):
+    """Genomes with each gene and with each pair of genes, over a set of genomes.
+
+    Args:
+        presence (PresenceMatrix): genomes x genes presence.
+        rows (np.ndarray): rows of the genomes to count over; -1 for genomes
+            without any hit.
+        genes_a (list): genes of the rows of the joint counts; default all.
+        genes_b (list): genes of the columns; default genes_a.
+        chunk_genomes (int): genomes unpacked at a time.
+
+    Returns:
+        tuple: (n_a, n_b, joint) with joint[i, j] the number of genomes with
+            both genes_a[i] and genes_b[j].
+    """
+    pm_a = presence if genes_a is None else presence.select(genes_a)
+    pm_b = pm_a if genes_b is None else presence.select(genes_b)
+    joint = np.zeros((pm_a.n_genes, pm_b.n_genes), dtype=np.int64)
+    n_a = np.zeros(pm_a.n_genes, dtype=np.int64)
+    n_b = np.zeros(pm_b.n_genes, dtype=np.int64)
+    for start in range(0, len(rows), chunk_genomes):
+        chunk = rows[start:start + chunk_genomes]
+        a = pm_a.dense_rows(chunk)
+        b = a if pm_b is pm_a else pm_b.dense_rows(chunk)
+        n_a += a.sum(axis=0)
+        n_b += b.sum(axis=0)
+        # float32 products are exact for counts below 2^24 per chunk and use BLAS
+        a = a.astype(np.float32)
+        b = a if pm_b is pm_a else b.astype(np.float32)
+        joint += np.rint(a.T @ b).astype(np.int64)
+    return n_a, n_b, joint
+
+
+def _hypergeom_far_tail(x0, n_total, n_a, n_b, upper):
+    """P(X >= x0) (upper) or P(X <= x0) of hypergeometric X, for x0 on the far
+    side of the mode, where the terms decrease geometrically.
+
+    Sums pmf ratios from x0 outwards for all pairs at once, dropping pairs as
+    their terms become negligible, then scales by pmf(x0).
+    """
+    # Deferred: scipy.special is slow to import
+    from scipy.special import gammaln
+
+    def log_choose(n, k):
+        return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+    x = x0.astype(np.float64)
+    n_total = np.broadcast_to(np.float64(n_total), x.shape)
+    lowest = np.maximum(0, n_a + n_b - n_total)
+    highest = np.minimum(n_a, n_b)
+    in_support = (x >= lowest) & (x <= highest)
+    x_safe = np.clip(x, lowest, highest)
+    log_pmf = (log_choose(n_a, x_safe) + log_choose(n_total - n_a, n_b - x_safe)
+               - log_choose(n_total, n_b))
+
+    # Terms become exactly 0 past the edge of the support, so only convergence
+    # is checked. Pairs that converged keep adding negligible terms until the
+    # working arrays are compacted, which avoids re-indexing on every step.
+    total = np.ones(len(x))
+    pos = np.flatnonzero(in_support)
+    xi, a, b = x[pos], n_a[pos], n_b[pos]
+    rest = n_total[pos] - a - b
+    term, tot = np.ones(len(pos)), np.ones(len(pos))
+    eps = np.finfo(np.float64).eps / 4
+    while len(pos):
+        if upper:
+            term *= (a - xi) * (b - xi) / ((xi + 1) * (rest + xi + 1))
+            xi += 1
+        else:
+            term *= xi * (rest + xi) / ((a - xi + 1) * (b - xi + 1))
+            xi -= 1
+        tot += term
+        more = term > eps * tot
+        n_more = np.count_nonzero(more)
+        if n_more < 0.75 * len(pos):
+            total[pos] = tot
+            pos, xi, a, b, rest, term, tot = (v[more] for v in (pos, xi, a, b, rest, term, tot))
+    return np.where(in_support, np.exp(log_pmf) * total, 0.0)
+
+
+def hypergeom_tails(k, n_total, n_a, n_b):
+    """Both one-sided hypergeometric p-values of k genomes with two genes.
+
+    Equal to scipy.stats.hypergeom.sf(k - 1, ...) and .cdf(k, ...), i.e. the
+    one-sided Fisher exact tests, but vectorized over millions of pairs: each
+    tail is summed from the side away from the mode, where it converges in a
+    few standard deviations, and the near side is its complement.
+
+    Returns:
+        tuple: (p_enriched, p_depleted), P(X >= k) and P(X <= k).
+    """
+    k, n_a, n_b = (np.asarray(v, dtype=np.float64) for v in (k, n_a, n_b))
+    mode = np.floor((n_a + 1) * (n_b + 1) / (n_total + 2))
+    above = k > mode
+    below = k < mode
+
+    p_enriched = np.empty(len(k))
+    p_enriched[above] = _hypergeom_far_tail(k[above], n_total, n_a[above], n_b[above], True)
+    p_enriched[~above] = 1 - _hypergeom_far_tail(k[~above] - 1, n_total, n_a[~above],
+                                                 n_b[~above], False)
+    p_depleted = np.empty(len(k))
+    p_depleted[below] = _hypergeom_far_tail(k[below], n_total, n_a[below], n_b[below], False)
+    p_depleted[~below] = 1 - _hypergeom_far_tail(k[~below] + 1, n_total, n_a[~below],
+                                                 n_b[~below], True)
+    return np.clip(p_enriched, 0, 1), np.clip(p_depleted, 0, 1)
+
+
+def pair_statistics(genes_a, genes_b, n_a, n_b, joint, n_genomes, symmetric=False, min_joint=0):
+    """Long table of co-occurrence statistics of gene pairs.
+
+    Args:
+        genes_a, genes_b (list): genes of the rows and columns of joint.
+        n_a, n_b (np.ndarray): genomes with each gene.
+        joint (np.ndarray): genomes with both genes of each pair.
+        n_genomes (int): genomes counted over.
+        symmetric (bool): genes_a and genes_b are the same; report each pair once.
+        min_joint (int): leave out pairs found together in fewer genomes.
+
+    Returns:
+        pd.DataFrame: gene_a, gene_b, n_genomes, n_a, n_b, n_both, jaccard,
+            expected, enrichment (observed / expected), p_enriched (probability
+            of at least n_both by chance) and p_depleted (at most n_both).
+    """
+    if symmetric:
+        i, j = np.triu_indices(len(genes_a), k=1)
+    else:
+        i, j = np.indices(joint.shape).reshape(2, -1)
+        distinct = np.asarray(genes_a, dtype=object)[i] != np.asarray(genes_b, dtype=object)[j]
+        i, j = i[distinct], j[distinct]
+    both = joint[i, j]
+    keep = both >= min_joint
+    i, j, both = i[keep], j[keep], both[keep]
+    a, b = n_a[i], n_b[j]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        union = a + b - both
+        jaccard = np.where(union > 0, both / union, np.nan)
+        expected = a * b / n_genomes if n_genomes else np.full(len(i), np.nan)
+        enrichment = both / expected
+    p_enriched, p_depleted = hypergeom_tails(both, n_genomes, a, b)
+    return pd.DataFrame({
+        'gene_a': np.asarray(genes_a)[i],
+        'gene_b': np.asarray(genes_b)[j],
+        'n_genomes': n_genomes,
+        'n_a': a,
+        'n_b': b,
+        'n_both': both,
+        'jaccard': jaccard,
+        'expected': expected,
+        'enrichment': enrichment,
+        'p_enriched': p_enriched,
+        'p_depleted': p_depleted,
+    })
+
+
+def cooccurrence(presence, genomes, genes=None, strata=None, min_joint=0,
+                 chunk_genomes=DEFAULT_CHUNK_GENOMES):
+    """Co-occurrence statistics of all pairs of genes, optionally per stratum.
+
+    Args:
+        presence (PresenceMatrix): genomes x genes presence.
+        genomes (pd.Index): genomes to count over, e.g. the GTDB representatives.
+            Genomes not in presence have no genes.
+        genes (list): if given, only pairs with one of these genes, against
+            every gene.
+        strata (pd.Series): stratum (e.g. phylum) of each genome in genomes;
+            statistics are computed within each one.
+        min_joint (int): leave out pairs found together in fewer genomes.
+        chunk_genomes (int): genomes unpacked at a time.
+
+    Returns:
+        pd.DataFrame: pair_statistics() of every pair (and stratum, with a
+            stratum column), with q_enriched, the Benjamini-Hochberg adjusted
+            p_enriched within each stratum.
+    """
+    rows = pd.Index(presence.genomes).get_indexer(genomes)
+    if strata is None:
+        groups = {'all': np.arange(len(genomes))}
+    else:
+        codes, names = pd.factorize(np.asarray(strata), sort=True)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+        groups = {name: order[bounds[s]:bounds[s + 1]] for s, name in enumerate(names)}
+
+    all_genes = presence.genes.tolist()
+    genes_b = None if genes is None else all_genes
+    tables = []
+    for name, members in groups.items():
+        with profiling.stage(f'joint counts {name}', rows=len(members)):
+            n_a, n_b, joint = joint_counts(presence, rows[members], genes, genes_b, chunk_genomes)
+        with profiling.stage(f'pair statistics {name}') as st:
+            table = pair_statistics(genes or all_genes, all_genes, n_a, n_b, joint, len(members),
+                                    symmetric=genes is None, min_joint=min_joint)
+            table['q_enriched'] = benjamini_hochberg(table['p_enriched'])
+            st.rows = len(table)
+        if strata is not None:
+            table.insert(0, 'stratum', name)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--in', '-i', type=str, required=True, dest='input',
+                        help='Genomes x genes presence table (CSV, parquet or feather) indexed by '
+                             'gtdbId, e.g. gene_data_with_derived_functions, or a packed presence '
+                             'matrix (.npz).')
+    parser.add_argument('--out', '-o', type=str, default='cooccurrence.csv',
+                        help='Output table, one row per gene pair (and stratum).')
+    parser.add_argument('-d', '--domain', type=str, default='bacteria',
+                        help='Domain to use for GTDB representative genomes.',
+                        choices=('bacteria', 'archaea'))
+    parser.add_argument('--genes', type=str, default=None, nargs='+',
+                        help='Only test pairs of these genes with every gene.')
+    parser.add_argument('--stratify', type=str, default=None,
+                        help='Test within each taxon of this level.',
+                        choices=[level for level in AGG_LEVELS if level != 'species'])
+    parser.add_argument('--table_genomes', action='store_true',
+                        help='Count over the genomes in the input table instead of the '
+                             'GTDB representatives (no metadata needed unless stratified).')
+    parser.add_argument('--min_joint', type=int, default=1,
+                        help='Leave out pairs found together in fewer genomes.')
+    parser.add_argument('--chunk_genomes', type=int, default=DEFAULT_CHUNK_GENOMES,
+                        help='Genomes unpacked at a time for the joint counts.')
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    profiling.start('cooccurrence', args.profile_out, args.cprofile_out)
+    print(f'Input file: {args.input}')
+
+    with profiling.stage('read presence') as st:
+        if args.input.endswith('.npz'):
+            presence = PresenceMatrix.load(args.input)
+        else:
+            presence = PresenceMatrix.from_dataframe(read_table(args.input, index_col=0) == True)
+        st.rows = presence.n_genomes
+
+    strata = None
+    if args.table_genomes and not args.stratify:
+        genomes = pd.Index(presence.genomes)
+    else:
+        print('Reading representatives...')
+        reps_df = load_representatives(args.domain, cache_dir=args.cache_dir,
+                                       use_cache=not args.no_cache)
+        if args.table_genomes:
+            reps_df = reps_df[reps_df.index.isin(presence.genomes)]
+        genomes = reps_df.index
+        if args.stratify:
+            strata = reps_df[AGG_LEVELS[args.stratify]].astype(str)
+
+    if args.genes:
+        missing = [g for g in args.genes if g not in presence]
+        if missing:
+            raise ValueError(f"Genes not in {args.input}: {', '.join(missing)}")
+    print(f'Counting co-occurrence of {presence.n_genes} genes in {len(genomes)} genomes')
+    results = cooccurrence(presence, genomes, args.genes, strata, args.min_joint, args.chunk_genomes)
+    with profiling.stage('write table', rows=len(results)):
+        write_table(results, args.out, index=False)
+    print(f'{len(results)} gene pairs saved to {args.out}')
+    profiling.finish()
+
+
+# Unit testing
+import unittest
+
+class TestCooccurrence(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 150
+        df = pd.DataFrame(rng.random((n, 4)) < [0.2, 0.5, 0.7, 0.1],
+                          index=[f'genome{i}' for i in range(n)], columns=['K1', 'K2', 'K3', 'K4'])
+        df['f1'] = df['K1'] | df['K4']
+        self.df = df
+        self.presence = PresenceMatrix.from_dataframe(df)
+        # Genomes without hits are part of the universe
+        self.genomes = pd.Index(list(df.index[10:]) + ['genome_x', 'genome_y'])
+
+    def brute_force(self, a, b, genomes):
+        df = self.df.reindex(genomes, fill_value=False)
+        return (df[a] & df[b]).sum(), df[a].sum(), df[b].sum()
+
+    def test_all_pairs(self):
+        from scipy.stats import fisher_exact
+        table = cooccurrence(self.presence, self.genomes, chunk_genomes=16)
+        self.assertEqual(len(table), 10)
+        for row in table.itertuples():
+            both, n_a, n_b = self.brute_force(row.gene_a, row.gene_b, self.genomes)
+            self.assertEqual((row.n_both, row.n_a, row.n_b), (both, n_a, n_b))
+            n = len(self.genomes)
+            contingency = [[both, n_a - both], [n_b - both, n - n_a - n_b + both]]
+            self.assertAlmostEqual(row.p_enriched,
+                                   fisher_exact(contingency, alternative='greater')[1])
+            self.assertAlmostEqual(row.jaccard, both / (n_a + n_b - both))
+
+    def test_hypergeom_tails(self):
+        from scipy.stats import hypergeom
+        rng = np.random.default_rng(1)
+        n_total = 5000
+        n_a = rng.integers(0, n_total, 2000)
+        n_b = rng.integers(0, n_total, 2000)
+        k = rng.binomial(np.minimum(n_a, n_b), rng.random(2000))
+        p_enriched, p_depleted = hypergeom_tails(k, n_total, n_a, n_b)
+        np.testing.assert_allclose(p_enriched, hypergeom.sf(k - 1, n_total, n_a, n_b),
+                                   rtol=1e-8, atol=1e-14)
+        np.testing.assert_allclose(p_depleted, hypergeom.cdf(k, n_total, n_a, n_b),
+                                   rtol=1e-8, atol=1e-14)
+
+    def test_genes_and_strata(self):
+        strata = pd.Series(np.where(np.arange(len(self.genomes)) % 3, 'p1', 'p2'))
+        table = cooccurrence(self.presence, self.genomes, genes=['f1'], strata=strata)
+        self.assertEqual(sorted(table['stratum'].unique()), ['p1', 'p2'])
+        self.assertEqual(set(table['gene_b']), {'K1', 'K2', 'K3', 'K4'})
+        row = table[(table['stratum'] == 'p2') & (table['gene_b'] == 'K2')].iloc[0]
+        genomes = self.genomes[(strata == 'p2').to_numpy()]
+        self.assertEqual((row.n_both, row.n_a, row.n_b), self.brute_force('f1', 'K2', genomes))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,86 @@
+import functools
+import sys
+
+import numpy as np
 import pandas as pd
-from pyparsing import (
-    Word, alphanums, infixNotation, opAssoc, Keyword,
-    ParserElement, ParseResults
-)
-from typing import Union, List, Any, Mapping
+from typing import TYPE_CHECKING, Union, List, Any, Mapping, Callable, Iterable, Optional, Tuple
+
+from presence_matrix import PresenceMatrix
+
+if TYPE_CHECKING:
+    from pyparsing import ParseResults
+
+# Gene data accepted by the vectorized evaluators
+GeneColumns = Union[pd.DataFrame, PresenceMatrix]
+
+
+def _column_ops(genes: GeneColumns, quantitative: bool = False):
+    """
+    Column lookup, complement, AND and OR operations for gene data.
+
+    DataFrame columns are evaluated as boolean arrays; PresenceMatrix columns stay
+    packed so that AND/OR/NOT work on 8 genomes per byte. Genes missing from the
+    data are all-absent columns.
+
+    In quantitative mode DataFrame columns are per-genome hit counts (gene copy
+    numbers): AND is the minimum (number of complete sets), OR the sum and NOT
+    is 1 where the count is zero and 0 elsewhere.
+    """
+    if quantitative:
+        if isinstance(genes, PresenceMatrix):
+            raise TypeError("Quantitative evaluation needs a DataFrame of counts, not a PresenceMatrix")
+
+        def lookup_counts(gene):
+            if gene in genes.columns:
+                return genes[gene].fillna(0).to_numpy(dtype=np.int64)
+            return np.zeros(len(genes), dtype=np.int64)
+        return (lookup_counts, lambda counts: (counts == 0).astype(np.int64),
+                np.minimum.reduce, np.add.reduce)
+
+    if isinstance(genes, PresenceMatrix):
+        return genes.column, genes.not_, np.bitwise_and.reduce, np.bitwise_or.reduce
+
+    def lookup(gene):
+        if gene in genes.columns:
+            return genes[gene].to_numpy(dtype=bool)
+        return np.zeros(len(genes), dtype=bool)
+    return lookup, np.invert, np.bitwise_and.reduce, np.bitwise_or.reduce
+
+
+@functools.lru_cache(maxsize=None)
+def _gene_expression_grammar():
+    """
+    The pyparsing grammar for gene expressions, built on first use.
+
+    pyparsing is imported, packrat enabled and the grammar built only when an
+    expression is first parsed, so scripts that never parse one do not pay for
+    them. The grammar is shared by all parsers.
+    """
+    from pyparsing import Word, alphanums, infixNotation, opAssoc, Keyword, ParserElement
+
+    # Enable performance optimization
+    ParserElement.enablePackrat()
+
+    # Define the parser
+    GENE = Word(alphanums + "_:.-")
+    AND = Keyword("AND")
+    OR = Keyword("OR")
+    NOT = Keyword("NOT")
+
+    return infixNotation(GENE,
+        [
+            (NOT, 1, opAssoc.RIGHT),
+            (AND, 2, opAssoc.LEFT),
+            (OR,  2, opAssoc.LEFT),
+        ])
+
+
+def _is_parse_results(parsed: Any) -> bool:
+    """Whether parsed is a pyparsing ParseResults, without importing pyparsing."""
+    # ParseResults can only exist if pyparsing was imported to create them
+    pyparsing = sys.modules.get('pyparsing')
+    return pyparsing is not None and isinstance(parsed, pyparsing.ParseResults)
+
 
 class BooleanExpressionParser:
     """
@@ -15,24 +92,12 @@ class BooleanExpressionParser:
     - `NOT gene1`
     - Nested expressions like `(gene1 AND gene2) OR NOT gene3`
     """
-    def __init__(self):
-        # Enable performance optimization
-        ParserElement.enablePackrat()
-
-        # Define the parser
-        self.GENE = Word(alphanums + "_:.-")
-        self.AND = Keyword("AND")
-        self.OR = Keyword("OR")
-        self.NOT = Keyword("NOT")
-
-        self.GENE_EXPRESSION = infixNotation(self.GENE,
-            [
-                (self.NOT, 1, opAssoc.RIGHT),
-                (self.AND, 2, opAssoc.LEFT),
-                (self.OR,  2, opAssoc.LEFT),
-            ])
-
-    def parse_expression(self, expression: str) -> ParseResults:
+    @property
+    def GENE_EXPRESSION(self):
+        """The pyparsing grammar, built on first use."""
+        return _gene_expression_grammar()
+
+    def parse_expression(self, expression: str) -> 'ParseResults':
         """
         Parse a boolean expression string into a structured format.
         
@@ -41,7 +106,7 @@ class BooleanExpressionParser:
         """
         return self.GENE_EXPRESSION.parseString(expression)
 
-    def evaluate(self, parsed: Union[str, List[Any], ParseResults],
+    def evaluate(self, parsed: Union[str, List[Any], 'ParseResults'],
                  gene_row: Mapping[str, bool]) -> bool:
         """Evaluate a parsed boolean expression against a gene row.
 
@@ -49,7 +114,7 @@ class BooleanExpressionParser:
         :param gene_row: A mapping of gene names to boolean values indicating presence.
         :return: True if the expression evaluates to true for the given gene row, False otherwise.
         """
-        if isinstance(parsed, ParseResults):
+        if _is_parse_results(parsed):
             return self.evaluate(parsed.as_list()[0], gene_row)
         elif isinstance(parsed, str):
             return bool(gene_row.get(parsed, False))
@@ -64,6 +129,210 @@ class BooleanExpressionParser:
                 return any(self.evaluate(p, gene_row) for p in parsed if p != 'OR')
         raise ValueError(f"Unexpected expression format: {parsed}")
 
+    def compile(self, parsed: Union[str, List[Any], 'ParseResults'],
+                quantitative: bool = False) -> Callable[[GeneColumns], np.ndarray]:
+        """Compile a parsed boolean expression into a vectorized evaluator.
+
+        The returned function takes a DataFrame with genomes as rows and genes as
+        columns, or a PresenceMatrix, and evaluates the expression over whole columns
+        at once (AND -> &, OR -> |, NOT -> ~). Genes missing from the data are treated
+        as absent in every genome, exactly as in evaluate().
+
+        :param parsed: The parsed expression (from parse_expression).
+        :param quantitative: Evaluate over a DataFrame of per-genome gene counts
+            instead (AND -> minimum, OR -> sum, NOT -> count == 0).
+        :return: A function mapping gene data to a boolean array with one entry per
+            genome, or to a packed column when given a PresenceMatrix, or to an
+            integer array in quantitative mode.
+        """
+        compiled = self._compile(parsed)
+        return lambda genes: compiled(*_column_ops(genes, quantitative))
+
+    def _compile(self, parsed: Union[str, List[Any], 'ParseResults']):
+        """Compile to a function of (lookup, complement, AND, OR) operations."""
+        if _is_parse_results(parsed):
+            return self._compile(parsed.as_list()[0])
+        elif isinstance(parsed, str):
+            gene = parsed
+            return lambda *ops: ops[0](gene)
+        elif isinstance(parsed, list):
+            if len(parsed) == 1:
+                return self._compile(parsed[0])
+            elif parsed[0] == 'NOT':
+                operand = self._compile(parsed[1])
+                return lambda *ops: ops[1](operand(*ops))
+            elif 'AND' in parsed:
+                operands = [self._compile(p) for p in parsed if p != 'AND']
+                return lambda *ops: ops[2]([op(*ops) for op in operands])
+            elif 'OR' in parsed:
+                operands = [self._compile(p) for p in parsed if p != 'OR']
+                return lambda *ops: ops[3]([op(*ops) for op in operands])
+        raise ValueError(f"Unexpected expression format: {parsed}")
+
+class ExpressionGraph:
+    """
+    A set of named boolean expressions compiled into one dependency graph.
+
+    Expressions may reference other expressions by name, in any order. Structurally
+    identical subexpressions (after flattening nested AND/OR and sorting their
+    operands) are stored once as a single node, so e.g. an OR-group of KOs shared
+    by several functions is computed only once per evaluation.
+
+    Nodes are tuples `(op, args)` where op is one of 'GENE', 'NOT', 'AND', 'OR' and
+    args is the gene name for 'GENE' nodes and a tuple of child node ids otherwise.
+    Children always have smaller ids than their parents, so evaluating nodes in id
+    order is a topological order.
+    """
+    def __init__(self, expressions: Mapping[str, str],
+                 parser: Optional[BooleanExpressionParser] = None):
+        """
+        Parse all expressions and build the graph.
+
+        :param expressions: Mapping of function names to boolean expression strings.
+        :param parser: Parser to use, a new BooleanExpressionParser by default.
+        :raises ValueError: If the expressions reference each other in a cycle.
+        """
+        self.parser = parser or BooleanExpressionParser()
+        self.expressions = dict(expressions)
+        self.parsed = {name: self.parser.parse_expression(expr).as_list()[0]
+                       for name, expr in self.expressions.items()}
+
+        self.nodes: List[Tuple[str, Any]] = []
+        self._node_ids = {}
+        self.roots = {}
+        self.n_tree_nodes = 0
+
+        for name in self.expressions:
+            self._resolve(name, [])
+
+    def _add_node(self, op: str, args: Any) -> int:
+        key = (op, args)
+        if key not in self._node_ids:
+            self._node_ids[key] = len(self.nodes)
+            self.nodes.append(key)
+        return self._node_ids[key]
+
+    def _resolve(self, name: str, stack: List[str]) -> int:
+        """Return the root node id of a function, building it if needed."""
+        if name in self.roots:
+            return self.roots[name]
+        if name in stack:
+            cycle = stack[stack.index(name):] + [name]
+            raise ValueError(f"Cyclic expression references: {' -> '.join(cycle)}")
+        node_id = self._build(self.parsed[name], stack + [name])
+        self.roots[name] = node_id
+        return node_id
+
+    def _build(self, parsed: Union[str, List[Any]], stack: List[str]) -> int:
+        """Add the nodes of a parsed (list form) expression and return its id."""
+        self.n_tree_nodes += 1
+        if isinstance(parsed, str):
+            if parsed in self.expressions:
+                return self._resolve(parsed, stack)
+            return self._add_node('GENE', parsed)
+        if len(parsed) == 1:
+            return self._build(parsed[0], stack)
+        if parsed[0] == 'NOT':
+            return self._add_node('NOT', (self._build(parsed[1], stack),))
+        for op in ('AND', 'OR'):
+            if op in parsed:
+                children = []
+                for p in parsed:
+                    if p == op:
+                        continue
+                    child = self._build(p, stack)
+                    # Flatten nested groups of the same operator
+                    child_op, child_args = self.nodes[child]
+                    children.extend(child_args if child_op == op else (child,))
+                return self._add_node(op, tuple(sorted(children)))
+        raise ValueError(f"Unexpected expression format: {parsed}")
+
+    def genes(self) -> List[str]:
+        """Names of all genes (non-function leaves) referenced by the expressions."""
+        return [args for op, args in self.nodes if op == 'GENE']
+
+    def undefined_names(self, available: Iterable[str]) -> List[str]:
+        """
+        Names referenced by the expressions that are neither functions nor available genes.
+
+        :param available: Gene names present in the data, e.g. DataFrame columns.
+        :return: Sorted list of undefined names. These evaluate to False everywhere.
+        """
+        available = set(available)
+        return sorted(g for g in self.genes() if g not in available)
+
+    def canonical_form(self, name: str, gene_label: Optional[Callable[[str], str]] = None) -> str:
+        """
+        Normalized text of a function's expression, the same for any equivalent
+        spelling: references are inlined, nested AND/OR groups flattened and
+        operands sorted.
+
+        :param name: Function name.
+        :param gene_label: Text of each gene leaf, the gene name by default. E.g.
+            adding a hash of the gene's data makes the form a cache key.
+        """
+        gene_label = gene_label or str
+        forms = {}
+
+        def form(node_id):
+            if node_id not in forms:
+                op, args = self.nodes[node_id]
+                if op == 'GENE':
+                    forms[node_id] = f'GENE({gene_label(args)})'
+                else:
+                    forms[node_id] = f"{op}({','.join(sorted(form(i) for i in args))})"
+            return forms[node_id]
+        return form(self.roots[name])
+
+    def evaluate(self, genes: GeneColumns, functions: Optional[Iterable[str]] = None,
+                 quantitative: bool = False) -> GeneColumns:
+        """
+        Evaluate the expressions over whole gene columns.
+
+        :param genes: DataFrame with genomes as rows and genes as boolean columns,
+            or a PresenceMatrix.
+        :param functions: Functions to evaluate, all by default. Only the nodes
+            they depend on are computed.
+        :param quantitative: genes is a DataFrame of per-genome gene counts; AND
+            is the minimum, OR the sum and NOT is 1 where the count is 0. Nested
+            groups are flattened as for presence, which keeps these values since
+            minimum and sum are associative.
+        :return: For a DataFrame, a DataFrame with the same index and one boolean
+            (integer if quantitative) column per function; for a PresenceMatrix, a
+            PresenceMatrix over the same genomes with one column per function.
+            Functions are in the order the expressions were given, or of functions
+            if given.
+        """
+        names = list(self.expressions) if functions is None else list(functions)
+        # Children have smaller ids than their parents, so one pass down the ids
+        # marks everything the requested roots depend on
+        needed = np.zeros(len(self.nodes), dtype=bool)
+        needed[[self.roots[name] for name in names]] = True
+        for node_id in range(len(self.nodes) - 1, -1, -1):
+            op, args = self.nodes[node_id]
+            if needed[node_id] and op != 'GENE':
+                needed[list(args)] = True
+
+        lookup, invert, and_, or_ = _column_ops(genes, quantitative)
+        values = []
+        for (op, args), is_needed in zip(self.nodes, needed):
+            if not is_needed:
+                values.append(None)
+            elif op == 'GENE':
+                values.append(lookup(args))
+            elif op == 'NOT':
+                values.append(invert(values[args[0]]))
+            elif op == 'AND':
+                values.append(and_([values[i] for i in args]))
+            else:
+                values.append(or_([values[i] for i in args]))
+
+        if isinstance(genes, PresenceMatrix):
+            bits = [values[self.roots[name]] for name in names]
+            bits = np.stack(bits) if bits else np.zeros((0, genes.bits.shape[1]), dtype=np.uint8)
+            return PresenceMatrix(genes.genomes, names, bits)
+        return pd.DataFrame({name: values[self.roots[name]] for name in names},
+                            index=genes.index)
 
 # Unit testing
 import unittest
@@ -74,6 +343,7 @@ class TestBooleanExpressions(unittest.TestCase):
 
     def test_parse_expression(self):
         # Test parsing a simple expression
+        from pyparsing import ParseResults
         parsed = self.parser.parse_expression("gene1 AND gene2 OR NOT gene3")
         self.assertIsInstance(parsed, ParseResults)
         flat_list = parsed.as_list(flatten=True)
@@ -114,5 +384,116 @@ class TestBooleanExpressions(unittest.TestCase):
             result = self.parser.evaluate(parsed, gene_row)
             self.assertEqual(result, expected, f"Failed for expression: {expr_str}")
 
+    def test_compiled_matches_evaluate(self):
+        # Every combination of four genes plus a gene missing from the table
+        genes = ['gene1', 'gene2', 'gene3', 'gene4']
+        rows = [[bool(i >> j & 1) for j in range(len(genes))] for i in range(2 ** len(genes))]
+        gene_df = pd.DataFrame(rows, columns=genes)
+
+        expressions = [
+            "gene1 AND gene2",
+            "gene1 OR gene2 OR gene3",
+            "NOT gene3",
+            "NOT NOT gene3",
+            "gene3 OR (gene2 AND NOT gene1)",
+            "gene1 AND gene3 OR NOT gene2",
+            "(gene1 OR gene2) AND (gene3 AND NOT gene4)",
+            "NOT (gene1 OR gene2)",
+            "gene1 OR gene5",
+            "gene1 AND gene5",
+            "NOT gene5",
+        ]
+        for expr_str in expressions:
+            parsed = self.parser.parse_expression(expr_str)
+            expected = gene_df.apply(lambda row: self.parser.evaluate(parsed, row), axis=1)
+            result = self.parser.compile(parsed)(gene_df)
+            self.assertEqual(result.dtype, bool)
+            self.assertEqual(result.tolist(), expected.tolist(), f"Failed for expression: {expr_str}")
+
+class TestExpressionGraph(unittest.TestCase):
+    def setUp(self):
+        genes = ['gene1', 'gene2', 'gene3', 'gene4']
+        rows = [[bool(i >> j & 1) for j in range(len(genes))] for i in range(2 ** len(genes))]
+        self.gene_df = pd.DataFrame(rows, columns=genes)
+
+    def test_shared_subexpressions(self):
+        graph = ExpressionGraph({
+            'f1': "gene1 OR gene2",
+            'f2': "(gene2 OR gene1) AND gene3",
+            'f3': "gene3 AND (gene1 OR gene2)",
+        })
+        # f2 and f3 are the same expression up to operand order
+        self.assertEqual(graph.roots['f2'], graph.roots['f3'])
+        self.assertLess(len(graph.nodes), graph.n_tree_nodes)
+
+    def test_references_and_order(self):
+        expressions = {
+            'composite': "base AND NOT gene4",
+            'base': "gene1 OR (gene2 AND gene3)",
+            'missing': "gene5 OR gene1",
+        }
+        graph = ExpressionGraph(expressions)
+        result = graph.evaluate(self.gene_df)
+        self.assertEqual(result.columns.tolist(), list(expressions))
+
+        parser = BooleanExpressionParser()
+        expected = self.gene_df.copy()
+        for name in ['base', 'composite', 'missing']:
+            expected[name] = parser.compile(parser.parse_expression(expressions[name]))(expected)
+        for name in expressions:
+            self.assertEqual(result[name].tolist(), expected[name].tolist(), name)
+        self.assertEqual(graph.undefined_names(self.gene_df.columns), ['gene5'])
+
+        # Packed evaluation gives the same answers
+        packed = graph.evaluate(PresenceMatrix.from_dataframe(self.gene_df))
+        pd.testing.assert_frame_equal(packed.to_dataframe(index_name=None),
+                                      result.set_axis(result.index.astype(str)))
+        parser_packed = parser.compile(parser.parse_expression("NOT gene1 AND NOT gene5"))
+        pm = PresenceMatrix.from_dataframe(self.gene_df)
+        self.assertEqual(pm.unpack(parser_packed(pm)).tolist(),
+                         (~self.gene_df['gene1']).tolist())
+
+    def test_canonical_form_and_subset(self):
+        graph = ExpressionGraph({
+            'f1': "gene1 OR (gene2 OR gene3)",
+            'f2': "gene4 AND f1",
+        })
+        other = ExpressionGraph({'g': "(gene1 OR gene3 OR gene2) AND gene4"})
+        self.assertEqual(graph.canonical_form('f2'), other.canonical_form('g'))
+        self.assertEqual(graph.canonical_form('f1', lambda g: g.upper()),
+                         'OR(GENE(GENE1),GENE(GENE2),GENE(GENE3))')
+
+        subset = graph.evaluate(self.gene_df, functions=['f2'])
+        self.assertEqual(subset.columns.tolist(), ['f2'])
+        self.assertEqual(subset['f2'].tolist(), graph.evaluate(self.gene_df)['f2'].tolist())
+
+    def test_quantitative(self):
+        counts = pd.DataFrame({'gene1': [0, 1, 3, 2], 'gene2': [2, 0, 1, 2],
+                               'gene3': [1, 1, 0, np.nan]})
+        graph = ExpressionGraph({
+            'complex': "gene1 AND gene2",
+            'either': "gene1 OR gene2 OR gene5",
+            'nested': "(gene1 AND gene2) OR NOT gene3",
+        })
+        result = graph.evaluate(counts, quantitative=True)
+        self.assertEqual(result['complex'].tolist(), [0, 0, 1, 2])
+        self.assertEqual(result['either'].tolist(), [2, 1, 4, 4])
+        self.assertEqual(result['nested'].tolist(), [0, 0, 2, 3])
+        parser = BooleanExpressionParser()
+        compiled = parser.compile(parser.parse_expression("(gene1 AND gene2) OR NOT gene3"),
+                                  quantitative=True)
+        self.assertEqual(compiled(counts).tolist(), result['nested'].tolist())
+
+        # Presence is whether the count is non-zero
+        presence = graph.evaluate(counts.fillna(0) > 0)
+        pd.testing.assert_frame_equal(presence, result > 0)
+
+    def test_cycle_detection(self):
+        with self.assertRaises(ValueError):
+            ExpressionGraph({'a': "gene1 AND b", 'b': "gene2 OR c", 'c': "NOT a"})
+        with self.assertRaises(ValueError):
+            ExpressionGraph({'a': "a OR gene1"})
+
+
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
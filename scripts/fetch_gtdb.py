@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+"""Download GTDB release files in parallel, with resume and checksum verification.
+
+Files are downloaded into a local mirror directory laid out by release, so repeat
+runs (and other pipelines using the same release) do not download them again:
+
+    {cache_dir}/release{version}/{filename}
+
+Interrupted downloads are kept as {filename}.part and resumed with HTTP range
+requests. Each file is checked against the MD5 sums GTDB publishes with the
+release before it is moved into the mirror and linked (or copied) into the
+output directory. Gzipped files can optionally be decompressed while they are
+being downloaded.
+"""
+
+import argparse
+import hashlib
+import os
+import profiling
+import shutil
+import urllib.error
+import urllib.request
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from profiling import add_profile_arguments
+from typing import Dict, List, Optional
+
+# Name of the checksum file published in each GTDB release directory
+CHECKSUM_FNAME = 'MD5SUM.txt'
+
+DEFAULT_CACHE_DIR = path.join(path.expanduser('~'), '.cache', 'pi_genes', 'gtdb')
+BLOCK_SIZE = 1 << 20
+
+
+def release_url(base_url: str, fname: str) -> str:
+    return base_url.rstrip('/') + '/' + fname
+
+
+def parse_checksums(text: str) -> Dict[str, str]:
+    """Parse md5sum-style lines ("<md5>  ./path/to/file") into a basename -> md5 dict."""
+    checksums = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            checksums[path.basename(parts[1].lstrip('*'))] = parts[0].lower()
+    return checksums
+
+
+def fetch_checksums(base_url: str, checksum_fname: str = CHECKSUM_FNAME,
+                    timeout: float = 60) -> Optional[Dict[str, str]]:
+    """Published checksums of a release, or None if the release has no checksum file."""
+    try:
+        with urllib.request.urlopen(release_url(base_url, checksum_fname), timeout=timeout) as resp:
+            return parse_checksums(resp.read().decode())
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+
+
+def file_md5(fname: str) -> str:
+    digest = hashlib.md5()
+    with open(fname, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def decompressed_name(fname: str) -> str:
+    return fname[:-len('.gz')] if fname.endswith('.gz') else fname
+
+
+def gunzip_file(src: str, dest: str) -> None:
+    """Decompress a gzip file in blocks."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(src, 'rb') as fin, open(dest + '.tmp', 'wb') as fout:
+        for block in iter(lambda: fin.read(BLOCK_SIZE), b''):
+            fout.write(decompressor.decompress(block))
+        fout.write(decompressor.flush())
+    os.replace(dest + '.tmp', dest)
+
+
+def download(url: str, dest: str, expected_md5: Optional[str] = None,
+             decompress_to: Optional[str] = None, timeout: float = 60) -> str:
+    """Download url to dest, resuming from dest + '.part' if present.
+
+    Args:
+        url (str): file URL.
+        dest (str): final path of the downloaded file.
+        expected_md5 (str): if given, the download must match this MD5 sum.
+        decompress_to (str): if given, also write the gunzipped contents here,
+            decompressing while downloading when the download starts from scratch.
+        timeout (float): socket timeout in seconds.
+
+    Returns:
+        str: the MD5 sum of the downloaded file.
+
+    Raises:
+        ValueError: if the download does not match expected_md5. The partial
+            file is removed so the next attempt starts over.
+    """
+    part = dest + '.part'
+    offset = path.getsize(part) if path.exists(part) else 0
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', f'bytes={offset}-')
+
+    digest = hashlib.md5()
+    with urllib.request.urlopen(request, timeout=timeout) as resp:
+        if offset and resp.status == 206:
+            # Resuming: hash what we already have
+            with open(part, 'rb') as fh:
+                for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+                    digest.update(block)
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+
+        # Decompress on the fly only if we see the stream from the start
+        decompressor = None
+        if decompress_to and offset == 0:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            decompressed = open(decompress_to + '.tmp', 'wb')
+        try:
+            with open(part, mode) as fh:
+                for block in iter(lambda: resp.read(BLOCK_SIZE), b''):
+                    fh.write(block)
+                    digest.update(block)
+                    if decompressor is not None:
+                        decompressed.write(decompressor.decompress(block))
+            if decompressor is not None:
+                decompressed.write(decompressor.flush())
+        finally:
+            if decompressor is not None:
+                decompressed.close()
+
+    md5 = digest.hexdigest()
+    if expected_md5 and md5 != expected_md5.lower():
+        os.remove(part)
+        if decompressor is not None:
+            os.remove(decompress_to + '.tmp')
+        raise ValueError(f'Checksum mismatch for {url}: expected {expected_md5}, got {md5}')
+
+    os.replace(part, dest)
+    if decompress_to:
+        if decompressor is not None:
+            os.replace(decompress_to + '.tmp', decompress_to)
+        else:
+            gunzip_file(dest, decompress_to)
+    return md5
+
+
+def link_or_copy(src: str, dest: str) -> None:
+    """Hard-link src to dest, copying if linking is not possible."""
+    if path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def fetch_file(base_url: str, fname: str, mirror_dir: str, outdir: str,
+               checksums: Optional[Dict[str, str]], decompress: bool = False,
+               timeout: float = 60) -> str:
+    """Fetch one release file into the mirror (if needed) and link it into outdir.
+
+    Returns:
+        str: path of the file in outdir (the decompressed file if decompress).
+    """
+    expected_md5 = checksums.get(fname) if checksums else None
+    mirrored = path.join(mirror_dir, fname)
+    decompress = decompress and fname.endswith('.gz')
+    mirrored_plain = decompressed_name(mirrored) if decompress else None
+
+    with profiling.stage(f'fetch {fname}') as st:
+        cached = path.exists(mirrored) and (expected_md5 is None or file_md5(mirrored) == expected_md5)
+        if cached:
+            print(f'Using mirrored {mirrored}')
+            if decompress and not path.exists(mirrored_plain):
+                gunzip_file(mirrored, mirrored_plain)
+        else:
+            print(f'Downloading {fname}')
+            download(release_url(base_url, fname), mirrored, expected_md5,
+                     decompress_to=mirrored_plain, timeout=timeout)
+            print(f'Downloaded {fname}' + (' (checksum OK)' if expected_md5 else ''))
+        st.info.update(cached=cached, bytes=path.getsize(mirrored))
+
+    src = mirrored_plain if decompress else mirrored
+    dest = path.join(outdir, path.basename(src))
+    link_or_copy(src, dest)
+    return dest
+
+
+def fetch_release(base_url: str, filenames: List[str], outdir: str, version: str,
+                  cache_dir: str = DEFAULT_CACHE_DIR, decompress: bool = False,
+                  checksum_fname: str = CHECKSUM_FNAME, require_checksums: bool = False,
+                  n_workers: int = 4, timeout: float = 60) -> List[str]:
+    """Fetch several files of one GTDB release concurrently.
+
+    Args:
+        base_url (str): URL of the release directory.
+        filenames (list): file names within the release directory.
+        outdir (str): directory to place the files in.
+        version (str): release version, names the mirror subdirectory.
+        cache_dir (str): root of the local mirror.
+        decompress (bool): also provide gunzipped copies of .gz files.
+        checksum_fname (str): name of the release's checksum file.
+        require_checksums (bool): fail if a file has no published checksum.
+        n_workers (int): number of concurrent downloads.
+        timeout (float): socket timeout in seconds.
+
+    Returns:
+        list: paths of the fetched files in outdir, in the order of filenames.
+    """
+    mirror_dir = path.join(cache_dir, f'release{version}')
+    os.makedirs(mirror_dir, exist_ok=True)
+    os.makedirs(outdir, exist_ok=True)
+
+    with profiling.stage('fetch checksums'):
+        checksums = fetch_checksums(base_url, checksum_fname, timeout)
+    missing = [f for f in filenames if not checksums or f not in checksums]
+    if missing:
+        if require_checksums:
+            raise ValueError(f'No published checksums for: {missing}')
+        print(f'Warning: no published checksums for {missing}; these are not verified')
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(fetch_file, base_url, f, mirror_dir, outdir, checksums,
+                               decompress, timeout) for f in filenames]
+        return [f.result() for f in futures]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch GTDB release files.')
+    parser.add_argument('filenames', nargs='+', help='File names within the release directory.')
+    parser.add_argument('--base_url', type=str, required=True,
+                        help='URL of the GTDB release directory.')
+    parser.add_argument('--version', type=str, required=True,
+                        help='GTDB release version, e.g. 214.')
+    parser.add_argument('--outdir', type=str, required=True,
+                        help='Directory to place the fetched files in.')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help='Local mirror of downloaded releases.')
+    parser.add_argument('--decompress', action='store_true', default=False,
+                        help='Also write gunzipped copies of .gz files.')
+    parser.add_argument('--checksums', type=str, default=CHECKSUM_FNAME,
+                        help='Name of the checksum file in the release directory.')
+    parser.add_argument('--require_checksums', action='store_true', default=False,
+                        help='Fail if any file has no published checksum.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of concurrent downloads.')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    profiling.start('fetch_gtdb', args.profile_out, args.cprofile_out)
+
+    with profiling.stage('fetch release', files=len(args.filenames)):
+        fetched = fetch_release(args.base_url, args.filenames, args.outdir, args.version,
+                                cache_dir=args.cache_dir, decompress=args.decompress,
+                                checksum_fname=args.checksums,
+                                require_checksums=args.require_checksums, n_workers=args.workers)
+    for fname in fetched:
+        print(f'Fetched {fname}')
+    profiling.finish()
+
+
+# Unit testing
+import unittest
+
+class TestFetchGTDB(unittest.TestCase):
+    """Fetches from a local HTTP server that supports range requests."""
+    def setUp(self):
+        import gzip
+        import tempfile
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        self.served = {
+            'bac120_metadata_r0.tsv.gz': gzip.compress(b'accession\tgtdb_taxonomy\n' * 50000),
+            'bac120_r0.tree': b'((A:1,B:1):1,C:2);' * 1000,
+        }
+        self.served[CHECKSUM_FNAME] = ''.join(
+            f'{hashlib.md5(data).hexdigest()}  ./{name}\n'
+            for name, data in self.served.items()).encode()
+        self.requests = []
+
+        served, requests = self.served, self.requests
+
+        class RangeHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.rsplit('/', 1)[-1]
+                requests.append((name, self.headers.get('Range')))
+                if name not in served:
+                    self.send_error(404)
+                    return
+                data = served[name]
+                status = 200
+                if self.headers.get('Range'):
+                    start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                    data, status = data[start:], 206
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/release0/'
+        self.cache_dir = path.join(root, 'mirror')
+        self.outdir = path.join(root, 'out')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def fetch(self, **kwargs):
+        return fetch_release(self.base_url, ['bac120_metadata_r0.tsv.gz', 'bac120_r0.tree'],
+                             self.outdir, '0', cache_dir=self.cache_dir, **kwargs)
+
+    def test_fetch_and_mirror(self):
+        import gzip
+        fetched = self.fetch(decompress=True)
+        with open(fetched[0], 'rb') as fh:
+            self.assertEqual(fh.read(), gzip.decompress(self.served['bac120_metadata_r0.tsv.gz']))
+        with open(fetched[1], 'rb') as fh:
+            self.assertEqual(fh.read(), self.served['bac120_r0.tree'])
+
+        # A second fetch is served from the mirror
+        n_requests = len(self.requests)
+        self.fetch()
+        self.assertEqual([r[0] for r in self.requests[n_requests:]], [CHECKSUM_FNAME])
+        self.assertTrue(path.exists(path.join(self.outdir, 'bac120_metadata_r0.tsv.gz')))
+
+    def test_resume(self):
+        import gzip
+        mirror_dir = path.join(self.cache_dir, 'release0')
+        os.makedirs(mirror_dir)
+        data = self.served['bac120_metadata_r0.tsv.gz']
+        with open(path.join(mirror_dir, 'bac120_metadata_r0.tsv.gz.part'), 'wb') as fh:
+            fh.write(data[:1000])
+
+        fetched = self.fetch(decompress=True)
+        self.assertIn(('bac120_metadata_r0.tsv.gz', 'bytes=1000-'), self.requests)
+        with open(fetched[0], 'rb') as fh:
+            self.assertEqual(fh.read(), gzip.decompress(data))
+
+    def test_checksum_mismatch(self):
+        self.served[CHECKSUM_FNAME] = self.served[CHECKSUM_FNAME].replace(
+            hashlib.md5(self.served['bac120_r0.tree']).hexdigest().encode(), b'0' * 32)
+        with self.assertRaises(ValueError):
+            self.fetch()
+        self.assertFalse(path.exists(path.join(self.cache_dir, 'release0', 'bac120_r0.tree')))
+        self.assertFalse(path.exists(path.join(self.cache_dir, 'release0', 'bac120_r0.tree.part')))
+
+
+if __name__ == '__main__':
+    main()
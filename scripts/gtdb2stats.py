@@ -4,61 +4,155 @@
 
 import pandas as pd
 import argparse
+import profiling
 
 from os import path
-
-# Full names of the phylogenetic levels
-FULL_PHYLO_NAMES_DICT = {
-    'd': 'domain', 'p': 'phylum', 'c': 'class', 'o': 'order', 'f': 'family', 'g': 'genus', 's': 'species'
-}
-PHYLO_COLNAMES = 'domain,phylum,class,order,family,genus,species'.split(',')
-
-# Name of the column in the annotree results that contains the concatenated phylogeny
-TAXONOMY_COLNAME = 'gtdb_taxonomy'
-
-def extract_phylogeny(row):
-    # phylogeny is given as a string with the following example
-    # d__Archaea;p__Thermoproteota;c__Nitrososphaeria;o__Nitrososphaerales;f__Nitrosopumilaceae;g__Nitrosopumilus;s__Nitrosopumilus sp905612295
-    # extract a dictionary mapping levels to values
-    phylo = {}
-    for part in row[TAXONOMY_COLNAME].split(';'):
-        key, value = part.split('__')
-        # Use the full phylogeny names
-        phylo[FULL_PHYLO_NAMES_DICT[key]] = value
-    return phylo
+from gtdb_metadata import (
+    DEFAULT_CHUNKSIZE, PHYLO_COLNAMES, REPRESENTATIVE_COLNAME, TAXONOMY_COLNAME,
+    add_cache_arguments, iter_metadata_chunks, load_gtdb_metadata, parse_taxonomy,
+    resolve_metadata_path
+)
+from profiling import add_profile_arguments
+from table_io import add_format_argument, write_table
 
 
 def add_phylogeny_columns(df):
-    # apply function to each row in the dataframe
-    phylo_df = df.apply(extract_phylogeny, axis=1, result_type='expand')
+    phylo_df = parse_taxonomy(df[TAXONOMY_COLNAME])
     return pd.concat([df, phylo_df], axis=1)
 
-def metadata_phylogeny_counts(metadata_df):
-    all_counts = []
 
-    my_df = add_phylogeny_columns(metadata_df)
+def count_phylogeny_levels(phylo_df, count_columns):
+    """Count genomes by name at every phylogenetic level in one grouped pass.
 
-    # for each column in PHYLO_COLNAMES, we want counts of values by name
-    cts_by_phylo = dict(phylogenetic_level=[], domain=[], name=[], count=[])
-    for colname in PHYLO_COLNAMES:
-        my_cts = my_df.groupby('domain')[colname].value_counts().reset_index()
-        for _, row in my_cts.iterrows():
-            cts_by_phylo['phylogenetic_level'].append(colname)
-            cts_by_phylo['domain'].append(row['domain'])
-            cts_by_phylo['name'].append(row[colname])
-            cts_by_phylo['count'].append(row['count'])
+    Args:
+        phylo_df (pd.DataFrame): one categorical column per level in PHYLO_COLNAMES
+            plus the columns in count_columns.
+        count_columns (dict): output column name -> (input column, aggregation),
+            as for DataFrame.groupby().agg().
 
-    # convert to a dataframe
-    cts_by_phylo_df = pd.DataFrame(cts_by_phylo)
+    Returns:
+        pd.DataFrame: long format counts with columns phylogenetic_level, domain,
+            name and the count columns; sorted by level, domain, descending count
+            and name as groupby().value_counts() orders them.
+    """
+    # Counts per full lineage; every level is a sum over these lineages
+    lineage_counts = phylo_df.groupby(PHYLO_COLNAMES, observed=True).agg(**count_columns)
+    lineage_counts = lineage_counts.reset_index()
+    sort_column = next(iter(count_columns))
 
-    # convert to long format, rename index to 'name' and variable to 'phylogenetic_level'
-    #cts_by_phylo_df = pd.melt(cts_by_phylo_df, id_vars='index', value_vars=PHYLO_COLNAMES,
-    #                            var_name='phylogenetic_level', value_name='count')
-    #cts_by_phylo_df = cts_by_phylo_df.rename(columns={'index': 'name'})
+    level_counts = []
+    for colname in PHYLO_COLNAMES:
+        keys = ['domain'] if colname == 'domain' else ['domain', colname]
+        cts = lineage_counts.groupby(keys, observed=True)[list(count_columns)].sum().reset_index()
+        cts['name'] = cts[colname]
+        cts['domain'] = cts['domain'].astype(str)
+        cts['name'] = cts['name'].astype(str)
+        cts = cts.sort_values(['domain', sort_column, 'name'], ascending=[True, False, True],
+                              kind='mergesort')
+        cts.insert(0, 'phylogenetic_level', colname)
+        level_counts.append(cts)
+
+    cts_by_phylo_df = pd.concat(level_counts, ignore_index=True)
+    return cts_by_phylo_df[['phylogenetic_level', 'domain', 'name'] + list(count_columns)]
+
+
+def metadata_phylogeny_counts(metadata_df, count_representatives=False):
+    """Count genomes at each phylogenetic level.
+
+    Args:
+        metadata_df (pd.DataFrame): GTDB metadata with a gtdb_taxonomy column
+            or with the taxonomy already split into PHYLO_COLNAMES.
+        count_representatives (bool): also count representative genomes only,
+            as an additional 'representative_count' column.
+
+    Returns:
+        pd.DataFrame: counts with columns phylogenetic_level, domain, name, count.
+    """
+    if all(c in metadata_df.columns for c in PHYLO_COLNAMES):
+        # Already split, e.g. by load_gtdb_metadata()
+        phylo_df = metadata_df[PHYLO_COLNAMES].copy()
+    else:
+        phylo_df = parse_taxonomy(metadata_df[TAXONOMY_COLNAME])
+    phylo_df['genome'] = 1
+    count_columns = dict(count=('genome', 'sum'))
+    if count_representatives:
+        phylo_df['representative'] = (metadata_df['gtdb_representative'] == 't').astype(int)
+        count_columns['representative_count'] = ('representative', 'sum')
+    return count_phylogeny_levels(phylo_df, count_columns)
+
+
+def stream_phylogeny_counts(fname, representatives_only=False, count_representatives=False,
+                            chunksize=DEFAULT_CHUNKSIZE, sep='\t'):
+    """Count genomes at each phylogenetic level while streaming a metadata file.
+
+    Only counts per distinct taxonomy string are kept between chunks, so memory
+    does not grow with the number of genomes.
+
+    Args:
+        fname (str): GTDB metadata file, plain or gzip-compressed.
+        representatives_only (bool): count representative genomes only.
+        count_representatives (bool): add a 'representative_count' column.
+        chunksize (int): rows parsed at a time.
+        sep (str): field separator of the metadata file.
+
+    Returns:
+        pd.DataFrame: as metadata_phylogeny_counts().
+    """
+    taxonomy_counts = None
+    columns = [TAXONOMY_COLNAME, REPRESENTATIVE_COLNAME]
+    for chunk in iter_metadata_chunks(fname, columns, chunksize, sep, representatives_only):
+        chunk = chunk.assign(genome=1,
+                             representative=(chunk[REPRESENTATIVE_COLNAME] == 't').astype(int))
+        chunk_counts = chunk.groupby(TAXONOMY_COLNAME)[['genome', 'representative']].sum()
+        if taxonomy_counts is None:
+            taxonomy_counts = chunk_counts
+        else:
+            taxonomy_counts = taxonomy_counts.add(chunk_counts, fill_value=0).astype(int)
+
+    phylo_df = parse_taxonomy(pd.Series(taxonomy_counts.index, dtype=object))
+    phylo_df['genome'] = taxonomy_counts['genome'].to_numpy()
+    count_columns = dict(count=('genome', 'sum'))
+    if count_representatives:
+        phylo_df['representative'] = taxonomy_counts['representative'].to_numpy()
+        count_columns['representative_count'] = ('representative', 'sum')
+    return count_phylogeny_levels(phylo_df, count_columns)
+
+
+def phylogeny_counts(metadata_fname, representatives_only=False, count_representatives=False,
+                     stream=False, chunksize=DEFAULT_CHUNKSIZE, sep='\t', cache_dir=None,
+                     use_cache=True):
+    """Count genomes at each phylogenetic level of one GTDB metadata file.
+
+    Args:
+        metadata_fname (str): GTDB metadata file, plain or gzip-compressed.
+        representatives_only (bool): count representative genomes only.
+        count_representatives (bool): add a 'representative_count' column.
+        stream (bool): count while streaming the file (see stream_phylogeny_counts)
+            instead of loading and caching the metadata table.
+        chunksize (int): rows parsed at a time.
+        sep (str): field separator of the metadata file.
+        cache_dir (str): directory for cached metadata tables.
+        use_cache (bool): read from and write to the metadata cache.
+
+    Returns:
+        pd.DataFrame: as metadata_phylogeny_counts().
+    """
+    fname = path.basename(metadata_fname)
+    if stream:
+        with profiling.stage('stream phylogeny counts', file=fname) as st:
+            counts = stream_phylogeny_counts(metadata_fname, representatives_only,
+                                             count_representatives, chunksize=chunksize, sep=sep)
+            st.info['taxa'] = len(counts)
+        return counts
+
+    with profiling.stage('load metadata', file=fname) as st:
+        metadata_df = load_gtdb_metadata(
+            metadata_fname, sep=sep, cache_dir=cache_dir, use_cache=use_cache,
+            chunksize=chunksize, representatives_only=representatives_only)
+        st.rows = len(metadata_df)
+    with profiling.stage('count phylogeny levels', rows=len(metadata_df), file=fname):
+        return metadata_phylogeny_counts(metadata_df, count_representatives)
 
-    # Drop rows with NaN values
-    #cts_by_phylo_df = cts_by_phylo_df.dropna()
-    return cts_by_phylo_df
 
 def main():
     parser = argparse.ArgumentParser(description='Calculate phylogenetic summary statistics from a manifest file')
@@ -68,26 +162,42 @@ def main():
     parser.add_argument('-r', '--representatives_only', action='store_true',
                         help='Limit to representative genomes only',
                         default=False)
+    parser.add_argument('--with_representatives', action='store_true', default=False,
+                        help='Count all genomes and, in an extra representative_count column, '
+                             'representative genomes only')
     parser.add_argument('--sep', type=str, help='Default separator is a tab', default='\t')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Count while streaming the metadata files instead of loading '
+                             '(and caching) the metadata table')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help='Number of metadata rows parsed at a time')
+    add_format_argument(parser)
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
+    profiling.start('gtdb2stats', args.profile_out, args.cprofile_out)
 
-    print(f'Reading bacterial metadata from {args.bacterial_metadata}')
-    print(f'Reading archaeal metadata from {args.archaeal_metadata}')
-    bacterial_df = pd.read_csv(args.bacterial_metadata, sep=args.sep)
-    archaeal_df = pd.read_csv(args.archaeal_metadata, sep=args.sep)
+    if args.representatives_only and args.with_representatives:
+        parser.error('--representatives_only and --with_representatives are mutually exclusive')
 
-    if args.representatives_only:
-        bacterial_df = bacterial_df[bacterial_df['gtdb_representative'] == 't']
-        archaeal_df = archaeal_df[archaeal_df['gtdb_representative'] == 't']
-
-    bacterial_counts = metadata_phylogeny_counts(bacterial_df)
-    archaeal_counts = metadata_phylogeny_counts(archaeal_df)
+    all_counts = []
+    for metadata_fname in (args.bacterial_metadata, args.archaeal_metadata):
+        metadata_fname = resolve_metadata_path(metadata_fname)
+        print(f'Reading metadata from {metadata_fname}')
+        counts = phylogeny_counts(
+            metadata_fname, args.representatives_only, args.with_representatives,
+            stream=args.stream, chunksize=args.chunksize, sep=args.sep,
+            cache_dir=args.cache_dir, use_cache=not args.no_cache)
+        all_counts.append(counts)
+    bacterial_counts, archaeal_counts = all_counts
 
     all_counts_df = pd.concat([bacterial_counts, archaeal_counts], axis=0)
 
     print(f'Writing summary statistics to {args.output}')
-    all_counts_df.to_csv(args.output, index=False)
+    with profiling.stage('write', rows=len(all_counts_df)):
+        write_table(all_counts_df, args.output, args.table_format, index=False)
+    profiling.finish()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,282 @@
+"""Shared loader for GTDB metadata tables.
+
+The GTDB metadata TSVs have ~110 columns and hundreds of thousands of rows, but
+the pipeline only needs the accession, the representative flag and the taxonomy.
+load_gtdb_metadata() reads just those columns, splits the taxonomy into one
+categorical column per level, and caches the result in a binary (pickle) file
+keyed on the hash of the source file and the GTDB release, so that later runs
+skip the TSV parse entirely.
+
+Files are read in bounded-size chunks, directly from .tsv.gz if compressed, and
+filtered (e.g. to representatives) chunk by chunk, so peak memory depends on the
+chunk size and the rows kept rather than on the size of the file.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+import profiling
+
+from os import path
+from typing import Iterator, List, Optional, Sequence
+
+# Full names of the phylogenetic levels
+FULL_PHYLO_NAMES_DICT = {
+    'd': 'domain', 'p': 'phylum', 'c': 'class', 'o': 'order', 'f': 'family', 'g': 'genus', 's': 'species'
+}
+PHYLO_COLNAMES = 'domain,phylum,class,order,family,genus,species'.split(',')
+
+# Name of the column in the GTDB metadata that contains the concatenated phylogeny
+TAXONOMY_COLNAME = 'gtdb_taxonomy'
+
+# Columns loaded by default in addition to the taxonomy
+REPRESENTATIVE_COLNAME = 'gtdb_representative'
+DEFAULT_COLUMNS = ('accession', REPRESENTATIVE_COLNAME)
+
+# Rows parsed at a time when streaming metadata files
+DEFAULT_CHUNKSIZE = 100_000
+
+# Release number in GTDB file names, e.g. bac120_metadata_r214.tsv
+RELEASE_RE = re.compile(r'_r(\d+(?:\.\d+)?)')
+
+# Bump when the cached table layout changes
+CACHE_VERSION = 2
+CACHE_INDEX_FNAME = 'file_hashes.json'
+
+
+def parse_taxonomy(taxonomy: pd.Series) -> pd.DataFrame:
+    """Split GTDB taxonomy strings into one categorical column per level.
+
+    Taxonomy strings look like
+    d__Archaea;p__Thermoproteota;c__Nitrososphaeria;o__Nitrososphaerales;f__Nitrosopumilaceae;g__Nitrosopumilus;s__Nitrosopumilus sp905612295
+    Many genomes share a taxonomy string, so each distinct string is split once.
+    Categories are sorted so that grouping on them orders taxa by name.
+
+    Args:
+        taxonomy (pd.Series): GTDB taxonomy strings.
+
+    Returns:
+        pd.DataFrame: one categorical column per level, named by the full level
+            names, with the same index as taxonomy.
+    """
+    codes, uniques = pd.factorize(taxonomy)
+    parts = pd.Series(uniques, dtype=object).str.split(';', expand=True)
+
+    levels = {}
+    for i in parts.columns:
+        prefixes = parts[i].str[:3].unique()
+        if len(prefixes) != 1 or not prefixes[0].endswith('__'):
+            raise ValueError(f'Unexpected taxonomy prefixes at position {i}: {prefixes}')
+        level = FULL_PHYLO_NAMES_DICT[prefixes[0][0]]
+        level_codes, level_names = pd.factorize(parts[i].str[3:], sort=True)
+        levels[level] = pd.Categorical.from_codes(level_codes[codes], categories=level_names)
+    return pd.DataFrame(levels, index=taxonomy.index)
+
+
+def infer_release(fname: str) -> Optional[str]:
+    """GTDB release from a metadata file name, or None if it does not contain one."""
+    match = RELEASE_RE.search(path.basename(fname))
+    return match.group(1) if match else None
+
+
+def _read_hash_index(index_fname: str) -> dict:
+    if not path.exists(index_fname):
+        return {}
+    try:
+        with open(index_fname) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        # An unreadable index only costs re-hashing
+        return {}
+
+
+def file_sha256s(fnames: Sequence[str], cache_dir: Optional[str] = None) -> List[str]:
+    """SHA-256 of the contents of each file.
+
+    If cache_dir is given, hashes are remembered there by path, size and
+    modification time so that unchanged multi-GB files are not re-read. The
+    index is read once per call and, if any file was hashed, written once by
+    atomic rename, so concurrent runs sharing the directory never see a partial
+    index.
+    """
+    index_fname = path.join(cache_dir, CACHE_INDEX_FNAME) if cache_dir else None
+    index = _read_hash_index(index_fname) if index_fname else {}
+
+    hashes = []
+    updated = {}
+    for fname in fnames:
+        stat = os.stat(fname)
+        key = path.abspath(fname)
+        entry = index.get(key)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            hashes.append(entry['sha256'])
+            continue
+
+        digest = hashlib.sha256()
+        with open(fname, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(block)
+        hashes.append(digest.hexdigest())
+        updated[key] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=hashes[-1])
+
+    if index_fname and updated:
+        # Merge into the current index, which another run may have extended meanwhile
+        index = _read_hash_index(index_fname)
+        index.update(updated)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(index, fh, indent=1)
+            os.replace(tmp_fname, index_fname)
+        except BaseException:
+            if path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+    return hashes
+
+
+def file_sha256(fname: str, cache_dir: Optional[str] = None) -> str:
+    """SHA-256 of a file's contents, remembered in cache_dir as in file_sha256s()."""
+    return file_sha256s([fname], cache_dir)[0]
+
+
+def default_cache_dir(fname: str) -> str:
+    """Cache directory used when none is given: a 'cache' directory next to the file."""
+    return path.join(path.dirname(path.abspath(fname)), 'cache')
+
+
+def resolve_metadata_path(fname: str) -> str:
+    """Path of a metadata file, accepting either the .tsv or the compressed .tsv.gz name."""
+    if path.exists(fname):
+        return fname
+    alternative = fname[:-len('.gz')] if fname.endswith('.gz') else fname + '.gz'
+    if path.exists(alternative):
+        return alternative
+    raise FileNotFoundError(fname)
+
+
+def iter_metadata_chunks(fname: str, columns: Sequence[str], chunksize: int = DEFAULT_CHUNKSIZE,
+                         sep: str = '\t', representatives_only: bool = False
+                         ) -> Iterator[pd.DataFrame]:
+    """Stream selected columns of a GTDB metadata file in chunks of at most chunksize rows.
+
+    Args:
+        fname (str): GTDB metadata file, plain or gzip-compressed.
+        columns (list): columns to read.
+        chunksize (int): maximum number of rows per chunk.
+        sep (str): field separator of the metadata file.
+        representatives_only (bool): drop non-representative genomes from each chunk.
+
+    Yields:
+        pd.DataFrame: string columns of the rows in each chunk.
+    """
+    columns = list(columns)
+    usecols = columns
+    if representatives_only and REPRESENTATIVE_COLNAME not in usecols:
+        usecols = usecols + [REPRESENTATIVE_COLNAME]
+
+    with pd.read_csv(fname, sep=sep, usecols=usecols, dtype=str, chunksize=chunksize,
+                     compression='infer') as reader:
+        for chunk in reader:
+            if representatives_only:
+                chunk = chunk[chunk[REPRESENTATIVE_COLNAME] == 't']
+            yield chunk[columns]
+
+
+def load_gtdb_metadata(fname: str, columns: Sequence[str] = DEFAULT_COLUMNS,
+                       release: Optional[str] = None, cache_dir: Optional[str] = None,
+                       use_cache: bool = True, sep: str = '\t',
+                       representatives_only: bool = False,
+                       chunksize: int = DEFAULT_CHUNKSIZE) -> pd.DataFrame:
+    """Load selected columns of a GTDB metadata file with the taxonomy split into levels.
+
+    Args:
+        fname (str): GTDB metadata file, e.g. bac120_metadata_r214.tsv.gz.
+            The .tsv and .tsv.gz names are interchangeable.
+        columns (list): metadata columns to keep besides the taxonomy levels.
+        release (str): GTDB release, used in the cache key. Inferred from the file
+            name by default.
+        cache_dir (str): directory for cached tables. Defaults to default_cache_dir().
+        use_cache (bool): read from and write to the cache.
+        sep (str): field separator of the metadata file.
+        representatives_only (bool): keep only GTDB representative genomes.
+        chunksize (int): rows parsed at a time.
+
+    Returns:
+        pd.DataFrame: the requested columns followed by one categorical column
+            per level in PHYLO_COLNAMES.
+    """
+    fname = resolve_metadata_path(fname)
+    columns = list(columns)
+    release = release or infer_release(fname) or 'unknown'
+
+    cache_fname = None
+    if use_cache:
+        cache_dir = cache_dir or default_cache_dir(fname)
+        os.makedirs(cache_dir, exist_ok=True)
+        key = hashlib.sha256(json.dumps(dict(
+            sha256=file_sha256(fname, cache_dir), release=release, columns=columns,
+            representatives_only=representatives_only, sep=sep,
+            version=CACHE_VERSION)).encode()).hexdigest()[:16]
+        base = path.basename(fname).split('.')[0]
+        cache_fname = path.join(cache_dir, f'{base}.{key}.pkl')
+        if path.exists(cache_fname):
+            print(f'Loading cached metadata from {cache_fname}')
+            with profiling.stage('read cached metadata') as st:
+                metadata_df = pd.read_pickle(cache_fname)
+                st.rows = len(metadata_df)
+            return metadata_df
+
+    # Kept columns are accumulated per chunk; taxonomy strings are replaced by
+    # codes into the set of distinct strings, which are split once at the end.
+    read_cols = columns + [c for c in [TAXONOMY_COLNAME] if c not in columns]
+    kept = {col: [] for col in columns}
+    taxonomy_ids = {}
+    taxonomy_codes = []
+    with profiling.stage('read metadata', file=path.basename(fname)) as st:
+        for chunk in iter_metadata_chunks(fname, read_cols, chunksize, sep, representatives_only):
+            codes, uniques = pd.factorize(chunk[TAXONOMY_COLNAME])
+            chunk_ids = np.array([taxonomy_ids.setdefault(u, len(taxonomy_ids)) for u in uniques],
+                                 dtype=np.int64)
+            taxonomy_codes.append(chunk_ids[codes])
+            for col in columns:
+                kept[col].append(chunk[col].to_numpy())
+
+        metadata_df = pd.DataFrame({col: np.concatenate(kept[col]) if kept[col] else []
+                                    for col in columns})
+        for col in columns:
+            # Representative flags and the like have only a few distinct values
+            if col != TAXONOMY_COLNAME and metadata_df[col].nunique() <= 0.5 * len(metadata_df):
+                metadata_df[col] = metadata_df[col].astype('category')
+        st.rows = len(metadata_df)
+
+    with profiling.stage('parse taxonomy', rows=len(taxonomy_ids)):
+        codes = np.concatenate(taxonomy_codes) if taxonomy_codes else np.zeros(0, dtype=np.int64)
+        unique_levels = parse_taxonomy(pd.Series(list(taxonomy_ids), dtype=object))
+        phylo_df = pd.DataFrame({
+            level: pd.Categorical.from_codes(unique_levels[level].cat.codes.to_numpy()[codes],
+                                             categories=unique_levels[level].cat.categories)
+            for level in unique_levels.columns
+        })
+        metadata_df = pd.concat([metadata_df, phylo_df], axis=1)
+
+    if cache_fname:
+        with profiling.stage('write cache', rows=len(metadata_df)):
+            metadata_df.to_pickle(cache_fname)
+        print(f'Cached metadata in {cache_fname}')
+    return metadata_df
+
+
+def add_cache_arguments(parser) -> None:
+    """Add the common metadata cache options to an argparse parser."""
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory for cached GTDB metadata. Default is a "cache" '
+                             'directory next to each metadata file.')
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='Always parse the GTDB metadata files, without caching.')
@@ -0,0 +1,357 @@
+"""Array-backed GTDB trees.
+
+GTDB publishes its bacterial and archaeal trees (bac120_r214.tree, ar53_r214.tree)
+in Newick format, with genome accessions at the leaves and support values and
+taxa on internal nodes, e.g. '100.0:p__Firmicutes; c__Bacilli'. load_tree()
+parses a tree once into flat arrays and caches them next to the file (as for the
+metadata, keyed on the file hash), so later runs load it in milliseconds.
+
+Nodes are numbered in pre-order: every node comes before its descendants, and
+the subtree of node i is the contiguous range i .. end[i] - 1. Summing a value
+over every subtree is then a difference of two cumulative sums, O(n) for all
+nodes at once and without recursion or per-clade grouping.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from os import path
+from typing import Iterable, List, Optional, Sequence
+
+from gtdb_metadata import default_cache_dir, file_sha256
+
+# Tree files published with each GTDB release
+TREE_FNAMES = {
+    'bacteria': 'bac120_r214.tree',
+    'archaea': 'ar53_r214.tree',
+}
+
+# Bump when the cached array layout changes
+TREE_CACHE_VERSION = 1
+
+# Newick tokens: comments, quoted labels, structure, branch lengths and bare labels
+_NEWICK_TOKEN_RE = re.compile(r"""
+    \[[^\]]*\]                # [comment]
+  | '(?:[^']|'')*'            # 'quoted label', '' escapes a quote
+  | [(),;]                    # structure
+  | :\s*[^\s(),:;\[]*         # :branch length
+  | [^\s(),:;'\[]+            # bare label
+  | \s+
+""", re.VERBOSE)
+
+
+def _unquote(label: str) -> str:
+    if label.startswith("'"):
+        return label[1:-1].replace("''", "'")
+    # Underscores stand for spaces in bare Newick labels, but GTDB accessions
+    # (GB_GCA_...) use them literally, so bare labels are kept as written
+    return label
+
+
+def split_internal_label(label: str):
+    """Split a GTDB internal node label into (support, taxa).
+
+    '100.0:p__Firmicutes; c__Bacilli' -> (100.0, 'p__Firmicutes; c__Bacilli').
+    Missing parts are NaN and ''.
+    """
+    support, _, taxa = label.partition(':') if ':' in label else (label, '', '')
+    try:
+        return float(support), taxa.strip()
+    except ValueError:
+        # No support value, only taxa
+        return np.nan, label.strip()
+
+
+class Tree:
+    """
+    Rooted tree stored as arrays over its nodes in pre-order.
+
+    :param parent: Index of each node's parent; -1 for the root.
+    :param end: One past the last node of each node's subtree.
+    :param labels: Node labels: accessions at leaves, GTDB support/taxa labels
+        (or '') at internal nodes.
+    :param branch_lengths: Length of the branch above each node; NaN if missing.
+    """
+    def __init__(self, parent: np.ndarray, end: np.ndarray, labels: Sequence[str],
+                 branch_lengths: np.ndarray):
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.end = np.asarray(end, dtype=np.int32)
+        self.labels = np.asarray(labels, dtype=str)
+        self.branch_lengths = np.asarray(branch_lengths, dtype=np.float64)
+
+        n = len(self.parent)
+        if not (len(self.end) == len(self.labels) == len(self.branch_lengths) == n):
+            raise ValueError("Tree arrays must all have one entry per node")
+        self.is_leaf = self.end == np.arange(1, n + 1)
+        self.leaves = np.flatnonzero(self.is_leaf)
+        self._leaf_index = None
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.parent)
+
+    @property
+    def n_leaves(self) -> int:
+        return len(self.leaves)
+
+    @property
+    def leaf_names(self) -> np.ndarray:
+        """Labels (accessions) of the leaves, in pre-order."""
+        return self.labels[self.leaves]
+
+    def leaf_index(self, names: Iterable[str]) -> np.ndarray:
+        """Node index of each named leaf, -1 for names not in the tree."""
+        if self._leaf_index is None:
+            self._leaf_index = {name: i for name, i in zip(self.leaf_names, self.leaves)}
+        return np.array([self._leaf_index.get(name, -1) for name in names], dtype=np.int64)
+
+    def children(self):
+        """Children of every node in CSR form.
+
+        Returns:
+            tuple: (offsets, child_indices) where the children of node i are
+                child_indices[offsets[i]:offsets[i + 1]], in pre-order.
+        """
+        nonroot = np.flatnonzero(self.parent >= 0)
+        order = np.argsort(self.parent[nonroot], kind='stable')
+        counts = np.bincount(self.parent[nonroot], minlength=self.n_nodes)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return offsets, nonroot[order]
+
+    def _ancestor_sums(self, node_values: np.ndarray) -> np.ndarray:
+        """Sum of node_values over each node and its ancestors.
+
+        Each node's value is added to its whole subtree range through a difference
+        array, so this is O(n) like subtree_sums().
+        """
+        diff = np.zeros(self.n_nodes + 1, dtype=np.result_type(node_values.dtype, np.int64))
+        np.add.at(diff, np.arange(self.n_nodes), node_values)
+        np.subtract.at(diff, self.end, node_values)
+        return np.cumsum(diff[:-1])
+
+    def depths(self) -> np.ndarray:
+        """Number of edges from the root to each node."""
+        return self._ancestor_sums((self.parent >= 0).astype(np.int64))
+
+    def root_distances(self) -> np.ndarray:
+        """Sum of branch lengths from the root to each node (missing lengths count as 0)."""
+        return self._ancestor_sums(np.nan_to_num(self.branch_lengths))
+
+    def subtree_sums(self, node_values: np.ndarray) -> np.ndarray:
+        """Sum of node_values over the subtree of every node.
+
+        :param node_values: Array with one row per node (any trailing shape).
+        :return: Array of the same shape; row i sums rows i .. end[i] - 1.
+        """
+        node_values = np.asarray(node_values)
+        cumulative = np.zeros((self.n_nodes + 1,) + node_values.shape[1:],
+                              dtype=np.result_type(node_values.dtype, np.int64))
+        np.cumsum(node_values, axis=0, out=cumulative[1:])
+        return cumulative[self.end] - cumulative[:-1]
+
+    def leaf_sums(self, leaf_values: np.ndarray) -> np.ndarray:
+        """Sum of values given for the leaves (in pre-order) over every subtree."""
+        leaf_values = np.asarray(leaf_values)
+        node_values = np.zeros((self.n_nodes,) + leaf_values.shape[1:], dtype=leaf_values.dtype)
+        node_values[self.leaves] = leaf_values
+        return self.subtree_sums(node_values)
+
+    def leaf_counts(self) -> np.ndarray:
+        """Number of leaves in the subtree of every node."""
+        return self.subtree_sums(self.is_leaf.astype(np.int64))
+
+    def node_ids(self, nodes: Optional[Sequence[int]] = None) -> List[str]:
+        """iTOL identifiers of nodes: the accession of a leaf, and 'first|last' for an
+        internal node, which iTOL resolves to the last common ancestor of its first
+        and last leaves -- the node itself."""
+        nodes = np.arange(self.n_nodes) if nodes is None else np.asarray(nodes, dtype=np.int64)
+        # First leaf at or after each position, last leaf at or before it
+        leaf_pos = np.where(self.is_leaf, np.arange(self.n_nodes), self.n_nodes)
+        first_leaf = np.minimum.accumulate(leaf_pos[::-1])[::-1]
+        last_leaf = np.maximum.accumulate(np.where(self.is_leaf, np.arange(self.n_nodes), -1))
+
+        ids = []
+        for i in nodes:
+            if self.is_leaf[i]:
+                ids.append(str(self.labels[i]))
+            else:
+                ids.append(f'{self.labels[first_leaf[i]]}|{self.labels[last_leaf[self.end[i] - 1]]}')
+        return ids
+
+    def taxa(self) -> List[str]:
+        """GTDB taxa on each node ('' for leaves and unnamed internal nodes)."""
+        return ['' if leaf else split_internal_label(label)[1]
+                for leaf, label in zip(self.is_leaf, self.labels)]
+
+    def find_taxa(self, names: Iterable[str]) -> np.ndarray:
+        """Nodes whose taxa include any of names, e.g. 'p__Firmicutes' or 'Firmicutes'."""
+        wanted = set(names)
+        found = []
+        for i, taxa in enumerate(self.taxa()):
+            for taxon in filter(None, (t.strip() for t in taxa.split(';'))):
+                if taxon in wanted or taxon[3:] in wanted:
+                    found.append(i)
+                    break
+        return np.array(found, dtype=np.int64)
+
+    def _cut(self, below: np.ndarray) -> np.ndarray:
+        """Nodes that are not below the cutoff but whose parent is, plus leaves that are
+        below it: a set of disjoint clades covering every leaf."""
+        parent_below = np.ones(self.n_nodes, dtype=bool)
+        nonroot = self.parent >= 0
+        parent_below[nonroot] = below[self.parent[nonroot]]
+        return np.flatnonzero((parent_below & ~below) | (below & self.is_leaf))
+
+    def cut_at_depth(self, depth: int) -> np.ndarray:
+        """Clades rooted at the given number of edges below the root (or shallower leaves)."""
+        return self._cut(self.depths() < depth)
+
+    def cut_at_distance(self, distance: float) -> np.ndarray:
+        """Clades rooted where the root distance first reaches distance (or shallower leaves)."""
+        return self._cut(self.root_distances() < distance)
+
+    def save(self, fname: str) -> None:
+        np.savez_compressed(fname, parent=self.parent, end=self.end, labels=self.labels,
+                            branch_lengths=self.branch_lengths)
+
+    @classmethod
+    def load(cls, fname: str) -> 'Tree':
+        with np.load(fname) as data:
+            return cls(data['parent'], data['end'], data['labels'], data['branch_lengths'])
+
+
+def parse_newick(text: str) -> Tree:
+    """Parse a Newick string into a Tree, in one pass over its tokens."""
+    parent, end, labels, lengths = [], [], [], []
+    stack = []
+    last = None        # node that the next label or branch length belongs to
+    expect_node = True  # after '(' or ',' a new child starts
+
+    def add_node(label=''):
+        parent.append(stack[-1] if stack else -1)
+        end.append(-1)
+        labels.append(label)
+        lengths.append(np.nan)
+        return len(parent) - 1
+
+    for match in _NEWICK_TOKEN_RE.finditer(text):
+        token = match.group()
+        first = token[0]
+        if first.isspace() or first == '[':
+            continue
+        if first == '(':
+            stack.append(add_node())
+            expect_node = True
+        elif first in ',)':
+            if expect_node:
+                # Unnamed leaf, e.g. "(,)"
+                end[add_node()] = len(parent)
+            if first == ')':
+                last = stack.pop()
+                end[last] = len(parent)
+            expect_node = first == ','
+        elif first == ':':
+            lengths[last] = float(token[1:]) if token[1:].strip() else np.nan
+        elif first == ';':
+            break
+        elif expect_node:
+            last = add_node(_unquote(token))
+            end[last] = len(parent)
+            expect_node = False
+        else:
+            labels[last] = _unquote(token)
+
+    if stack:
+        raise ValueError("Unbalanced parentheses in Newick tree")
+    return Tree(parent, end, labels, lengths)
+
+
+def load_tree(fname: str, cache_dir: Optional[str] = None, use_cache: bool = True) -> Tree:
+    """
+    Load a Newick tree file, from the array cache if it was parsed before.
+
+    :param fname: Newick file, e.g. bac120_r214.tree.
+    :param cache_dir: Directory for cached arrays. Defaults to default_cache_dir().
+    :param use_cache: Read from and write to the cache.
+    :return: The Tree.
+    """
+    cache_fname = None
+    if use_cache:
+        cache_dir = cache_dir or default_cache_dir(fname)
+        os.makedirs(cache_dir, exist_ok=True)
+        key = hashlib.sha256(json.dumps(dict(
+            sha256=file_sha256(fname, cache_dir), version=TREE_CACHE_VERSION)).encode()).hexdigest()[:16]
+        cache_fname = path.join(cache_dir, f'{path.basename(fname)}.{key}.npz')
+        if path.exists(cache_fname):
+            print(f'Loading cached tree from {cache_fname}')
+            return Tree.load(cache_fname)
+
+    with open(fname) as fh:
+        tree = parse_newick(fh.read())
+
+    if cache_fname:
+        tree.save(cache_fname)
+        print(f'Cached tree in {cache_fname}')
+    return tree
+
+
+# Unit testing
+import unittest
+import tempfile
+
+class TestTree(unittest.TestCase):
+    NEWICK = ("((GB_A:0.1,GB_B:0.2)'90.0:g__X':0.3,(RS_C:0.1,(GB_D:0.4,GB_E:0.5)'100.0':0.1)"
+              "'99.0:f__Y; g__Z':0.2,GB_F:1.0)'d__Bacteria';")
+
+    def setUp(self):
+        self.tree = parse_newick(self.NEWICK)
+
+    def test_parse(self):
+        tree = self.tree
+        self.assertEqual(tree.leaf_names.tolist(), ['GB_A', 'GB_B', 'RS_C', 'GB_D', 'GB_E', 'GB_F'])
+        self.assertEqual(tree.n_nodes, 10)
+        self.assertEqual(tree.parent[0], -1)
+        self.assertEqual(tree.labels[0], 'd__Bacteria')
+        self.assertEqual(split_internal_label(tree.labels[4]), (99.0, 'f__Y; g__Z'))
+        self.assertAlmostEqual(tree.branch_lengths[tree.leaf_index(['GB_E'])[0]], 0.5)
+        offsets, children = tree.children()
+        self.assertEqual(children[offsets[0]:offsets[1]].tolist(), [1, 4, 9])
+        self.assertEqual(tree.node_ids([1, 6, 9]), ['GB_A|GB_B', 'GB_D|GB_E', 'GB_F'])
+
+    def test_subtree_sums(self):
+        tree = self.tree
+        rng = np.random.default_rng(0)
+        values = rng.integers(0, 5, (tree.n_leaves, 3))
+        sums = tree.leaf_sums(values)
+        # Brute force: add every leaf's values to all of its ancestors
+        expected = np.zeros((tree.n_nodes, 3), dtype=np.int64)
+        for leaf, v in zip(tree.leaves, values):
+            node = leaf
+            while node >= 0:
+                expected[node] += v
+                node = tree.parent[node]
+        np.testing.assert_array_equal(sums, expected)
+        self.assertEqual(tree.leaf_counts()[0], 6)
+
+    def test_cuts_partition_leaves(self):
+        tree = self.tree
+        for clades in (tree.cut_at_depth(1), tree.cut_at_depth(2), tree.cut_at_distance(0.25),
+                       tree.cut_at_depth(10)):
+            covered = np.concatenate([np.arange(c, tree.end[c]) for c in clades])
+            self.assertEqual(sorted(covered[tree.is_leaf[covered]]), tree.leaves.tolist())
+        self.assertEqual(tree.cut_at_depth(1).tolist(), [1, 4, 9])
+        self.assertEqual(tree.find_taxa(['Z', 'g__X']).tolist(), [1, 4])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = path.join(tmpdir, 'test.tree')
+            with open(fname, 'w') as fh:
+                fh.write(self.NEWICK)
+            parsed = load_tree(fname)
+            cached = load_tree(fname)
+        self.assertEqual(cached.labels.tolist(), parsed.labels.tolist())
+        np.testing.assert_array_equal(cached.end, parsed.end)
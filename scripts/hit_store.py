@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""On-disk sparse store of AnnoTree hits, built out of core.
+
+tabulate_genes_by_organism.py reads every hit into one DataFrame, which is fine
+for a few dozen queries but not for AnnoTree exports of all of KEGG (hundreds of
+millions of hits). This script streams hit files in chunks instead: gtdbId and
+SearchId are mapped to integer codes as they are read and the (genome, query)
+code pairs are appended to a scratch file, so memory holds one chunk and the
+two dictionaries at a time.
+
+Finalizing turns the pairs into a compressed sparse column (CSC) matrix, one
+column per query, in two passes over the memory-mapped scratch file: count the
+hits of each query, then scatter the genome codes to their column. Each column
+is then sorted and duplicates dropped. The store directory holds
+
+    meta.json      counts and source files
+    genomes.txt    genome accessions, sorted, one per line (row codes)
+    queries.txt    query names, sorted, one per line (column codes)
+    indptr.npy     column offsets (int64, n_queries + 1)
+    indices.npy    genome codes of each column (int32)
+
+The arrays are memory-mapped when opened, so reading the columns one
+expression file needs touches only those columns:
+
+    python scripts/hit_store.py --out data/annotree/store --manifest data/annotree/annotree_manifest.csv
+    python scripts/apply_expressions.py --input data/annotree/store --expressions ... --outdir ...
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import profiling
+
+from os import path
+from typing import Iterable, List, Optional, Sequence
+
+from presence_matrix import PresenceMatrix
+from profiling import add_profile_arguments
+
+# Bump when the store layout changes
+STORE_VERSION = 1
+DEFAULT_CHUNKSIZE = 1_000_000
+
+_PAIRS_FNAME = 'pairs.tmp'
+_META_FNAME = 'meta.json'
+
+
+def _write_lines(fname: str, values: Iterable[str]) -> None:
+    with open(fname, 'w') as fh:
+        fh.writelines(f'{v}\n' for v in values)
+
+
+def _read_lines(fname: str) -> np.ndarray:
+    with open(fname) as fh:
+        return np.array(fh.read().splitlines(), dtype=str)
+
+
+class HitStoreWriter:
+    """
+    Builds a hit store from chunks of hits, then finalizes it.
+
+    :param store_dir: Directory of the store; created if needed.
+    """
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self._genome_codes = {}
+        self._query_codes = {}
+        self.n_hits = 0
+        self.sources: List[str] = []
+        self._pairs = open(path.join(store_dir, _PAIRS_FNAME), 'wb')
+
+    @staticmethod
+    def _encode(values: pd.Series, codes: dict) -> np.ndarray:
+        """Codes of values, adding unseen values; only distinct values are looked up."""
+        chunk_codes, uniques = pd.factorize(values)
+        mapping = np.array([codes.setdefault(v, len(codes)) for v in uniques], dtype=np.int32)
+        return mapping[chunk_codes]
+
+    def add_hits(self, hits_df: pd.DataFrame) -> None:
+        """Append a chunk of hits with gtdbId and SearchId columns (and geneId if read)."""
+        hits_df = hits_df[hits_df[['gtdbId', 'SearchId']].notnull().all(axis=1)]
+        if 'geneId' in hits_df:
+            hits_df = hits_df[hits_df['geneId'].notnull()]
+        pairs = np.empty((len(hits_df), 2), dtype=np.int32)
+        pairs[:, 0] = self._encode(hits_df['gtdbId'], self._genome_codes)
+        pairs[:, 1] = self._encode(hits_df['SearchId'], self._query_codes)
+        pairs.tofile(self._pairs)
+        self.n_hits += len(pairs)
+
+    def add_file(self, fname: str, chunksize: int = DEFAULT_CHUNKSIZE) -> None:
+        """Stream one AnnoTree hits CSV into the store."""
+        with profiling.stage('ingest file', file=path.basename(fname)) as st:
+            n_before = self.n_hits
+            for chunk in pd.read_csv(fname, usecols=['gtdbId', 'geneId', 'SearchId'],
+                                     dtype=str, chunksize=chunksize):
+                self.add_hits(chunk)
+            st.rows = self.n_hits - n_before
+        self.sources.append(fname)
+
+    def finalize(self, chunksize: int = DEFAULT_CHUNKSIZE) -> 'HitStore':
+        """Build the CSC arrays from the appended hits and remove the scratch file."""
+        self._pairs.close()
+        pairs_fname = path.join(self.store_dir, _PAIRS_FNAME)
+        genomes = np.array(list(self._genome_codes), dtype=str)
+        queries = np.array(list(self._query_codes), dtype=str)
+        # Rows and columns are sorted, as in a pivot of the long table; codes
+        # are remapped to their sorted rank while scattering
+        genome_order = np.argsort(genomes, kind='stable')
+        query_order = np.argsort(queries, kind='stable')
+        genome_rank = np.empty(len(genomes), dtype=np.int32)
+        genome_rank[genome_order] = np.arange(len(genomes), dtype=np.int32)
+        query_rank = np.empty(len(queries), dtype=np.int64)
+        query_rank[query_order] = np.arange(len(queries))
+
+        pairs = np.memmap(pairs_fname, dtype=np.int32, mode='r', shape=(self.n_hits, 2)) \
+            if self.n_hits else np.zeros((0, 2), dtype=np.int32)
+
+        with profiling.stage('count columns', rows=self.n_hits):
+            counts = np.zeros(len(queries), dtype=np.int64)
+            for start in range(0, self.n_hits, chunksize):
+                counts += np.bincount(query_rank[pairs[start:start + chunksize, 1]],
+                                      minlength=len(queries))
+            indptr = np.zeros(len(queries) + 1, dtype=np.int64)
+            np.cumsum(counts, out=indptr[1:])
+
+        unsorted_fname = path.join(self.store_dir, 'indices.tmp.npy')
+        with profiling.stage('scatter', rows=self.n_hits):
+            unsorted = np.lib.format.open_memmap(unsorted_fname, mode='w+', dtype=np.int32,
+                                                 shape=(self.n_hits,))
+            cursor = indptr[:-1].copy()
+            for start in range(0, self.n_hits, chunksize):
+                chunk = pairs[start:start + chunksize]
+                columns = query_rank[chunk[:, 1]]
+                order = np.argsort(columns, kind='stable')
+                columns = columns[order]
+                # Position of each hit within its column's run in this chunk
+                run_starts = np.searchsorted(columns, columns, side='left')
+                offsets = cursor[columns] + np.arange(len(columns)) - run_starts
+                unsorted[offsets] = genome_rank[chunk[order, 0]]
+                cursor += np.bincount(columns, minlength=len(queries))
+            unsorted.flush()
+
+        with profiling.stage('sort columns', rows=self.n_hits) as st:
+            # Sorted, de-duplicated columns are compacted in place: a column never
+            # starts after its original offset
+            new_indptr = np.zeros_like(indptr)
+            for q in range(len(queries)):
+                column = np.unique(unsorted[indptr[q]:indptr[q + 1]])
+                unsorted[new_indptr[q]:new_indptr[q] + len(column)] = column
+                new_indptr[q + 1] = new_indptr[q] + len(column)
+            n_pairs = int(new_indptr[-1])
+            indices = np.lib.format.open_memmap(path.join(self.store_dir, 'indices.npy'),
+                                                mode='w+', dtype=np.int32, shape=(n_pairs,))
+            for start in range(0, n_pairs, chunksize):
+                stop = min(start + chunksize, n_pairs)
+                indices[start:stop] = unsorted[start:stop]
+            indices.flush()
+            st.info.update(pairs=n_pairs)
+        del unsorted, indices, pairs
+        os.remove(unsorted_fname)
+        os.remove(pairs_fname)
+
+        np.save(path.join(self.store_dir, 'indptr.npy'), new_indptr)
+        _write_lines(path.join(self.store_dir, 'genomes.txt'), genomes[genome_order])
+        _write_lines(path.join(self.store_dir, 'queries.txt'), queries[query_order])
+        meta = dict(version=STORE_VERSION, n_hits=self.n_hits, n_pairs=n_pairs,
+                    n_genomes=len(genomes), n_queries=len(queries), sources=self.sources)
+        with open(path.join(self.store_dir, _META_FNAME), 'w') as fh:
+            json.dump(meta, fh, indent=2)
+        return HitStore(self.store_dir)
+
+
+class HitStore:
+    """
+    Read access to a finalized hit store; the sparse arrays are memory-mapped.
+
+    :param store_dir: Directory written by HitStoreWriter.finalize().
+    """
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(path.join(store_dir, _META_FNAME)) as fh:
+            self.meta = json.load(fh)
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Hit store {store_dir} has version {self.meta.get('version')}, "
+                             f"expected {STORE_VERSION}; rebuild it with hit_store.py")
+        self.genomes = _read_lines(path.join(store_dir, 'genomes.txt'))
+        self.queries = _read_lines(path.join(store_dir, 'queries.txt'))
+        self.indptr = np.load(path.join(store_dir, 'indptr.npy'))
+        self.indices = np.load(path.join(store_dir, 'indices.npy'), mmap_mode='r')
+        self._query_index = {q: i for i, q in enumerate(self.queries)}
+
+    @staticmethod
+    def is_store(fname: str) -> bool:
+        """Whether fname is a hit store directory."""
+        return path.isfile(path.join(fname, _META_FNAME))
+
+    @property
+    def n_genomes(self) -> int:
+        return len(self.genomes)
+
+    @property
+    def n_queries(self) -> int:
+        return len(self.queries)
+
+    def __contains__(self, query: str) -> bool:
+        return query in self._query_index
+
+    def query_counts(self) -> pd.Series:
+        """Number of genomes with a hit for each query."""
+        return pd.Series(np.diff(self.indptr), index=self.queries)
+
+    def genome_codes(self, query: str) -> np.ndarray:
+        """Sorted row codes of the genomes with a hit for a query."""
+        q = self._query_index[query]
+        return np.asarray(self.indices[self.indptr[q]:self.indptr[q + 1]])
+
+    def presence(self, queries: Optional[Sequence[str]] = None) -> PresenceMatrix:
+        """
+        Packed presence of the given queries (default all) over all genomes.
+
+        :param queries: Query names; names not in the store are left out.
+        """
+        queries = self.queries if queries is None else [q for q in queries if q in self]
+        bits = np.zeros((len(queries), (self.n_genomes + 7) // 8), dtype=np.uint8)
+        dense = np.zeros(self.n_genomes, dtype=bool)
+        for i, query in enumerate(queries):
+            codes = self.genome_codes(query)
+            dense[codes] = True
+            bits[i] = np.packbits(dense)
+            dense[codes] = False
+        return PresenceMatrix(self.genomes, queries, bits)
+
+    def presence_for_expressions(self, expressions_df: pd.DataFrame) -> PresenceMatrix:
+        """Packed presence of only the queries the expressions reference."""
+        from exp_parsing import ExpressionGraph
+
+        graph = ExpressionGraph(expressions_df['boolean_expression'].to_dict())
+        return self.presence(sorted(set(graph.genes())))
+
+
+def build_store(fnames: Sequence[str], store_dir: str,
+                chunksize: int = DEFAULT_CHUNKSIZE) -> HitStore:
+    """Stream the hit files into a new store in store_dir."""
+    writer = HitStoreWriter(store_dir)
+    for fname in fnames:
+        writer.add_file(fname, chunksize)
+    return writer.finalize(chunksize)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fnames', type=str, nargs='*',
+                        help='AnnoTree hit CSV files (gtdbId, geneId and SearchId columns).')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Also ingest the per-query hit files of this annotree manifest.')
+    parser.add_argument('--annotree_dir', type=str, default=None,
+                        help='Directory of the per-query hit files of the manifest. '
+                             'Default is the manifest\'s directory.')
+    parser.add_argument('--out', type=str, required=True,
+                        help='Store directory.')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help='Rows read and scattered at a time.')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    profiling.start('hit_store', args.profile_out, args.cprofile_out)
+
+    fnames = list(args.fnames)
+    if args.manifest:
+        from tabulate_genes_by_organism import read_manifest
+        manifest = read_manifest(args.manifest, args.annotree_dir or path.dirname(args.manifest))
+        fnames += manifest['filepath'].tolist()
+    if not fnames:
+        parser.error('no hit files given')
+
+    print(f'Ingesting {len(fnames)} hit files into {args.out}...')
+    store = build_store(fnames, args.out, args.chunksize)
+    print(f"Stored {store.meta['n_pairs']} genome/query pairs from {store.meta['n_hits']} hits: "
+          f"{store.n_genomes} genomes, {store.n_queries} queries")
+    profiling.finish()
+
+
+# Unit testing
+import unittest
+import tempfile
+
+class TestHitStore(unittest.TestCase):
+    def test_matches_presence_from_hits(self):
+        from tabulate_genes_by_organism import presence_from_hits
+
+        rng = np.random.default_rng(0)
+        hits_df = pd.DataFrame({
+            'gtdbId': [f'genome{i}' for i in rng.integers(0, 50, 400)],
+            'geneId': [f'gene{i}' for i in range(400)],
+            'SearchId': [f'K{i:05d}' for i in rng.integers(0, 12, 400)],
+        })
+        hits_df.loc[::37, 'geneId'] = np.nan
+        expected = presence_from_hits(hits_df)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fnames = []
+            for i, part in enumerate([hits_df[:150], hits_df[150:300], hits_df[300:]]):
+                fnames.append(path.join(tmpdir, f'hits{i}.csv'))
+                part.to_csv(fnames[-1], index=False)
+            store = build_store(fnames, path.join(tmpdir, 'store'), chunksize=25)
+            self.assertEqual(sorted(os.listdir(store.store_dir)),
+                             ['genomes.txt', 'indices.npy', 'indptr.npy', 'meta.json', 'queries.txt'])
+            presence = store.presence()
+            pd.testing.assert_frame_equal(presence.to_dataframe(), expected.to_dataframe())
+            subset = store.presence(['K00003', 'missing', 'K00001'])
+            self.assertEqual(subset.genes.tolist(), ['K00003', 'K00001'])
+            np.testing.assert_array_equal(subset.bits, expected.select(['K00003', 'K00001']).bits)
+            self.assertEqual(store.query_counts().tolist(), expected.counts().tolist())
+            del store, presence, subset
+
+
+if __name__ == '__main__':
+    main()
@@ -9,16 +9,22 @@ TODO: make sure that the AnnoTree tree is using the GTDB taxonomy.
 __author__ = 'Avi I. Flamholz'
 
 import argparse
+import numpy as np
 import pandas as pd
-import re
-import seaborn as sns
+import profiling
 
 from os import path
 from pathlib import Path
+from gtdb_metadata import add_cache_arguments, load_gtdb_metadata
+from gtdb_tree import TREE_FNAMES, load_tree
+from palettes import color_palette_hex
+from presence_matrix import PresenceMatrix
+from profiling import add_profile_arguments
+from table_io import read_table, write_table
 
 REPS_FNAMES = {
-    'bacteria': 'bac120_metadata_r214.tsv',
-    'archaea': 'ar53_metadata_r214.tsv'
+    'bacteria': 'bac120_metadata_r214.tsv.gz',
+    'archaea': 'ar53_metadata_r214.tsv.gz'
 }
 
 SELF_PATH = Path(path.abspath(__file__))
@@ -69,31 +75,63 @@ FIELD_SHAPES,{field_shapes}
 DATA
 """
 
-# A regex capturing all the taxonomic levels in the GTDB taxonomy format
-TAXONOMY_RE = re.compile(r'd__(?P<domain>[^;]+);p__(?P<phylum>[^;]+);c__(?P<class>[^;]+);o__(?P<order>[^;]+);f__(?P<family>[^;]+);g__(?P<genus>[^;]+);s__(?P<species>[^;]+)')
+BOXPLOT_HEADER_FORMAT = """
+DATASET_BOXPLOT
+SEPARATOR COMMA
+DATASET_LABEL,{label}
+COLOR,{hex_color}
+DATA
+"""
 
 AGG_LEVELS = {
-    'species': 'gtdbId',
+    'species': 'species',
     'genus': 'genus',
     'family': 'family',
     'order': 'order',
     'class': 'class',
     'phylum': 'phylum'
 }
+
+RESAMPLE_METHODS = ('bootstrap', 'rarefy')
+# Largest number of replicate draws held in memory at once
+MAX_BATCH_ELEMENTS = 2 ** 22
+# Quantiles of the replicates drawn in iTOL boxplots, besides the interval bounds
+BOX_QUANTILES = (0.25, 0.5, 0.75)
  
+def load_representatives(domain='bacteria', gtdb_path=GTDB_PATH, cache_dir=None, use_cache=True):
+    """Taxonomy of the GTDB representative genomes of a domain, indexed by accession.
+
+    Streams only the needed columns of the representative genomes, with the
+    taxonomy split into levels.
+    """
+    gtdb_reps_fname = path.join(gtdb_path, REPS_FNAMES[domain])
+    with profiling.stage('read representatives', domain=domain) as st:
+        reps_df = load_gtdb_metadata(gtdb_reps_fname, cache_dir=cache_dir,
+                                     use_cache=use_cache, representatives_only=True)
+        reps_df = reps_df.set_index('accession')
+        st.rows = len(reps_df)
+    return reps_df
+
+
 def count_hits(gids, reps_df, agg_level):
-    """Count hits in annotree CSV file at this aggregation level.
-    
+    """Count representative genomes with hits at this aggregation level.
+
+    One function at a time; count_hits_all_levels() counts every function at
+    once from the presence table.
+
     Args:
-        fh (file): File handle to annotree CSV file.
+        gids (list): accessions of the genomes with the function, e.g. the index
+            of the rows of a presence table where its column is True.
+        reps_df (pd.DataFrame): representative genome taxonomy indexed by accession.
         agg_level (str): Aggregation level to count hits at.
-    
+
     Returns:
-        pd.DataFrame: DataFrame with counts at this aggregation level.
+        pd.DataFrame: DataFrame with a 'count' column indexed by the taxa of the
+            level that have hits.
     """
     masked_reps_df = reps_df[reps_df.index.isin(gids)]
     agg_key = AGG_LEVELS[agg_level]
-    counts = masked_reps_df.groupby(agg_key).agg(dict(species='count'))
+    counts = masked_reps_df.groupby(agg_key, observed=True).agg(dict(species='count'))
     counts.columns = ['count']
     return counts
 
@@ -114,7 +152,7 @@ def normalize_counts(counts, reps_df, agg_level):
         return counts
     
     # Count number of representative genomes at this aggregation level
-    reps_count = reps_df.groupby(agg_level).agg(dict(species='count'))
+    reps_count = reps_df.groupby(agg_level, observed=True).agg(dict(species='count'))
     reps_count.columns = ['count']
 
     # Normalize counts by number of representative genomes
@@ -125,61 +163,270 @@ def normalize_counts(counts, reps_df, agg_level):
     return normed
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--domain', type=str, default='bacteria',
-                        help='Domain to use for GTDB representative genomes.',
-                        choices=('bacteria', 'archaea'))
-    parser.add_argument('--in', '-i', type=argparse.FileType('r'),
-                        required=True, dest='input',
-                        help='Input annotree hits CSV file path. Indexed by gtdbId.')
-    parser.add_argument('--out', '-o', type=str, default='iTOL_dataset.txt',
-                        help='Output iTOL dataset file name.')
-    parser.add_argument('--palette', '-p', type=str, default='tab10',
-                        help='Seaborn palette name for colors.')
-    parser.add_argument('--agg_level', '-a', type=str, default='species',
-                        help='Aggregation level for annotree hits.',
-                        choices=sorted(AGG_LEVELS.values()))
-    parser.add_argument('--plot_type', '-t', type=str, default='bar',
-                        help='iTOL plot type.',
-                        choices=('bar', 'binary', 'heatmap'))
-    parser.add_argument('--binary_threshold', '-b', type=float, default=0.5,
-                        help='Threshold for binarizing counts or normalized counts.')
-    
-    args = parser.parse_args()
-    print(f'Input file: {args.input.name}')
-
-    print('Reading representatives...')
-    gtdb_reps_fname = path.join(GTDB_PATH, REPS_FNAMES[args.domain])
-    reps_df = pd.read_csv(gtdb_reps_fname, sep='\t')
-
-    # Extract the taxonomic information 
-    tax_df = reps_df['gtdb_taxonomy'].str.extract(TAXONOMY_RE)
-    reps_df = pd.concat([reps_df, tax_df], axis=1)
-
-    # Retain only representative genomes
-    mask = reps_df['gtdb_representative'] == 't'
-    reps_df = reps_df[mask].set_index('accession')
-
-    hits = pd.read_csv(args.input, index_col=0)
-    count_cols = []
-    for c in hits.columns:
-        print('Processing column:', c)
-        gids = hits[hits[c] == True].index.to_list()
-        counts = count_hits(gids, reps_df, args.agg_level)
-        normed = normalize_counts(counts, reps_df, args.agg_level)
-        normed.columns = [c]
-        count_cols.append(normed)
-    annotree_counts = pd.concat(count_cols, axis=1)
-
-    print('Aggregating counts...')
+def dense_hits(hits, quantitative=False):
+    """Genomes, dense genomes x functions array and function names of hits.
+
+    The array is boolean presence, or integer counts if quantitative. Numeric
+    (count-valued) tables are present where the count is non-zero. Genomes
+    listed more than once in a DataFrame are merged.
+    """
+    if isinstance(hits, PresenceMatrix):
+        dense = hits.to_dense()
+        return pd.Index(hits.genomes), dense.astype(np.int64) if quantitative else dense, \
+            hits.genes.tolist()
+    if quantitative:
+        values = hits.fillna(0).astype(np.int64)
+        if not values.index.is_unique:
+            values = values.groupby(level=0).sum()
+        return values.index, values.to_numpy(), values.columns.tolist()
+    is_count = [pd.api.types.is_numeric_dtype(t) and not pd.api.types.is_bool_dtype(t)
+                for t in hits.dtypes]
+    present = hits.fillna(0) > 0 if len(is_count) and all(is_count) else hits == True
+    if not present.index.is_unique:
+        present = present.groupby(level=0).any()
+    return present.index, present.to_numpy(), present.columns.tolist()
+
+
+def presence_matrix(hits, reps_df, quantitative=False):
+    """Sparse representative genome x function presence matrix.
+
+    Args:
+        hits (pd.DataFrame or PresenceMatrix): genomes x functions, True where the
+            function is present, or counts.
+        reps_df (pd.DataFrame): representative genome taxonomy indexed by accession.
+        quantitative (bool): keep the counts of hits instead of presence.
+
+    Returns:
+        tuple: (scipy.sparse.csr_matrix with one row per genome in reps_df,
+            list of function names). Genomes without hits are all-zero rows.
+    """
+    # Deferred: scipy.sparse is slow to import and only needed for counting
+    from scipy import sparse
+
+    genomes, dense, functions = dense_hits(hits, quantitative)
+    rows = genomes.get_indexer(reps_df.index)
+    found = rows >= 0
+    found_dense = dense[rows[found]]
+    genome_idx, function_idx = np.nonzero(found_dense)
+    values = found_dense[genome_idx, function_idx].astype(np.int64)
+    genome_idx = np.flatnonzero(found)[genome_idx]
+    matrix = sparse.csr_matrix(
+        (values, (genome_idx, function_idx)),
+        shape=(len(reps_df), len(functions)))
+    return matrix, functions
+
+
+def taxon_membership(reps_df, agg_levels):
+    """Sparse genome x taxon membership matrix for several aggregation levels.
+
+    Args:
+        reps_df (pd.DataFrame): representative genome taxonomy.
+        agg_levels (list): aggregation levels, keys of AGG_LEVELS.
+
+    Returns:
+        tuple: (scipy.sparse.csr_matrix with one column per taxon of every level,
+            dict mapping each level to the pd.Index of its taxa, in column order).
+    """
+    from scipy import sparse
+
+    n_genomes = len(reps_df)
+    blocks = []
+    taxa = {}
+    for level in agg_levels:
+        codes, names = pd.factorize(reps_df[AGG_LEVELS[level]], sort=True)
+        rows = np.flatnonzero(codes >= 0)
+        blocks.append(sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, codes[rows])),
+            shape=(n_genomes, len(names))))
+        taxa[level] = pd.Index(np.asarray(names), name=level)
+    return sparse.hstack(blocks, format='csr'), taxa
+
+
+def count_hits_all_levels(hits, reps_df, agg_levels, quantitative=False):
+    """Count and normalize hits of every function at several aggregation levels at once.
+
+    Counts are one sparse product of the taxon membership matrix and the genome x
+    function presence matrix, instead of a groupby per function and level.
+
+    Args:
+        hits (pd.DataFrame or PresenceMatrix): genomes x functions presence.
+        reps_df (pd.DataFrame): representative genome taxonomy indexed by accession.
+        agg_levels (list): aggregation levels, keys of AGG_LEVELS.
+        quantitative (bool): hits are counts (e.g. gene copies); counts are then
+            summed over each taxon instead of counting genomes with the function.
+
+    Returns:
+        dict: level -> (counts, n_reps) where counts is a taxa x functions
+            DataFrame of representative genomes with each function and n_reps is
+            a Series with the number of representative genomes per taxon.
+    """
+    with profiling.stage('presence matrix', rows=len(reps_df)):
+        presence, functions = presence_matrix(hits, reps_df, quantitative)
+    with profiling.stage('taxon membership', rows=len(reps_df)):
+        membership, taxa = taxon_membership(reps_df, agg_levels)
+
+    with profiling.stage('count', rows=len(reps_df), functions=len(functions),
+                         taxa=membership.shape[1]):
+        all_counts = (membership.T @ presence).toarray()
+        all_reps = np.asarray(membership.sum(axis=0)).ravel()
+
+    results = {}
+    offset = 0
+    for level in agg_levels:
+        level_taxa = taxa[level]
+        level_slice = slice(offset, offset + len(level_taxa))
+        counts = pd.DataFrame(all_counts[level_slice], index=level_taxa, columns=functions)
+        n_reps = pd.Series(all_reps[level_slice], index=level_taxa, name='n_representatives')
+        results[level] = (counts, n_reps)
+        offset += len(level_taxa)
+    return results
+
+
+def count_hits_clades(hits, tree, clades, quantitative=False):
+    """Count and normalize hits of every function in clades of a GTDB tree.
+
+    Counts for every node are one pass over the tree (Tree.leaf_sums), so any
+    set of clades costs the same as a single rank.
+
+    Args:
+        hits (pd.DataFrame or PresenceMatrix): genomes x functions presence.
+        tree (gtdb_tree.Tree): tree with genome accessions at its leaves.
+        clades (array): node indices of the clades to report.
+        quantitative (bool): sum counts of hits instead of counting genomes.
+
+    Returns:
+        tuple: (counts, n_leaves) as for one level of count_hits_all_levels(), with
+            clades identified by their iTOL node ids and normalized by the number
+            of genomes (leaves) in each clade.
+    """
+    genomes, dense, functions = dense_hits(hits, quantitative)
+    rows = genomes.get_indexer(tree.leaf_names)
+    leaf_hits = np.zeros((tree.n_leaves, len(functions)), dtype=np.int64)
+    found = rows >= 0
+    leaf_hits[found] = dense[rows[found]]
+
+    node_ids = pd.Index(tree.node_ids(clades), name='clade')
+    counts = pd.DataFrame(tree.leaf_sums(leaf_hits)[clades], index=node_ids, columns=functions)
+    n_leaves = pd.Series(tree.leaf_counts()[clades], index=node_ids, name='n_representatives')
+    return counts, n_leaves
+
+
+def itol_values(counts, n_reps, agg_level):
+    """Values to plot for one level: fractions of representatives, counts for species.
+
+    Taxa without hits are NaN and, at the species level, omitted, matching
+    normalize_counts() applied to count_hits() for each function.
+    """
+    has_hits = counts > 0
+    if agg_level == 'species':
+        values = counts.where(has_hits)
+        return values[has_hits.any(axis=1)]
+    return counts.div(n_reps, axis=0).where(has_hits)
+
+
+def resample_fractions(counts, n_reps, method='bootstrap', n_replicates=1000, depth=None,
+                       ci=0.95, seed=0, max_batch_elements=MAX_BATCH_ELEMENTS):
+    """Means and confidence intervals of taxon fractions under resampling of genomes.
+
+    Replicate counts are drawn directly from their distribution given the taxon's
+    count and size, for blocks of taxa x functions x replicates at a time, which
+    is equivalent to resampling genome labels and counting:
+        - bootstrap: n genomes drawn with replacement from a taxon of n genomes,
+          so the count is Binomial(n, count / n).
+        - rarefy: depth genomes drawn without replacement, so the count is
+          Hypergeometric(count, n - count, depth). Taxa with fewer than depth
+          genomes are NaN.
+
+    Args:
+        counts (pd.DataFrame): taxa x functions representative genomes with each function.
+        n_reps (pd.Series): representative genomes per taxon.
+        method (str): 'bootstrap' or 'rarefy'.
+        n_replicates (int): number of replicates per taxon.
+        depth (int): genomes drawn per taxon when rarefying. Default is the
+            smallest taxon.
+        ci (float): confidence level of the intervals.
+        seed (int): seed of the random draws.
+        max_batch_elements (int): largest number of draws held in memory at once.
+
+    Returns:
+        dict: statistic -> taxa x functions DataFrame of replicate fractions, for
+            'mean', 'ci_low', 'ci_high' and the BOX_QUANTILES ('q25', 'q50', 'q75').
+    """
+    if method not in RESAMPLE_METHODS:
+        raise ValueError(f"Unknown resampling method: {method}")
+    k = counts.to_numpy(dtype=np.int64)
+    n = n_reps.reindex(counts.index).to_numpy(dtype=np.int64)
+    if method == 'rarefy':
+        depth = int(n.min()) if depth is None else depth
+        keep = n >= depth
+        # Taxa too small to rarefy draw from themselves and are masked afterwards
+        sample = np.where(keep, depth, n)
+    else:
+        keep = np.ones(len(n), dtype=bool)
+        sample = n
+
+    alpha = (1 - ci) / 2
+    quantiles = [alpha] + list(BOX_QUANTILES) + [1 - alpha]
+    names = ['ci_low'] + [f'q{round(q * 100)}' for q in BOX_QUANTILES] + ['ci_high']
+    stats = np.full((len(quantiles) + 1,) + k.shape, np.nan)
+
+    rng = np.random.default_rng(seed)
+    n_taxa = max(1, max_batch_elements // max(1, k.shape[1] * n_replicates))
+    for start in range(0, len(n), n_taxa):
+        block = slice(start, start + n_taxa)
+        kb, nb = k[block, :, None], n[block, None, None]
+        size = kb.shape[:2] + (n_replicates,)
+        if method == 'rarefy':
+            draws = rng.hypergeometric(kb, nb - kb, sample[block, None, None], size=size)
+        else:
+            draws = rng.binomial(nb, kb / np.maximum(nb, 1), size=size)
+        fractions = draws / np.maximum(sample[block, None, None], 1)
+        stats[0, block] = fractions.mean(axis=-1)
+        stats[1:, block] = np.quantile(fractions, quantiles, axis=-1)
+    stats[:, ~keep] = np.nan
+
+    return {name: pd.DataFrame(values, index=counts.index, columns=counts.columns)
+            for name, values in zip(['mean'] + names, stats)}
+
+
+def long_counts_table(results, intervals=None):
+    """Long format counts and fractions for every level, taxon and function.
+
+    With intervals (level -> resample_fractions() output), the resampled mean
+    and confidence interval of each fraction are added as columns.
+    """
+    tables = []
+    for level, (counts, n_reps) in results.items():
+        table = counts.rename_axis(index='taxon', columns='function').stack().rename('count')
+        table = table.reset_index()
+        table.insert(0, 'level', level)
+        table['n_representatives'] = n_reps.reindex(table['taxon']).to_numpy()
+        table['fraction'] = table['count'] / table['n_representatives']
+        if intervals is not None and level in intervals:
+            for stat in ('mean', 'ci_low', 'ci_high'):
+                table[f'fraction_{stat}'] = intervals[level][stat].to_numpy().ravel()
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def level_output_path(out, agg_level, n_levels):
+    """Output file for one level: fills {agg_level} in out, or adds a suffix if needed."""
+    if '{agg_level}' in out:
+        return out.format(agg_level=agg_level)
+    if n_levels == 1:
+        return out
+    base, ext = path.splitext(out)
+    return f'{base}_{agg_level}{ext}'
+
+
+def write_itol_dataset(annotree_counts, out, plot_type, palette, binary_threshold):
+    """Write one iTOL dataset of taxa x functions values."""
     labels = annotree_counts.columns.tolist()
     n_colors = len(labels)
-    pal = sns.color_palette(args.palette, n_colors=n_colors)
-    hex_colors = pal.as_hex()
+    hex_colors = color_palette_hex(palette, n_colors=n_colors)
 
     header_text = ''
-    if args.plot_type == 'binary':
+    if plot_type == 'binary':
         print('Binarizing counts...')
         field_colors = ','.join(hex_colors)
         field_labels = ','.join(labels)
@@ -187,15 +434,15 @@ def main():
         header_text = BINARY_HEADER_FORMAT.format(
             label='annotree', field_colors=field_colors,
             field_labels=field_labels, field_shapes=field_shapes)
-        annotree_counts = (annotree_counts > args.binary_threshold).astype(int)
-    elif args.plot_type == 'bar' and n_colors > 1:
+        annotree_counts = (annotree_counts > binary_threshold).astype(int)
+    elif plot_type == 'bar' and n_colors > 1:
         print('Creating multibar plot...')
         field_colors = ','.join(hex_colors)
         field_labels = ','.join(labels)
         header_text = MULTIBAR_HEADER_FORMAT.format(
             label='annotree', field_colors=field_colors,
             field_labels=field_labels)
-    elif args.plot_type == 'heatmap':
+    elif plot_type == 'heatmap':
         print('Creating heatmap plot...')
         field_colors = ','.join(hex_colors)
         field_labels = ','.join(labels)
@@ -206,14 +453,264 @@ def main():
     else:
         print('Creating simplebar plot...')
         header_text = SIMPLEBAR_HEADER_FORMAT.format(
-            label=args.labels[0], hex_color=hex_colors[0])
+            label=labels[0], hex_color=hex_colors[0])
     
-    print(f'Writing iTOL dataset to {args.out}...')
-    with open(args.out, 'w') as f:
+    print(f'Writing iTOL dataset to {out}...')
+    with open(out, 'w') as f:
         f.write(header_text)
         annotree_counts.to_csv(f, header=False)
+
+
+def write_itol_intervals(counts, stats, out, palette):
+    """Write one iTOL boxplot dataset per function of resampled taxon fractions.
+
+    Whiskers are the confidence interval, boxes the quartiles of the replicates.
+    Taxa without hits or without replicates (too small to rarefy) are omitted, as
+    in the value datasets. Returns the file names written.
+    """
+    labels = counts.columns.tolist()
+    hex_colors = color_palette_hex(palette, n_colors=len(labels))
+    columns = ['ci_low', 'q25', 'q50', 'q75', 'ci_high']
+    base, ext = path.splitext(out)
+    fnames = []
+    for label, hex_color in zip(labels, hex_colors):
+        box = pd.DataFrame({c: stats[c][label] for c in columns})
+        box = box[(counts[label] > 0) & box.notna().all(axis=1)]
+        fname = f'{base}_{label}_ci{ext}'
+        print(f'Writing iTOL intervals to {fname}...')
+        with open(fname, 'w') as f:
+            f.write(BOXPLOT_HEADER_FORMAT.format(label=label,
+                                                 hex_color=hex_color))
+            box.to_csv(f, header=False)
+        fnames.append(fname)
+    return fnames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--domain', type=str, default='bacteria',
+                        help='Domain to use for GTDB representative genomes.',
+                        choices=('bacteria', 'archaea'))
+    parser.add_argument('--in', '-i', type=str,
+                        required=True, dest='input',
+                        help='Input annotree hits table (CSV, parquet or feather), indexed by gtdbId, '
+                             'or a packed presence matrix (.npz).')
+    parser.add_argument('--out', '-o', type=str, default='iTOL_dataset.txt',
+                        help='Output iTOL dataset file name. With several aggregation levels, '
+                             '{agg_level} in the name is replaced by the level, otherwise the '
+                             'level is added as a suffix.')
+    parser.add_argument('--palette', '-p', type=str, default='tab10',
+                        help='Palette name for colors: a built-in palette (tab10, Set2, deep, ...) '
+                             'or, if seaborn is installed, any seaborn palette.')
+    parser.add_argument('--agg_level', '-a', type=str, default=None, nargs='+',
+                        help='Aggregation level(s) for annotree hits. Default is species, '
+                             'unless clades of the GTDB tree are requested.',
+                        choices=list(AGG_LEVELS))
+    parser.add_argument('--tree', type=str, default=None,
+                        help='GTDB Newick tree for clade aggregation. Default is the '
+                             'release tree of the domain in data/gtdb.')
+    parser.add_argument('--clade_depth', type=int, default=[], nargs='+',
+                        help='Aggregate hits in the clades of the GTDB tree this many '
+                             'branches below the root (one dataset per depth).')
+    parser.add_argument('--clade_distance', type=float, default=[], nargs='+',
+                        help='Aggregate hits in the clades of the GTDB tree at this '
+                             'branch length distance from the root (one dataset per distance).')
+    parser.add_argument('--clades', type=str, default=None, nargs='+',
+                        help='Aggregate hits in the named clades of the GTDB tree, '
+                             'e.g. p__Firmicutes or Firmicutes.')
+    parser.add_argument('--plot_type', '-t', type=str, default='bar',
+                        help='iTOL plot type.',
+                        choices=('bar', 'binary', 'heatmap'))
+    parser.add_argument('--binary_threshold', '-b', type=float, default=0.5,
+                        help='Threshold for binarizing counts or normalized counts.')
+    parser.add_argument('--counts_out', type=str, default=None,
+                        help='Optional table of counts and fractions for every level, taxon and function.')
+    parser.add_argument('--quantitative', action='store_true', default=False,
+                        help='Input values are counts (e.g. gene copy numbers from apply_expressions.py '
+                             '--quantitative): plot the mean count per representative genome of each '
+                             'taxon (counts for species) instead of the fraction with the function. '
+                             'The count and fraction columns of --counts_out are then totals and means.')
+    parser.add_argument('--resample', type=str, default=None, choices=RESAMPLE_METHODS,
+                        help='Resample genomes within each taxon to estimate confidence intervals '
+                             'of the fractions: bootstrap genomes, or rarefy every taxon to '
+                             '--rarefy_depth genomes. Intervals are added to --counts_out and '
+                             'written as one iTOL boxplot dataset per function (not for species).')
+    parser.add_argument('--replicates', type=int, default=1000,
+                        help='Number of resampling replicates.')
+    parser.add_argument('--rarefy_depth', type=int, default=None,
+                        help='Genomes drawn per taxon when rarefying; smaller taxa are left '
+                             'out. Default is the size of the smallest taxon.')
+    parser.add_argument('--ci', type=float, default=0.95,
+                        help='Confidence level of the resampled intervals.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the resampling.')
+    add_cache_arguments(parser)
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+    if args.quantitative and args.resample:
+        parser.error('--resample estimates fractions of genomes with a function; '
+                     'it cannot be combined with --quantitative')
+    profiling.start('hits2itol', args.profile_out, args.cprofile_out)
+    print(f'Input file: {args.input}')
+
+    with profiling.stage('read hits') as st:
+        if args.input.endswith('.npz'):
+            hits = PresenceMatrix.load(args.input)
+        else:
+            hits = read_table(args.input, index_col=0)
+        st.rows = len(hits.genomes) if isinstance(hits, PresenceMatrix) else len(hits)
+
+    use_clades = bool(args.clade_depth or args.clade_distance or args.clades)
+    agg_levels = list(dict.fromkeys(args.agg_level or ([] if use_clades else ['species'])))
+    results = {}
+    if agg_levels:
+        print('Reading representatives...')
+        reps_df = load_representatives(args.domain, cache_dir=args.cache_dir,
+                                       use_cache=not args.no_cache)
+
+        print(f'Counting hits at levels: {", ".join(agg_levels)}')
+        with profiling.stage('count hits', levels=agg_levels):
+            results = count_hits_all_levels(hits, reps_df, agg_levels, args.quantitative)
+
+    if use_clades:
+        tree_fname = args.tree or path.join(GTDB_PATH, TREE_FNAMES[args.domain])
+        print(f'Reading tree {tree_fname}...')
+        with profiling.stage('read tree') as st:
+            tree = load_tree(tree_fname, cache_dir=args.cache_dir, use_cache=not args.no_cache)
+            st.rows = tree.n_nodes
+
+        # Each clade selection is reported like an aggregation level
+        selections = {f'depth{d}': lambda d=d: tree.cut_at_depth(d) for d in args.clade_depth}
+        selections.update({f'distance{d:g}': lambda d=d: tree.cut_at_distance(d)
+                           for d in args.clade_distance})
+        if args.clades:
+            selections['clades'] = lambda: tree.find_taxa(args.clades)
+        for name, select in selections.items():
+            with profiling.stage(f'count hits {name}') as st:
+                clades = select()
+                results[name] = count_hits_clades(hits, tree, clades, args.quantitative)
+                st.rows = len(clades)
+            print(f'Counted hits in {len(clades)} clades for {name}')
+        agg_levels += list(selections)
+
+    intervals = {}
+    if args.resample:
+        # Species are single genomes; there is nothing to resample
+        for agg_level in [l for l in agg_levels if l != 'species']:
+            counts, n_reps = results[agg_level]
+            with profiling.stage(f'resample {agg_level}', rows=counts.size,
+                                 replicates=args.replicates) as st:
+                intervals[agg_level] = resample_fractions(
+                    counts, n_reps, args.resample, args.replicates, args.rarefy_depth,
+                    args.ci, args.seed)
+            print(f'Resampled {agg_level} fractions ({args.resample}, {args.replicates} replicates)')
+
+    if args.counts_out:
+        with profiling.stage('write counts') as st:
+            counts_df = long_counts_table(results, intervals)
+            write_table(counts_df, args.counts_out, index=False)
+            st.rows = len(counts_df)
+        print(f'Counts saved to {args.counts_out}')
+
+    for agg_level in agg_levels:
+        counts, n_reps = results[agg_level]
+        with profiling.stage(f'itol dataset {agg_level}', rows=len(counts)):
+            annotree_counts = itol_values(counts, n_reps, agg_level)
+            out = level_output_path(args.out, agg_level, len(agg_levels))
+            write_itol_dataset(annotree_counts, out, args.plot_type, args.palette,
+                               args.binary_threshold)
+            if agg_level in intervals:
+                write_itol_intervals(counts, intervals[agg_level], out, args.palette)
     
     print('Done!')
+    profiling.finish()
+
+
+# Unit testing
+import unittest
+
+class TestHitCounting(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 200
+        self.reps_df = pd.DataFrame({
+            'phylum': [f'p{i}' for i in rng.integers(0, 4, n)],
+            'class': [f'c{i}' for i in rng.integers(0, 9, n)],
+            'species': [f's{i}' for i in range(n)],
+        }, index=[f'genome{i}' for i in range(n)]).astype('category')
+        # Hits include genomes that are not representatives
+        self.hits = pd.DataFrame(rng.random((n + 20, 3)) < 0.2,
+                                 index=[f'genome{i}' for i in range(n + 20)],
+                                 columns=['f1', 'f2', 'f3'])
+
+    def test_matches_per_function_counts(self):
+        levels = ['species', 'class', 'phylum']
+        results = count_hits_all_levels(self.hits, self.reps_df, levels)
+        packed = count_hits_all_levels(PresenceMatrix.from_dataframe(self.hits),
+                                       self.reps_df, levels)
+        for level in levels:
+            cols = []
+            for c in self.hits.columns:
+                gids = self.hits[self.hits[c] == True].index.to_list()
+                normed = normalize_counts(count_hits(gids, self.reps_df, level), self.reps_df, level)
+                normed.columns = [c]
+                cols.append(normed)
+            # Per-function species counts have different indices; compare sorted
+            expected = pd.concat(cols, axis=1).sort_index()
+            expected.index = expected.index.astype(str)
+
+            counts, n_reps = results[level]
+            values = itol_values(counts, n_reps, level)
+            pd.testing.assert_frame_equal(values, expected, check_dtype=False, check_names=False)
+            pd.testing.assert_frame_equal(packed[level][0], counts)
+
+    def test_clade_counts(self):
+        from gtdb_tree import parse_newick
+        tree = parse_newick('((genome0:1,genome1:1)p__A:1,((genome2:1,genome3:1):1,genome4:1)p__B:1);')
+        clades = tree.cut_at_depth(1)
+        counts, n_leaves = count_hits_clades(self.hits, tree, clades)
+        self.assertEqual(counts.index.tolist(), ['genome0|genome1', 'genome2|genome4'])
+        self.assertEqual(n_leaves.tolist(), [2, 3])
+        expected = [self.hits.loc[['genome0', 'genome1']].sum(),
+                    self.hits.loc[['genome2', 'genome3', 'genome4']].sum()]
+        np.testing.assert_array_equal(counts.to_numpy(), np.array(expected))
+        packed, _ = count_hits_clades(PresenceMatrix.from_dataframe(self.hits), tree, clades)
+        pd.testing.assert_frame_equal(packed, counts)
+
+    def test_quantitative_counts(self):
+        rng = np.random.default_rng(2)
+        copies = pd.DataFrame(rng.poisson(0.5, self.hits.shape), index=self.hits.index,
+                              columns=self.hits.columns)
+        counts, n_reps = count_hits_all_levels(copies, self.reps_df, ['class'],
+                                               quantitative=True)['class']
+        reps_copies = copies.reindex(self.reps_df.index)
+        expected = reps_copies.groupby(self.reps_df['class'], observed=True).sum()
+        np.testing.assert_array_equal(counts.to_numpy(), expected.to_numpy())
+
+        # Without quantitative, counts are presence
+        presence, _ = count_hits_all_levels(copies, self.reps_df, ['class'])['class']
+        expected = (reps_copies > 0).groupby(self.reps_df['class'], observed=True).sum()
+        np.testing.assert_array_equal(presence.to_numpy(), expected.to_numpy())
+
+    def test_resample_fractions(self):
+        counts, n_reps = count_hits_all_levels(self.hits, self.reps_df, ['class'])['class']
+        fractions = counts.div(n_reps, axis=0)
+        boot = resample_fractions(counts, n_reps, 'bootstrap', n_replicates=2000, seed=1,
+                                  max_batch_elements=1000)
+        self.assertLess((boot['mean'] - fractions).abs().max().max(), 0.02)
+        self.assertTrue(((boot['ci_low'] <= fractions) & (fractions <= boot['ci_high'])).all().all())
+        again = resample_fractions(counts, n_reps, 'bootstrap', n_replicates=2000, seed=1)
+        pd.testing.assert_frame_equal(again['ci_high'], boot['ci_high'])
+
+        # Rarefying to a taxon's own size draws all of it: no spread
+        depth = int(n_reps.median())
+        rare = resample_fractions(counts, n_reps, 'rarefy', n_replicates=50, depth=depth)
+        small = n_reps < depth
+        self.assertTrue(rare['mean'][small.to_numpy()].isna().all().all())
+        exact = (n_reps == depth).to_numpy()
+        pd.testing.assert_frame_equal(rare['ci_low'][exact], fractions[exact], check_names=False)
+        pd.testing.assert_frame_equal(rare['ci_high'][exact], fractions[exact], check_names=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+"""Compact genome x gene presence matrix.
+
+Presence/absence of each gene is stored as one bit per genome, packed into
+uint8 words per gene column (np.packbits along the genome axis). Bulk AND/OR/NOT
+and popcount then operate on 8 genomes per byte.
+"""
+
+import numpy as np
+import pandas as pd
+
+from typing import Iterable, Sequence
+
+
+class PresenceMatrix:
+    """
+    Genome x gene presence matrix with bits packed per gene column.
+
+    :param genomes: Genome identifiers (e.g. GTDB accessions), one per row.
+    :param genes: Gene (query) identifiers, one per column.
+    :param bits: uint8 array of shape (n_genes, ceil(n_genomes / 8)) holding the
+        packed columns. Padding bits past the last genome must be zero.
+    """
+    def __init__(self, genomes: Sequence[str], genes: Sequence[str], bits: np.ndarray):
+        self.genomes = np.asarray(genomes, dtype=str)
+        self.genes = np.asarray(genes, dtype=str)
+        self.bits = np.ascontiguousarray(bits, dtype=np.uint8)
+
+        n_bytes = (len(self.genomes) + 7) // 8
+        if self.bits.shape != (len(self.genes), n_bytes):
+            raise ValueError(f"Expected packed bits of shape {(len(self.genes), n_bytes)}, "
+                             f"got {self.bits.shape}")
+
+        self._genome_index = {g: i for i, g in enumerate(self.genomes)}
+        self._gene_index = {g: i for i, g in enumerate(self.genes)}
+        self._bytes_by_genome = None
+
+    @classmethod
+    def from_dense(cls, genomes: Sequence[str], genes: Sequence[str],
+                   dense: np.ndarray) -> 'PresenceMatrix':
+        """Build from a dense boolean array of shape (n_genomes, n_genes)."""
+        dense = np.asarray(dense, dtype=bool).reshape(len(genomes), len(genes))
+        return cls(genomes, genes, np.packbits(dense.T, axis=1))
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'PresenceMatrix':
+        """Build from a DataFrame with genomes as rows and genes as boolean columns."""
+        return cls.from_dense(df.index.astype(str), df.columns.astype(str),
+                              df.to_numpy(dtype=bool))
+
+    @classmethod
+    def from_codes(cls, genome_codes: np.ndarray, gene_codes: np.ndarray,
+                   genomes: Sequence[str], genes: Sequence[str]) -> 'PresenceMatrix':
+        """
+        Build from parallel arrays of integer (genome, gene) codes, one pair per hit.
+
+        Duplicate pairs are fine; presence is set if any hit exists.
+        """
+        n_bytes = (len(genomes) + 7) // 8
+        genome_codes = np.asarray(genome_codes, dtype=np.int64)
+        gene_codes = np.asarray(gene_codes, dtype=np.int64)
+        bits = np.zeros((len(genes), n_bytes), dtype=np.uint8)
+        # Big-endian bit order within each byte to match np.packbits
+        masks = (np.uint8(0x80) >> (genome_codes % 8).astype(np.uint8)).astype(np.uint8)
+        np.bitwise_or.at(bits, (gene_codes, genome_codes // 8), masks)
+        return cls(genomes, genes, bits)
+
+    @property
+    def n_genomes(self) -> int:
+        return len(self.genomes)
+
+    @property
+    def n_genes(self) -> int:
+        return len(self.genes)
+
+    @property
+    def shape(self):
+        return (self.n_genomes, self.n_genes)
+
+    def __contains__(self, gene: str) -> bool:
+        return gene in self._gene_index
+
+    def genome_index(self, genome: str) -> int:
+        """Row index of a genome."""
+        return self._genome_index[genome]
+
+    def gene_index(self, gene: str) -> int:
+        """Column index of a gene."""
+        return self._gene_index[gene]
+
+    def column(self, gene: str) -> np.ndarray:
+        """Packed bits for one gene, or an all-absent column if the gene is unknown."""
+        if gene in self._gene_index:
+            return self.bits[self._gene_index[gene]]
+        return self.empty()
+
+    def dense_column(self, gene: str) -> np.ndarray:
+        """Unpacked boolean presence of one gene across all genomes."""
+        return self.unpack(self.column(gene))
+
+    def genomes_with(self, gene: str) -> np.ndarray:
+        """Identifiers of the genomes in which the gene is present."""
+        return self.genomes[self.dense_column(gene)]
+
+    def empty(self) -> np.ndarray:
+        """Packed all-absent column."""
+        return np.zeros(self.bits.shape[1], dtype=np.uint8)
+
+    def unpack(self, packed: np.ndarray) -> np.ndarray:
+        """Unpack packed column(s) into booleans over the genomes (last axis)."""
+        return np.unpackbits(packed, axis=-1, count=self.n_genomes).astype(bool)
+
+    def pack(self, dense: np.ndarray) -> np.ndarray:
+        """Pack boolean column(s) over the genomes (last axis)."""
+        return np.packbits(np.asarray(dense, dtype=bool), axis=-1)
+
+    # Bulk operations on packed columns
+    @staticmethod
+    def and_(*columns: np.ndarray) -> np.ndarray:
+        return np.bitwise_and.reduce(columns)
+
+    @staticmethod
+    def or_(*columns: np.ndarray) -> np.ndarray:
+        return np.bitwise_or.reduce(columns)
+
+    def not_(self, column: np.ndarray) -> np.ndarray:
+        """Complement a packed column, keeping the padding bits zero."""
+        inverted = ~column
+        n_pad = 8 * inverted.shape[-1] - self.n_genomes
+        if n_pad:
+            inverted[..., -1] &= np.uint8((0xFF << n_pad) & 0xFF)
+        return inverted
+
+    @staticmethod
+    def popcount(column: np.ndarray) -> int:
+        """Number of genomes set in a packed column."""
+        return int(np.bitwise_count(column).sum())
+
+    def counts(self) -> pd.Series:
+        """Number of genomes in which each gene is present."""
+        return pd.Series(np.bitwise_count(self.bits).sum(axis=1, dtype=np.int64),
+                         index=self.genes)
+
+    def select(self, genes: Iterable[str]) -> 'PresenceMatrix':
+        """Sub-matrix with the given genes; unknown genes are all-absent columns."""
+        genes = list(genes)
+        bits = np.stack([self.column(g) for g in genes]) if genes \
+            else np.zeros((0, self.bits.shape[1]), dtype=np.uint8)
+        return PresenceMatrix(self.genomes, genes, bits)
+
+    def with_columns(self, other: 'PresenceMatrix') -> 'PresenceMatrix':
+        """
+        Matrix with the columns of other added, over the same genomes.
+
+        Columns of other named like an existing gene replace it in place; the rest
+        are appended in order, as when assigning DataFrame columns.
+        """
+        if not np.array_equal(self.genomes, other.genomes):
+            raise ValueError("Matrices must have the same genomes in the same order")
+        bits = self.bits.copy()
+        genes = list(self.genes)
+        appended = []
+        for i, gene in enumerate(other.genes):
+            if gene in self._gene_index:
+                bits[self._gene_index[gene]] = other.bits[i]
+            else:
+                genes.append(gene)
+                appended.append(i)
+        return PresenceMatrix(self.genomes, genes, np.concatenate([bits, other.bits[appended]]))
+
+    def dense_rows(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Unpacked presence of the given genomes, shape (len(rows), n_genes).
+
+        :param rows: Genome (row) indices; -1 gives an all-absent genome.
+        """
+        if self._bytes_by_genome is None:
+            # Byte-major copy so each genome's byte is gathered as a contiguous row
+            self._bytes_by_genome = np.ascontiguousarray(self.bits.T)
+        rows = np.asarray(rows, dtype=np.int64)
+        valid = rows >= 0
+        dense = np.zeros((len(rows), self.n_genes), dtype=bool)
+        r = rows[valid]
+        shifts = (7 - r % 8).astype(np.uint8)[:, None]
+        dense[valid] = (self._bytes_by_genome[r // 8] >> shifts) & 1
+        return dense
+
+    def to_dense(self) -> np.ndarray:
+        """Unpacked boolean array of shape (n_genomes, n_genes)."""
+        return self.unpack(self.bits).T
+
+    def to_dataframe(self, index_name: str = 'gtdbId') -> pd.DataFrame:
+        """Boolean DataFrame with genomes as rows and genes as columns."""
+        index = pd.Index(self.genomes, name=index_name)
+        return pd.DataFrame(self.to_dense(), index=index, columns=self.genes)
+
+    def save(self, fname: str) -> None:
+        """Save to a compressed .npz file."""
+        np.savez_compressed(fname, genomes=self.genomes, genes=self.genes, bits=self.bits)
+
+    @classmethod
+    def load(cls, fname: str) -> 'PresenceMatrix':
+        """Load a matrix written by save()."""
+        with np.load(fname) as data:
+            return cls(data['genomes'], data['genes'], data['bits'])
+
+
+# Unit testing
+import unittest
+
+class TestPresenceMatrix(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # 13 genomes so the last byte has padding bits
+        self.df = pd.DataFrame(rng.random((13, 4)) < 0.5,
+                               index=[f"genome{i}" for i in range(13)],
+                               columns=['K1', 'K2', 'K3', 'K4'])
+        self.df.index.name = 'gtdbId'
+        self.pm = PresenceMatrix.from_dataframe(self.df)
+
+    def test_round_trip(self):
+        pd.testing.assert_frame_equal(self.pm.to_dataframe(), self.df)
+        self.assertEqual(self.pm.shape, (13, 4))
+        self.assertEqual(self.pm.genome_index('genome3'), 3)
+        self.assertEqual(self.pm.gene_index('K4'), 3)
+        self.assertEqual(self.pm.counts().tolist(), self.df.sum().tolist())
+
+    def test_bulk_operations(self):
+        a, b = self.pm.column('K1'), self.pm.column('K2')
+        dense_a, dense_b = self.df['K1'].to_numpy(), self.df['K2'].to_numpy()
+        self.assertEqual(self.pm.unpack(PresenceMatrix.and_(a, b)).tolist(), (dense_a & dense_b).tolist())
+        self.assertEqual(self.pm.unpack(PresenceMatrix.or_(a, b)).tolist(), (dense_a | dense_b).tolist())
+        self.assertEqual(self.pm.unpack(self.pm.not_(a)).tolist(), (~dense_a).tolist())
+        self.assertEqual(self.pm.popcount(self.pm.not_(a)), int((~dense_a).sum()))
+        self.assertEqual(self.pm.popcount(self.pm.column('missing')), 0)
+
+    def test_from_codes(self):
+        genome_codes, gene_codes = np.nonzero(self.df.to_numpy())
+        # Duplicate hits do not change presence
+        genome_codes = np.concatenate([genome_codes, genome_codes[:3]])
+        gene_codes = np.concatenate([gene_codes, gene_codes[:3]])
+        pm = PresenceMatrix.from_codes(genome_codes, gene_codes, self.df.index, self.df.columns)
+        np.testing.assert_array_equal(pm.bits, self.pm.bits)
+
+    def test_dense_rows(self):
+        rows = np.array([12, -1, 0, 9])
+        expected = self.df.to_numpy()[rows]
+        expected[1] = False
+        np.testing.assert_array_equal(self.pm.dense_rows(rows), expected)
+
+    def test_with_columns(self):
+        other = PresenceMatrix.from_dataframe(pd.DataFrame({'K5': ~self.df['K2'],
+                                                            'K1': ~self.df['K1']}))
+        expected = self.df.copy()
+        expected['K5'] = ~self.df['K2']
+        expected['K1'] = ~self.df['K1']
+        pd.testing.assert_frame_equal(self.pm.with_columns(other).to_dataframe(), expected)
+
+    def test_save_load(self):
+        import tempfile
+        from os import path
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = path.join(tmpdir, 'presence.npz')
+            self.pm.save(fname)
+            loaded = PresenceMatrix.load(fname)
+        np.testing.assert_array_equal(loaded.bits, self.pm.bits)
+        self.assertEqual(loaded.genomes.tolist(), self.pm.genomes.tolist())
+        self.assertEqual(loaded.genes.tolist(), self.pm.genes.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+"""Per-stage timing and peak-memory instrumentation for the pipeline scripts.
+
+Scripts and the functions they call wrap each phase in stage():
+
+    with profiling.stage('read hits') as st:
+        hits_df = read_all_query_hits(fnames)
+        st.rows = len(hits_df)
+
+Each stage records its wall and CPU time, the number of rows it processed and
+the peak resident memory reached while it ran. Stages may nest; a nested stage
+is named after its parent, e.g. "load metadata/parse taxonomy".
+
+No profiler is active by default, in which case stage() does nothing beyond
+entering a context manager, so library functions are instrumented
+unconditionally. Scripts add --profile_out (write the stages as JSON) and
+--cprofile_out (save cProfile statistics of the slowest top-level stage) with
+add_profile_arguments() and wrap main() between start() and finish().
+
+Peak memory is per stage on Linux, where the kernel's high-water mark can be
+reset (/proc/self/clear_refs). Elsewhere it is the process's peak so far, and
+None on Windows, which lacks the resource module.
+Memory is only measured on the main thread; stages run in worker threads
+record their times only.
+"""
+
+import cProfile
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Unix only (not on Windows); there is then no peak memory figure
+    resource = None
+
+_STATUS_FNAME = '/proc/self/status'
+_CLEAR_REFS_FNAME = '/proc/self/clear_refs'
+
+# The profiler of the running script, if profiling was requested
+_active = None
+
+
+def _max_rss_mb() -> Optional[float]:
+    """Peak resident set size of the process so far, in MB, or None if unknown."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+class _MemoryTracker:
+    """Reads (and where possible resets) the process's resident memory high-water mark."""
+
+    def __init__(self):
+        self.resettable = False
+        try:
+            with open(_CLEAR_REFS_FNAME, 'w') as fh:
+                fh.write('5')
+            self.resettable = self._status_mb('VmHWM') is not None
+        except OSError:
+            pass
+
+    @staticmethod
+    def _status_mb(field: str) -> Optional[float]:
+        try:
+            with open(_STATUS_FNAME) as fh:
+                for line in fh:
+                    if line.startswith(field + ':'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    def peak_mb(self) -> Optional[float]:
+        """High-water mark since the last reset (or process start)."""
+        if self.resettable:
+            return self._status_mb('VmHWM')
+        return _max_rss_mb()
+
+    def current_mb(self) -> Optional[float]:
+        return self._status_mb('VmRSS')
+
+    def reset(self) -> None:
+        if self.resettable:
+            with open(_CLEAR_REFS_FNAME, 'w') as fh:
+                fh.write('5')
+
+
+class Stage:
+    """Measurements of one stage. Set rows and add entries to info while it runs."""
+
+    def __init__(self, name: str, depth: int = 0, rows: Optional[int] = None, **info):
+        self.name = name
+        self.depth = depth
+        self.rows = rows
+        self.info = info
+        self.seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_mb = None
+        self.rss_start_mb = None
+        self.rss_end_mb = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        record = dict(name=self.name, depth=self.depth, seconds=self.seconds,
+                      cpu_seconds=self.cpu_seconds, rows=self.rows)
+        if self.rows is not None and self.seconds:
+            record['rows_per_second'] = self.rows / self.seconds
+        record.update(peak_rss_mb=self.peak_rss_mb, rss_start_mb=self.rss_start_mb,
+                      rss_end_mb=self.rss_end_mb)
+        record.update(self.info)
+        return record
+
+
+class Profiler:
+    """Collects the stages of one script run.
+
+    Args:
+        script (str): name of the script, stored in the report.
+        profile_out (str): JSON file the report is written to by write().
+        cprofile_out (str): if given, each top-level stage runs under cProfile and
+            the statistics of the slowest one are saved to this file.
+    """
+
+    def __init__(self, script: str, profile_out: Optional[str] = None,
+                 cprofile_out: Optional[str] = None):
+        self.script = script
+        self.profile_out = profile_out
+        self.cprofile_out = cprofile_out
+        self.stages: List[Stage] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._memory = _MemoryTracker()
+        self._main_thread = threading.main_thread()
+        self._slowest = None
+        self._started = time.time()
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    def _open_stages(self) -> List[Stage]:
+        if not hasattr(self._local, 'open'):
+            self._local.open = []
+        return self._local.open
+
+    def _fold_peak(self, open_stages: List[Stage]) -> None:
+        """Add the high-water mark since the last reset to every open stage, then reset."""
+        peak = self._memory.peak_mb()
+        for s in open_stages if peak is not None else []:
+            s.peak_rss_mb = peak if s.peak_rss_mb is None else max(s.peak_rss_mb, peak)
+        self._memory.reset()
+
+    @contextmanager
+    def stage(self, name: str, rows: Optional[int] = None, **info):
+        open_stages = self._open_stages()
+        if open_stages:
+            name = f'{open_stages[-1].name}/{name}'
+        record = Stage(name, len(open_stages), rows, **info)
+        with self._lock:
+            self.stages.append(record)
+
+        track_memory = threading.current_thread() is self._main_thread
+        if track_memory:
+            self._fold_peak(open_stages)
+            record.rss_start_mb = self._memory.current_mb()
+
+        profile = None
+        if self.cprofile_out and not open_stages and track_memory:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already running, e.g. python -m cProfile
+                profile = None
+
+        open_stages.append(record)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            record.cpu_seconds = time.process_time() - start_cpu
+            open_stages.pop()
+            if profile is not None:
+                profile.disable()
+                if self._slowest is None or record.seconds > self._slowest[0].seconds:
+                    self._slowest = (record, profile)
+            if track_memory:
+                self._fold_peak(open_stages + [record])
+                record.rss_end_mb = self._memory.current_mb()
+
+    def report(self) -> Dict[str, Any]:
+        """The run's stages and totals as a JSON-serializable dict."""
+        report = dict(
+            script=self.script, argv=sys.argv[1:],
+            started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._started)),
+            seconds=time.perf_counter() - self._start,
+            cpu_seconds=time.process_time() - self._start_cpu,
+            peak_rss_mb=_max_rss_mb(),
+            per_stage_memory=self._memory.resettable,
+            python=platform.python_version(), pid=os.getpid(),
+            stages=[s.as_dict() for s in self.stages])
+        if self._slowest is not None:
+            report['cprofile'] = dict(stage=self._slowest[0].name, file=self.cprofile_out)
+        return report
+
+    def write(self) -> None:
+        """Write the report as JSON and the cProfile statistics, as requested."""
+        if self._slowest is not None:
+            self._slowest[1].dump_stats(self.cprofile_out)
+            print(f'cProfile statistics of stage "{self._slowest[0].name}" '
+                  f'saved to {self.cprofile_out}')
+        if self.profile_out:
+            with open(self.profile_out, 'w') as fh:
+                json.dump(self.report(), fh, indent=2)
+            print(f'Profile saved to {self.profile_out}')
+
+
+@contextmanager
+def stage(name: str, rows: Optional[int] = None, **info):
+    """Record a stage with the active profiler; does nothing if there is none.
+
+    Yields:
+        Stage: set its rows attribute or add to its info dict as the stage runs.
+    """
+    if _active is None:
+        yield Stage(name, rows=rows, **info)
+    else:
+        with _active.stage(name, rows, **info) as record:
+            yield record
+
+
+def add_profile_arguments(parser) -> None:
+    """Add the common profiling options to an argparse parser."""
+    parser.add_argument('--profile_out', '--profile-out', type=str, default=None,
+                        dest='profile_out',
+                        help='Write per-stage timings, row counts and peak memory to this JSON file.')
+    parser.add_argument('--cprofile_out', '--cprofile-out', type=str, default=None,
+                        dest='cprofile_out',
+                        help='Save cProfile statistics of the slowest stage to this file '
+                             '(view with python -m pstats or snakeviz).')
+
+
+def start(script: str, profile_out: Optional[str] = None,
+          cprofile_out: Optional[str] = None) -> Optional[Profiler]:
+    """Start profiling the running script if either output was requested."""
+    global _active
+    _active = None
+    if profile_out or cprofile_out:
+        _active = Profiler(script, profile_out, cprofile_out)
+    return _active
+
+
+def finish() -> None:
+    """Stop profiling and write the requested outputs."""
+    global _active
+    profiler, _active = _active, None
+    if profiler is not None:
+        profiler.write()
+
+
+# Unit testing
+import unittest
+import tempfile
+
+class TestProfiling(unittest.TestCase):
+    def test_inactive_stage_is_noop(self):
+        with stage('work', rows=3) as st:
+            st.rows = 4
+        self.assertIsNone(_active)
+
+    def test_nested_stages_and_report(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out = os.path.join(tmpdir, 'profile.json')
+            pstats_out = os.path.join(tmpdir, 'profile.pstats')
+            start('test', out, pstats_out)
+            with stage('read') as st:
+                st.rows = 10
+                with stage('parse', columns=2):
+                    sum(range(1000))
+            with stage('write', rows=5):
+                pass
+            finish()
+            self.assertIsNone(_active)
+
+            with open(out) as fh:
+                report = json.load(fh)
+            names = [s['name'] for s in report['stages']]
+            self.assertEqual(names, ['read', 'read/parse', 'write'])
+            read, parse, write = report['stages']
+            self.assertEqual(read['rows'], 10)
+            self.assertEqual(parse['depth'], 1)
+            self.assertEqual(parse['columns'], 2)
+            self.assertGreaterEqual(read['seconds'], parse['seconds'])
+            self.assertGreaterEqual(read['peak_rss_mb'], parse['peak_rss_mb'])
+            self.assertIn(report['cprofile']['stage'], ('read', 'write'))
+            self.assertTrue(os.path.exists(pstats_out))
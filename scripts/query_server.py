@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""Local HTTP server answering ad-hoc expression queries over the presence data.
+
+Loads the genome x query presence (and optionally the derived functions of an
+expressions file) and the GTDB taxonomy of the representative genomes once,
+then answers queries such as
+
+    GET /query?expr=K06163 AND K06164 AND NOT K01077&taxon=p__Pseudomonadota&level=class
+
+with the number and fraction of representative genomes with the expression,
+overall and per taxon of the level, as JSON. Expressions use the syntax of
+BooleanExpressionParser; taxon is a name at any level, optionally with its
+GTDB rank prefix (p__, c__, ...) or as level:name.
+
+Presence stays packed in memory, and the taxon of every genome is an integer
+code per level, so a query is one evaluation of the expression over packed
+columns and one bincount. Evaluated expressions are kept in an LRU cache keyed
+on their normalized form (ExpressionGraph.canonical_form), so respellings of
+the same expression (operand order, nesting, parentheses) are not recomputed.
+
+    python scripts/query_server.py --input intermediate/annotree/genes_by_organism.csv \\
+        --expressions data/annotree/annotree_expressions.csv --port 8765
+    curl 'http://127.0.0.1:8765/query?expr=K01077+OR+K01113&level=phylum'
+
+Other endpoints: /genes (queries and functions), /levels, /stats (cache use).
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+from apply_expressions import derive_functions
+from exp_parsing import BooleanExpressionParser, ExpressionGraph
+from gtdb_metadata import FULL_PHYLO_NAMES_DICT, PHYLO_COLNAMES, add_cache_arguments
+from hit_store import HitStore
+from hits2itol import load_representatives
+from presence_matrix import PresenceMatrix
+from table_io import read_table
+
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 4096
+# Rank prefixes of GTDB taxon names, e.g. p__ -> phylum
+RANK_PREFIXES = {f'{prefix}__': level for prefix, level in FULL_PHYLO_NAMES_DICT.items()}
+
+
+class LRUCache:
+    """Thread-safe least recently used cache of at most maxsize entries."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class PresenceIndex:
+    """In-memory presence of the representative genomes, indexed by taxon.
+
+    Args:
+        presence (PresenceMatrix): genomes x genes (queries and functions).
+        reps_df (pd.DataFrame): taxonomy of the representative genomes, indexed
+            by accession, with one column per level. Queries count over these
+            genomes; genomes without hits lack every gene.
+        cache_size (int): number of evaluated expressions kept.
+    """
+
+    def __init__(self, presence: PresenceMatrix, reps_df: pd.DataFrame,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        rows = pd.Index(presence.genomes).get_indexer(reps_df.index)
+        self.presence = PresenceMatrix.from_dense(reps_df.index.astype(str), presence.genes,
+                                                  presence.dense_rows(rows))
+        self.levels = [level for level in PHYLO_COLNAMES if level in reps_df and level != 'domain']
+        self.codes = {}
+        self.taxa = {}
+        for level in self.levels:
+            codes, taxa = pd.factorize(reps_df[level].astype(str).where(reps_df[level].notna()))
+            self.codes[level] = codes
+            self.taxa[level] = pd.Index(taxa)
+        self.parser = BooleanExpressionParser()
+        self.graphs = LRUCache(cache_size)
+        self.columns = LRUCache(cache_size)
+        self.results = LRUCache(cache_size)
+
+    def resolve_taxon(self, taxon: str):
+        """(level, name) of a taxon given as name, p__name or level:name."""
+        level = None
+        if ':' in taxon:
+            level, taxon = taxon.split(':', 1)
+        elif taxon[:3] in RANK_PREFIXES:
+            level, taxon = RANK_PREFIXES[taxon[:3]], taxon[3:]
+        for candidate in ([level] if level else self.levels):
+            if candidate in self.taxa and taxon in self.taxa[candidate]:
+                return candidate, taxon
+        raise ValueError(f"Unknown taxon: {taxon}" + (f" at level {level}" if level else ''))
+
+    def evaluate(self, expression: str):
+        """Normalized form and packed column of an expression, through the cache."""
+        graph = self.graphs.get(expression)
+        if graph is None:
+            # Parsing dominates the time of cached queries, so parsed text is kept too
+            graph = ExpressionGraph({'query': expression}, parser=self.parser)
+            self.graphs.put(expression, graph)
+        normalized = graph.canonical_form('query')
+        column = self.columns.get(normalized)
+        cached = column is not None
+        if not cached:
+            column = graph.evaluate(self.presence, functions=['query']).bits[0]
+            self.columns.put(normalized, column)
+        undefined = graph.undefined_names(self.presence.genes)
+        return normalized, column, cached, undefined
+
+    def query(self, expression: str, taxon: Optional[str] = None,
+              level: Optional[str] = None) -> Dict[str, Any]:
+        """Genomes with the expression, overall and per taxon of a level.
+
+        Args:
+            expression (str): boolean expression over genes and functions.
+            taxon (str): only count genomes of this taxon.
+            level (str): also count per taxon of this level.
+
+        Returns:
+            dict: JSON-serializable counts and fractions.
+        """
+        start = time.perf_counter()
+        if level is not None and level not in self.levels:
+            raise ValueError(f"Unknown level: {level}; one of {', '.join(self.levels)}")
+        normalized, column, cached, undefined = self.evaluate(expression)
+        taxon_key = self.resolve_taxon(taxon) if taxon else None
+
+        key = (normalized, taxon_key, level)
+        result = self.results.get(key)
+        if result is None:
+            present = self.presence.unpack(column)
+            selected = np.ones(len(present), dtype=bool)
+            if taxon_key:
+                taxon_level, name = taxon_key
+                selected = self.codes[taxon_level] == self.taxa[taxon_level].get_loc(name)
+            n_genomes = int(selected.sum())
+            n_with = int((present & selected).sum())
+            result = dict(normalized=normalized, n_genomes=n_genomes, n_with=n_with,
+                          fraction=n_with / n_genomes if n_genomes else None)
+            if taxon_key:
+                result['taxon'] = dict(level=taxon_key[0], name=taxon_key[1])
+            if level is not None:
+                codes = self.codes[level]
+                keep = selected & (codes >= 0)
+                sizes = np.bincount(codes[keep], minlength=len(self.taxa[level]))
+                counts = np.bincount(codes[keep & present], minlength=len(self.taxa[level]))
+                result['level'] = level
+                result['groups'] = [
+                    dict(taxon=name, n_genomes=int(n), n_with=int(k), fraction=float(k / n))
+                    for name, n, k in zip(self.taxa[level], sizes, counts) if n]
+            self.results.put(key, result)
+        else:
+            cached = True
+        return dict(result, expression=expression, undefined=undefined, cached=cached,
+                    milliseconds=(time.perf_counter() - start) * 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(genomes=self.presence.n_genomes, genes=self.presence.n_genes,
+                    cached_expressions=len(self.columns), cached_results=len(self.results),
+                    expression_hits=self.columns.hits, expression_misses=self.columns.misses,
+                    result_hits=self.results.hits, result_misses=self.results.misses)
+
+
+def _is_client_error(error: Exception) -> bool:
+    """Whether an error is due to the request: a malformed expression, or an
+    unknown taxon or level (ValueError)."""
+    # Expressions are parsed by pyparsing, imported on first use
+    pyparsing = sys.modules.get('pyparsing')
+    return isinstance(error, ValueError) or (
+        pyparsing is not None and isinstance(error, pyparsing.ParseBaseException))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """GET endpoints over the server's PresenceIndex."""
+
+    def _send(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        index = self.server.index
+        try:
+            if url.path == '/query':
+                if 'expr' not in params:
+                    raise ValueError("Missing expr parameter")
+                self._send(200, index.query(params['expr'], params.get('taxon'), params.get('level')))
+            elif url.path == '/genes':
+                self._send(200, dict(genes=index.presence.genes.tolist()))
+            elif url.path == '/levels':
+                self._send(200, dict(levels=index.levels))
+            elif url.path == '/stats':
+                self._send(200, index.stats())
+            else:
+                self._send(404, dict(error=f"Unknown path: {url.path}"))
+        except Exception as e:
+            if _is_client_error(e):
+                self._send(400, dict(error=f'{type(e).__name__}: {e}'))
+            else:
+                # A bug in the server: log it and report it as such
+                traceback.print_exc()
+                self._send(500, dict(error=f'{type(e).__name__}: {e}'))
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(index: PresenceIndex, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                quiet: bool = False) -> ThreadingHTTPServer:
+    """HTTP server answering queries over index; call serve_forever() to run it."""
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.index = index
+    server.quiet = quiet
+    return server
+
+
+def load_presence(fname: str) -> PresenceMatrix:
+    """Presence from a table, a packed matrix (.npz) or a hit store directory."""
+    if HitStore.is_store(fname):
+        return HitStore(fname).presence()
+    if fname.endswith('.npz'):
+        return PresenceMatrix.load(fname)
+    return PresenceMatrix.from_dataframe(read_table(fname, index_col=0).dropna(how='all') == True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', '-i', type=str, required=True,
+                        help='Genomes x queries presence: a table indexed by gtdbId, a packed '
+                             'presence matrix (.npz) or a hit store directory.')
+    parser.add_argument('--expressions', type=str, default=None,
+                        help='Expressions file whose functions can be used by name in queries.')
+    parser.add_argument('-d', '--domain', type=str, default='bacteria',
+                        help='Domain of the GTDB representative genomes counted over.',
+                        choices=('bacteria', 'archaea'))
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on.')
+    parser.add_argument('--cache_size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='Number of evaluated expressions (and of results) kept in memory.')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Do not log requests.')
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    print(f'Loading presence from {args.input}...')
+    presence = load_presence(args.input)
+    if args.expressions:
+        expressions_df = pd.read_csv(args.expressions, index_col=0).dropna(how='all')
+        presence = derive_functions(presence, expressions_df)
+    print('Reading representatives...')
+    reps_df = load_representatives(args.domain, cache_dir=args.cache_dir,
+                                   use_cache=not args.no_cache)
+    index = PresenceIndex(presence, reps_df, args.cache_size)
+    print(f'Indexed {index.presence.n_genes} genes and functions over '
+          f'{index.presence.n_genomes} representative genomes')
+
+    server = make_server(index, args.host, args.port, args.quiet)
+    print(f'Serving on http://{args.host}:{server.server_address[1]}/query?expr=...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Unit testing
+import unittest
+
+class TestQueryServer(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 120
+        self.reps_df = pd.DataFrame({
+            'phylum': [f'P{i}' for i in rng.integers(0, 3, n)],
+            'class': [f'C{i}' for i in rng.integers(0, 6, n)],
+        }, index=[f'genome{i}' for i in range(n)]).astype('category')
+        # Hits include a genome that is not a representative
+        self.df = pd.DataFrame(rng.random((n + 1, 3)) < 0.5, columns=['K1', 'K2', 'K3'],
+                               index=[f'genome{i}' for i in range(1, n + 1)] + ['other'])
+        self.index = PresenceIndex(PresenceMatrix.from_dataframe(self.df), self.reps_df)
+
+    def test_query(self):
+        result = self.index.query('K1 AND NOT (K3 OR K2)', taxon='p__P1', level='class')
+        df = self.df.reindex(self.reps_df.index, fill_value=False)
+        present = df['K1'] & ~(df['K2'] | df['K3'])
+        in_taxon = self.reps_df['phylum'] == 'P1'
+        self.assertEqual(result['n_genomes'], in_taxon.sum())
+        self.assertEqual(result['n_with'], (present & in_taxon).sum())
+        for group in result['groups']:
+            members = in_taxon & (self.reps_df['class'] == group['taxon'])
+            self.assertEqual((group['n_genomes'], group['n_with']),
+                             (members.sum(), (present & members).sum()))
+        self.assertFalse(result['cached'])
+
+        # A respelling of the same expression is served from the cache
+        again = self.index.query('NOT (K2 OR K3) AND K1', taxon='phylum:P1', level='class')
+        self.assertTrue(again['cached'])
+        self.assertEqual(again['groups'], result['groups'])
+        with self.assertRaises(ValueError):
+            self.index.query('K1', taxon='p__missing')
+
+    def test_http(self):
+        from urllib.error import HTTPError
+        from urllib.request import urlopen
+
+        server = make_server(self.index, port=0, quiet=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}'
+            with urlopen(f'{url}/query?expr=K1+OR+K2&level=phylum') as response:
+                body = json.load(response)
+            self.assertEqual(body['n_genomes'], len(self.reps_df))
+            self.assertEqual(len(body['groups']), 3)
+            with self.assertRaises(HTTPError) as error:
+                urlopen(f'{url}/query?expr=K1+AND')
+            self.assertEqual(error.exception.code, 400)
+
+            # Failures of the server itself are not the client's
+            self.index.query = lambda *args: 1 / 0
+            with self.assertRaises(HTTPError) as error:
+                urlopen(f'{url}/query?expr=K1')
+            self.assertEqual(error.exception.code, 500)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
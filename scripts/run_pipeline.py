@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""Run the AnnoTree pipeline in one process.
+
+manifest -> presence matrix -> derived functions -> iTOL datasets per nutrient
+
+Equivalent to running tabulate_genes_by_organism.py, apply_expressions.py and
+hits2itol.py (once per nutrient) in sequence, but the data stays in memory as a
+packed presence matrix between stages: every input is read once and nothing is
+written and parsed again. With --intermediate_dir the tables the separate
+scripts produce are written as well, and --stats_out adds the representative
+genome counts of gtdb2stats.py --representatives_only.
+"""
+
+import argparse
+import os
+import pandas as pd
+import profiling
+
+from os import path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from apply_expressions import derive_functions, display_functions, write_functional_results
+from gtdb2stats import metadata_phylogeny_counts
+from gtdb_metadata import add_cache_arguments
+from hits2itol import (
+    AGG_LEVELS, GTDB_PATH, count_hits_all_levels, itol_values, load_representatives,
+    write_itol_dataset
+)
+from presence_matrix import PresenceMatrix
+from profiling import add_profile_arguments
+from stage_cache import StageCache, add_stage_cache_arguments, open_stage_cache
+from table_io import TABLE_EXTENSIONS, add_format_argument, write_table
+from tabulate_genes_by_organism import (
+    ANNOTREE_DIR, HIT_COLUMNS, presence_from_hits, read_manifest, read_manifest_hits,
+    report_duplicates, write_gene_tables
+)
+
+# Short domain names used in the iTOL dataset file names
+DOMAIN_PREFIXES = {'bacteria': 'bac', 'archaea': 'arc'}
+DEFAULT_OUT_PATTERN = 'itol_{domain}_{nutrient}_{agg_level}.txt'
+
+
+class PipelineResults(NamedTuple):
+    """In-memory outputs of run_pipeline()."""
+    # Long table of AnnoTree hits (gtdbId, geneId, SearchId)
+    hits: pd.DataFrame
+    # Genomes x queries presence
+    presence: PresenceMatrix
+    # Genomes x (queries and derived functions) presence
+    gene_data: PresenceMatrix
+    # Displayed functions of each nutrient
+    nutrient_functions: Dict[str, List[str]]
+    # Level -> (taxa x displayed functions counts, representatives per taxon)
+    counts: Dict[str, Tuple[pd.DataFrame, pd.Series]]
+
+
+def run_pipeline(manifest: pd.DataFrame, expressions_df: pd.DataFrame, reps_df: pd.DataFrame,
+                 agg_levels: Sequence[str] = ('phylum',), n_workers: int = 8,
+                 cache: Optional[StageCache] = None,
+                 hit_columns: Optional[Sequence[str]] = HIT_COLUMNS) -> PipelineResults:
+    """Tabulate hits, apply the expressions and count hits of the displayed functions.
+
+    Args:
+        manifest (pd.DataFrame): AnnoTree manifest from read_manifest().
+        expressions_df (pd.DataFrame): expressions indexed by function name, with
+            nutrient, for_display and boolean_expression columns.
+        reps_df (pd.DataFrame): representative genome taxonomy indexed by accession,
+            from load_representatives().
+        agg_levels (list): aggregation levels, keys of AGG_LEVELS.
+        n_workers (int): number of hit files read in parallel.
+        cache (StageCache): if given, unchanged hit files and function columns
+            are read from it.
+        hit_columns (list): columns of the hit files to read; None for all of
+            them, as needed to write the long tables of write_intermediates().
+
+    Returns:
+        PipelineResults
+    """
+    hits_df = read_manifest_hits(manifest, n_workers, cache, hit_columns)
+    with profiling.stage('build presence', rows=len(hits_df)) as st:
+        presence = presence_from_hits(hits_df)
+        st.info.update(genomes=presence.n_genomes, queries=presence.n_genes)
+
+    gene_data = derive_functions(presence, expressions_df, cache=cache)
+
+    nutrient_functions = display_functions(expressions_df)
+    displayed = list(dict.fromkeys(f for fs in nutrient_functions.values() for f in fs))
+    # One count for all nutrients; each nutrient's dataset is a column subset
+    with profiling.stage('count hits', levels=list(agg_levels)):
+        counts = count_hits_all_levels(gene_data.select(displayed), reps_df, list(agg_levels))
+    return PipelineResults(hits_df, presence, gene_data, nutrient_functions, counts)
+
+
+def nutrient_itol_values(results: PipelineResults, nutrient: str, agg_level: str) -> pd.DataFrame:
+    """Values to plot for one nutrient at one level, as hits2itol computes them
+    from that nutrient's functional results."""
+    counts, n_reps = results.counts[agg_level]
+    return itol_values(counts[results.nutrient_functions[nutrient]], n_reps, agg_level)
+
+
+def write_intermediates(results: PipelineResults, manifest: pd.DataFrame,
+                        expressions_df: pd.DataFrame, outdir: str, table_format: str = 'csv'):
+    """Write the tables of tabulate_genes_by_organism.py and apply_expressions.py."""
+    os.makedirs(outdir, exist_ok=True)
+    ext = TABLE_EXTENSIONS[table_format]
+    report_duplicates(results.hits, manifest, outdir)
+    write_gene_tables(results.hits, results.presence, path.join(outdir, f'genes_long{ext}'),
+                      path.join(outdir, f'genes_by_organism{ext}'), table_format)
+    write_functional_results(results.gene_data.to_dataframe(), expressions_df, outdir,
+                             table_format)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--manifest', type=str, default=path.join(ANNOTREE_DIR, 'annotree_manifest.csv'),
+                        help='Path to the annotree manifest file.')
+    parser.add_argument('--annotree_dir', type=str, default=ANNOTREE_DIR,
+                        help='Directory of the per-query annotree hit files.')
+    parser.add_argument('--expressions', type=str,
+                        default=path.join(ANNOTREE_DIR, 'annotree_expressions.csv'),
+                        help='Path to the file containing boolean expressions.')
+    parser.add_argument('--outdir', type=str, default='output',
+                        help='Directory for the iTOL datasets.')
+    parser.add_argument('--out_pattern', type=str, default=DEFAULT_OUT_PATTERN,
+                        help='File name of each iTOL dataset, formatted with domain, nutrient '
+                             'and agg_level.')
+    parser.add_argument('--intermediate_dir', type=str, default=None,
+                        help='Also write the intermediate tables of the separate scripts here.')
+    parser.add_argument('--stats_out', type=str, default=None,
+                        help='Also write representative genome counts per phylogenetic level, '
+                             'as gtdb2stats.py --representatives_only.')
+    parser.add_argument('-d', '--domain', type=str, default='bacteria',
+                        help='Domain to use for GTDB representative genomes.',
+                        choices=tuple(DOMAIN_PREFIXES))
+    parser.add_argument('--gtdb_dir', type=str, default=GTDB_PATH,
+                        help='Directory of the GTDB metadata files.')
+    parser.add_argument('--agg_level', '-a', type=str, default=['phylum'], nargs='+',
+                        help='Aggregation level(s) for annotree hits.',
+                        choices=list(AGG_LEVELS))
+    parser.add_argument('--plot_type', '-t', type=str, default='heatmap',
+                        help='iTOL plot type.',
+                        choices=('bar', 'binary', 'heatmap'))
+    parser.add_argument('--palette', '-p', type=str, default='tab10',
+                        help='Seaborn palette name for colors.')
+    parser.add_argument('--binary_threshold', '-b', type=float, default=0.5,
+                        help='Threshold for binarizing counts or normalized counts.')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of per-query files to read in parallel.')
+    add_format_argument(parser, default='csv')
+    add_cache_arguments(parser)
+    add_stage_cache_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    profiling.start('run_pipeline', args.profile_out, args.cprofile_out)
+
+    use_cache = not args.no_cache
+    reps_df = load_representatives(args.domain, args.gtdb_dir, args.cache_dir, use_cache)
+    manifest = read_manifest(args.manifest, args.annotree_dir)
+    expressions_df = pd.read_csv(args.expressions, index_col=0).dropna(how='all')
+
+    agg_levels = list(dict.fromkeys(args.agg_level))
+    # The long tables of the intermediates keep every column of the hit files
+    results = run_pipeline(manifest, expressions_df, reps_df, agg_levels, args.workers,
+                           open_stage_cache(args),
+                           hit_columns=None if args.intermediate_dir else HIT_COLUMNS)
+
+    if args.intermediate_dir:
+        write_intermediates(results, manifest, expressions_df, args.intermediate_dir,
+                            args.table_format)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    for nutrient in results.nutrient_functions:
+        for agg_level in agg_levels:
+            out = path.join(args.outdir, args.out_pattern.format(
+                domain=DOMAIN_PREFIXES[args.domain], nutrient=nutrient, agg_level=agg_level))
+            with profiling.stage(f'itol dataset {nutrient} {agg_level}'):
+                write_itol_dataset(nutrient_itol_values(results, nutrient, agg_level), out,
+                                   args.plot_type, args.palette, args.binary_threshold)
+            print(f'iTOL dataset saved to {out}')
+
+    if args.stats_out:
+        # Representatives of the plotted domain are already loaded
+        all_counts = []
+        for domain in ('bacteria', 'archaea'):
+            domain_reps = reps_df if domain == args.domain else \
+                load_representatives(domain, args.gtdb_dir, args.cache_dir, use_cache)
+            with profiling.stage('count phylogeny levels', rows=len(domain_reps), domain=domain):
+                all_counts.append(metadata_phylogeny_counts(domain_reps))
+        write_table(pd.concat(all_counts, axis=0), args.stats_out, args.table_format, index=False)
+        print(f'Summary statistics saved to {args.stats_out}')
+
+    print('Done!')
+    profiling.finish()
+
+
+# Unit testing
+import unittest
+import numpy as np
+
+class TestPipeline(unittest.TestCase):
+    def test_matches_separate_stages(self):
+        import tempfile
+        from hits2itol import count_hits, normalize_counts
+
+        rng = np.random.default_rng(0)
+        genomes = [f'genome{i}' for i in range(60)]
+        reps_df = pd.DataFrame({
+            'phylum': [f'p{i}' for i in rng.integers(0, 3, len(genomes))],
+            'species': [f's{i}' for i in range(len(genomes))],
+        }, index=genomes).astype('category')
+        expressions_df = pd.DataFrame({
+            'nutrient': ['P', 'P', 'N'],
+            'for_display': [True, True, True],
+            'boolean_expression': ['K1 AND K2', 'K1 OR NOT K3', 'f1 OR K3'],
+        }, index=pd.Index(['f1', 'f2', 'f3'], name='name'))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest_fname = path.join(tmpdir, 'manifest.csv')
+            pd.DataFrame({'name': ['K1', 'K2', 'K3'], 'function': 'x'}).to_csv(manifest_fname, index=False)
+            for q in ['K1', 'K2', 'K3']:
+                hit_genomes = rng.choice(genomes, 25)
+                pd.DataFrame({'gtdbId': hit_genomes, 'geneId': [f'{q}_{i}' for i in range(25)],
+                              'SearchId': q}).to_csv(path.join(tmpdir, f'{q}_bacteria.csv'), index=False)
+            manifest = read_manifest(manifest_fname, tmpdir)
+            results = run_pipeline(manifest, expressions_df, reps_df, ['phylum', 'species'], n_workers=2)
+
+        wide_df = results.presence.to_dataframe()
+        gene_data_df = derive_functions(wide_df, expressions_df)
+        for nutrient, functions in results.nutrient_functions.items():
+            for level in ['phylum', 'species']:
+                cols = []
+                for c in functions:
+                    gids = gene_data_df[gene_data_df[c] == True].index.to_list()
+                    normed = normalize_counts(count_hits(gids, reps_df, level), reps_df, level)
+                    normed.columns = [c]
+                    cols.append(normed)
+                expected = pd.concat(cols, axis=1).sort_index()
+                expected.index = expected.index.astype(str)
+                pd.testing.assert_frame_equal(nutrient_itol_values(results, nutrient, level),
+                                              expected, check_dtype=False, check_names=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Content-addressed cache of pipeline results, with LRU eviction.
+
+Snakemake re-runs a rule when any input file changes, so editing one expression
+re-evaluates all of them and adding one query re-reads every hit file. With a
+stage cache the scripts look up each result by a key derived from exactly what
+it depends on, and only recompute entries whose key changed:
+
+    - parsed hits of a per-query file: the SHA-256 of the file
+      (tabulate_genes_by_organism.py, run_pipeline.py)
+    - a derived function column: the normalized expression with the hash of
+      every input column it references, and the genomes it is over
+      (apply_expressions.py, run_pipeline.py)
+
+Entries are files named by kind and key in one directory. Reading an entry
+touches its modification time, and when the cache grows past its size limit the
+least recently used entries are removed, so the limit holds across runs and
+processes sharing the directory.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from os import path
+from typing import Iterable, Optional
+
+# Bump when the cached entry formats change; part of every key
+STAGE_CACHE_VERSION = 1
+# Extensions of cached entries. Other files in the directory (e.g. the file
+# hash index of gtdb_metadata.file_sha256s) are neither counted nor evicted
+ENTRY_EXTENSIONS = ('.npy', '.pkl')
+DEFAULT_MAX_MB = 2048
+
+
+def hash_bytes(*parts) -> str:
+    """SHA-256 of the parts (bytes, str or arrays), separated so that their
+    boundaries are part of the hash."""
+    digest = hashlib.sha256(f'v{STAGE_CACHE_VERSION}'.encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part).tobytes()
+        elif isinstance(part, str):
+            part = part.encode()
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def hash_strings(values: Iterable[str]) -> str:
+    """SHA-256 of a sequence of strings, e.g. the genomes of a matrix."""
+    return hash_bytes('\n'.join(values))
+
+
+class StageCache:
+    """
+    Directory of cached arrays and tables keyed by content hashes.
+
+    :param cache_dir: Cache directory; created if needed.
+    :param max_mb: Size limit in MB. Least recently used entries are removed
+        when a write takes the cache over it.
+    """
+    def __init__(self, cache_dir: str, max_mb: float = DEFAULT_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _fname(self, kind: str, key: str, ext: str) -> str:
+        return path.join(self.cache_dir, f'{kind}-{key}{ext}')
+
+    def _entries(self):
+        """(path, size, last use) of every entry."""
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.startswith('.') \
+                    and entry.name.endswith(ENTRY_EXTENSIONS):
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime_ns
+
+    def size_bytes(self) -> int:
+        """Total size of the cached entries."""
+        return sum(size for _, size, _ in self._entries())
+
+    def _lookup(self, fname: str) -> bool:
+        if not path.exists(fname):
+            self.misses += 1
+            return False
+        try:
+            # Mark as recently used
+            os.utime(fname)
+        except OSError:
+            pass
+        self.hits += 1
+        return True
+
+    def _store(self, fname: str, write) -> None:
+        # Write to a temporary file and rename, so readers never see partial entries
+        fd, tmp_fname = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                write(fh)
+            os.replace(tmp_fname, fname)
+        except BaseException:
+            if path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+        if self._size is None:
+            self._size = self.size_bytes()
+        else:
+            self._size += path.getsize(fname)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """Remove least recently used entries until the cache fits max_bytes
+        (default the size limit). Returns the number of entries removed."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for fname, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self._size = total
+        return removed
+
+    def get_array(self, kind: str, key: str) -> Optional[np.ndarray]:
+        """Cached array, or None."""
+        fname = self._fname(kind, key, '.npy')
+        return np.load(fname) if self._lookup(fname) else None
+
+    def put_array(self, kind: str, key: str, array: np.ndarray) -> None:
+        self._store(self._fname(kind, key, '.npy'), lambda fh: np.save(fh, array))
+
+    def get_frame(self, kind: str, key: str) -> Optional[pd.DataFrame]:
+        """Cached DataFrame, or None."""
+        fname = self._fname(kind, key, '.pkl')
+        return pd.read_pickle(fname) if self._lookup(fname) else None
+
+    def put_frame(self, kind: str, key: str, df: pd.DataFrame) -> None:
+        self._store(self._fname(kind, key, '.pkl'), lambda fh: df.to_pickle(fh))
+
+    def summary(self) -> str:
+        return f'{self.hits} cached, {self.misses} computed'
+
+
+def add_stage_cache_arguments(parser) -> None:
+    """Add the stage cache options to an argparse parser."""
+    parser.add_argument('--stage_cache', type=str, default=None,
+                        help='Directory of the stage cache. Results whose inputs are unchanged '
+                             'are read from it instead of recomputed. Off by default.')
+    parser.add_argument('--stage_cache_max_mb', type=float, default=DEFAULT_MAX_MB,
+                        help='Size limit of the stage cache in MB; least recently used '
+                             'entries are removed beyond it.')
+
+
+def open_stage_cache(args) -> Optional[StageCache]:
+    """The stage cache requested on the command line, if any."""
+    if not args.stage_cache:
+        return None
+    return StageCache(args.stage_cache, args.stage_cache_max_mb)
+
+
+# Unit testing
+import unittest
+
+class TestStageCache(unittest.TestCase):
+    def test_round_trip_and_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = StageCache(tmpdir, max_mb=1)
+            self.assertIsNone(cache.get_array('column', 'a'))
+            array = np.arange(50_000, dtype=np.int64)  # 400 kB
+            cache.put_array('column', 'a', array)
+            np.testing.assert_array_equal(cache.get_array('column', 'a'), array)
+            df = pd.DataFrame({'x': ['u', 'v']})
+            cache.put_frame('hits', 'b', df)
+            pd.testing.assert_frame_equal(cache.get_frame('hits', 'b'), df)
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+            # 'a' is used after 'b', so 'b' is evicted first; then 'a' as well
+            os.utime(cache._fname('hits', 'b', '.pkl'), ns=(0, 0))
+            cache.get_array('column', 'a')
+            cache.put_array('column', 'c', array)
+            cache.put_array('column', 'd', array)
+            self.assertLessEqual(cache.size_bytes(), cache.max_bytes)
+            self.assertIsNone(cache.get_frame('hits', 'b'))
+            self.assertIsNotNone(cache.get_array('column', 'd'))
+
+            # Files that are not entries are kept
+            with open(path.join(tmpdir, 'file_hashes.json'), 'w') as fh:
+                fh.write('{}')
+            cache.evict(0)
+            self.assertEqual(os.listdir(tmpdir), ['file_hashes.json'])
+
+    def test_hash_bytes(self):
+        self.assertNotEqual(hash_bytes('ab', 'c'), hash_bytes('a', 'bc'))
+        self.assertEqual(hash_bytes(np.array([1, 2], dtype=np.uint8)), hash_bytes(b'\x01\x02'))
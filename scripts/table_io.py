@@ -0,0 +1,152 @@
+"""Reading and writing the tabular intermediates passed between pipeline stages.
+
+CSV is the default and export format. Columnar formats avoid re-parsing text
+between stages and let readers load only the columns they need:
+
+- parquet: compressed, typed columns (requires pyarrow)
+- feather: Arrow IPC, memory-mapped on read (requires pyarrow)
+
+Readers detect the format from the file contents, so a stage can consume any of
+them regardless of file extension.
+"""
+
+import pandas as pd
+
+from os import path
+from typing import List, Optional, Sequence, Union
+
+TABLE_FORMATS = ('csv', 'parquet', 'feather')
+TABLE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+# File signatures of the binary formats
+_MAGIC_BYTES = {b'PAR1': 'parquet', b'ARROW1': 'feather'}
+
+# String columns with at most this fraction of distinct values are stored as categoricals
+CATEGORICAL_MAX_FRACTION = 0.5
+
+
+def add_format_argument(parser, default: Optional[str] = None) -> None:
+    """Add the common --format option to an argparse parser."""
+    parser.add_argument('--format', type=str, default=default, choices=TABLE_FORMATS,
+                        dest='table_format',
+                        help='Format for output tables. Default is to infer from the output '
+                             'file extension, falling back to csv.')
+
+
+def infer_format(fname: str, table_format: Optional[str] = None) -> str:
+    """Format to write fname in: the explicit format if given, else from its extension."""
+    if table_format is not None:
+        return table_format
+    ext = path.splitext(fname)[1].lower()
+    for fmt, fmt_ext in TABLE_EXTENSIONS.items():
+        if ext == fmt_ext:
+            return fmt
+    return 'csv'
+
+
+def detect_format(fname: str) -> str:
+    """Format of an existing table file, from its leading bytes."""
+    with open(fname, 'rb') as fh:
+        head = fh.read(8)
+    for magic, fmt in _MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return fmt
+    return 'csv'
+
+
+def categorize(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert repetitive string columns to categoricals."""
+    df = df.copy()
+    for col in df.columns:
+        series = df[col]
+        if series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+            if len(series) and series.nunique() <= CATEGORICAL_MAX_FRACTION * len(series):
+                df[col] = series.astype('category')
+    return df
+
+
+def write_table(df: pd.DataFrame, fname: str, table_format: Optional[str] = None,
+                index: bool = True) -> None:
+    """
+    Write a DataFrame in the requested (or extension-inferred) format.
+
+    :param df: DataFrame to write.
+    :param fname: Output file path.
+    :param table_format: One of TABLE_FORMATS, or None to infer from fname.
+    :param index: Whether to store the DataFrame index.
+    """
+    fmt = infer_format(fname, table_format)
+    if fmt == 'csv':
+        df.to_csv(fname, index=index)
+        return
+
+    out_df = categorize(df)
+    if fmt == 'parquet':
+        out_df.to_parquet(fname, index=index)
+    else:
+        # Feather cannot store an index; keep it as a regular column instead
+        if index:
+            out_df = out_df.reset_index()
+        else:
+            out_df = out_df.reset_index(drop=True)
+        out_df.to_feather(fname)
+
+
+def table_columns(fname: str) -> List[str]:
+    """Column names stored in a table file, without reading its data."""
+    fmt = detect_format(fname)
+    if fmt == 'csv':
+        return pd.read_csv(fname, nrows=0).columns.tolist()
+
+    import pyarrow.parquet as pq
+    import pyarrow.ipc as ipc
+    if fmt == 'parquet':
+        # List a stored index first, where it would be in a CSV written with the index
+        schema = pq.read_schema(fname)
+        meta = schema.pandas_metadata or {}
+        index_names = [c for c in meta.get('index_columns', []) if isinstance(c, str)]
+        return index_names + [n for n in schema.names if n not in index_names]
+    with ipc.open_file(fname) as reader:
+        return reader.schema.names
+
+
+def read_table(fname: str, index_col: Optional[Union[str, int]] = None,
+               columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    Read a table written by write_table() (or any CSV).
+
+    :param fname: Path of the table.
+    :param index_col: Column to use as the index, by name or position.
+    :param columns: If given, load only these columns (plus the index column).
+    :return: The DataFrame.
+    """
+    fmt = detect_format(fname)
+    if fmt == 'csv':
+        if columns is None:
+            return pd.read_csv(fname, index_col=index_col)
+        header = pd.read_csv(fname, nrows=0).columns
+        if isinstance(index_col, int):
+            index_col = header[index_col]
+        usecols = list(columns)
+        if index_col is not None and index_col not in usecols:
+            usecols = [index_col] + usecols
+        return pd.read_csv(fname, usecols=usecols, index_col=index_col)[list(columns)]
+
+    names = table_columns(fname)
+    index_name = names[index_col] if isinstance(index_col, int) else index_col
+    load_cols = None
+    if columns is not None:
+        load_cols = list(columns)
+        if index_name is not None and index_name not in load_cols:
+            load_cols = [index_name] + load_cols
+
+    if fmt == 'parquet':
+        df = pd.read_parquet(fname, columns=load_cols)
+    else:
+        import pyarrow.feather as feather
+        df = feather.read_table(fname, columns=load_cols, memory_map=True).to_pandas()
+
+    # Parquet restores a stored index by itself
+    if index_name is not None and df.index.name != index_name:
+        df = df.set_index(index_name)
+    return df
@@ -1,41 +1,127 @@
+import numpy as np
 import pandas as pd
 import argparse
 import os
+import profiling
 
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+from gtdb_metadata import file_sha256s
+from presence_matrix import PresenceMatrix
+from profiling import add_profile_arguments
+from stage_cache import add_stage_cache_arguments, hash_bytes, open_stage_cache
+from table_io import add_format_argument, write_table
 
+# Columns of the AnnoTree hit files needed for presence and counts. The saved
+# long tables keep every column; callers that only build presence may read just these
+HIT_COLUMNS = ['gtdbId', 'geneId', 'SearchId']
 
-def main():
-    parser = argparse.ArgumentParser(description="Calculate PI functions by organism from the manifest file.")
-    parser.add_argument('--manifest', type=str, required=True, help='Path to the annotree manifest file')
-    parser.add_argument('--out_long', type=str, default='genes_long.csv',
-                        help='Path to the long-format output file.')
-    parser.add_argument('--out_wide', type=str, default='genes_by_organism.csv',
-                        help='Path to the wide-format output file.')
-    args = parser.parse_args()
+# Directory of the per-query AnnoTree hit files
+ANNOTREE_DIR = 'data/annotree'
+
+
+def read_query_hits(fname, usecols=None):
+    """Read one AnnoTree per-query hits file, all columns or only usecols."""
+    return pd.read_csv(fname, usecols=usecols)
 
-    outdir = path.dirname(args.out_wide)
-    print(f"Will write ancillary files to {outdir}")
-    if not path.exists(outdir):
-        print(f"Creating output directory: {outdir}")
-        os.makedirs(outdir, exist_ok=True)
 
-    manifest = pd.read_csv(args.manifest).dropna(how='all')
+def read_all_query_hits(fnames, n_workers=8, usecols=None):
+    """Read per-query hit files in parallel and concatenate them in order."""
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        all_results = list(pool.map(lambda fname: read_query_hits(fname, usecols), fnames))
+    return pd.concat(all_results, axis=0, ignore_index=True)
+
+
+def read_manifest(fname, annotree_dir=ANNOTREE_DIR):
+    """Read the AnnoTree manifest, adding the path of each query's hits file."""
+    manifest = pd.read_csv(fname).dropna(how='all')
     manifest['filename'] = manifest['name'].apply(lambda x: x + '_bacteria.csv')
-    manifest['filepath'] = manifest['filename'].apply(lambda x: f"data/annotree/{x}")
+    manifest['filepath'] = manifest['filename'].apply(lambda x: path.join(annotree_dir, x))
+    return manifest
 
-    # simply combine all the dataframes into a single one with a common index
-    all_results = []
-    for _, row in manifest.iterrows():
-        df = pd.read_csv(row['filepath'], index_col=0)
-        all_results.append(df)
 
-    # concatenate all results into a single DataFrame along the rows
-    combined_df = pd.concat(all_results, axis=0)
-    combined_df = combined_df.reset_index()
+def read_all_query_hits_cached(fnames, cache, n_workers=8, usecols=None):
+    """As read_all_query_hits(), reusing the parsed hits of files whose content is
+    in the stage cache and caching the others."""
+    # The columns read are part of the key, so full and narrowed reads do not mix
+    columns_key = ','.join(usecols) if usecols is not None else '*'
+    keys = [hash_bytes(file_hash, columns_key) for file_hash in file_sha256s(fnames, cache.cache_dir)]
+    results = [cache.get_frame('hits', key) for key in keys]
+    missing = [i for i, df in enumerate(results) if df is None]
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for i, df in zip(missing, pool.map(lambda fname: read_query_hits(fname, usecols),
+                                           [fnames[i] for i in missing])):
+            cache.put_frame('hits', keys[i], df)
+            results[i] = df
+    print(f"Hit files: {len(fnames) - len(missing)} unchanged, {len(missing)} read")
+    return pd.concat(results, axis=0, ignore_index=True)
 
-    # check for duplicate geneId values
-    duplicates = combined_df.duplicated(subset=['geneId'], keep=False)
+
+def read_manifest_hits(manifest, n_workers=8, cache=None, usecols=None):
+    """Long table of the hits of every query in the manifest.
+
+    With a StageCache, only files not read before (by content) are parsed.
+    With usecols (e.g. HIT_COLUMNS), only those columns are read, which is
+    enough for presence and counts but not for the saved long tables.
+    """
+    with profiling.stage('read hits', files=len(manifest)) as st:
+        fnames = manifest['filepath'].tolist()
+        if cache is None:
+            combined_df = read_all_query_hits(fnames, n_workers, usecols)
+        else:
+            combined_df = read_all_query_hits_cached(fnames, cache, n_workers, usecols)
+        st.rows = len(combined_df)
+    return combined_df
+
+
+def duplicated_genes(hits_df):
+    """Mask of rows whose geneId occurs more than once, in one hashed pass.
+
+    Equivalent to hits_df.duplicated(subset=['geneId'], keep=False).
+    """
+    gene_codes, _ = pd.factorize(hits_df['geneId'])
+    valid = gene_codes >= 0
+    counts = np.bincount(gene_codes[valid])
+    mask = np.zeros(len(hits_df), dtype=bool)
+    mask[valid] = counts[gene_codes[valid]] > 1
+    return pd.Series(mask, index=hits_df.index)
+
+
+def presence_from_hits(hits_df):
+    """Genome x query presence matrix built directly from the codes of the hits.
+
+    Genomes and queries are sorted, as in a pivot of the long table.
+    """
+    hits_df = hits_df[hits_df['geneId'].notnull()]
+    genome_codes, genomes = pd.factorize(hits_df['gtdbId'], sort=True)
+    query_codes, queries = pd.factorize(hits_df['SearchId'], sort=True)
+    valid = (genome_codes >= 0) & (query_codes >= 0)
+    return PresenceMatrix.from_codes(genome_codes[valid], query_codes[valid],
+                                     np.asarray(genomes).astype(str),
+                                     np.asarray(queries).astype(str))
+
+
+def counts_from_hits(hits_df):
+    """Genome x query table of hit counts (gene copies per genome), from the codes
+    of the hits in one bincount.
+
+    Genomes and queries are sorted, as in presence_from_hits().
+    """
+    hits_df = hits_df[hits_df['geneId'].notnull()]
+    genome_codes, genomes = pd.factorize(hits_df['gtdbId'], sort=True)
+    query_codes, queries = pd.factorize(hits_df['SearchId'], sort=True)
+    valid = (genome_codes >= 0) & (query_codes >= 0)
+    flat = genome_codes[valid].astype(np.int64) * len(queries) + query_codes[valid]
+    counts = np.bincount(flat, minlength=len(genomes) * len(queries))
+    return pd.DataFrame(counts.reshape(len(genomes), len(queries)).astype(np.int32),
+                        index=pd.Index(np.asarray(genomes).astype(str), name='gtdbId'),
+                        columns=np.asarray(queries).astype(str))
+
+
+def report_duplicates(combined_df, manifest, outdir):
+    """Print and save hits whose geneId occurs more than once."""
+    with profiling.stage('find duplicates', rows=len(combined_df)):
+        duplicates = duplicated_genes(combined_df)
     if duplicates.any():
         print(f"found {duplicates.sum()} duplicate gene IDs in a total of {len(combined_df)} genes.")
         dups = combined_df[duplicates]
@@ -53,22 +139,78 @@ def main():
         # families that are homologous but perform different functions.
         # Hard to know which one to keep, so we keep them all.
 
+
+def write_gene_tables(combined_df, presence, out_long, out_wide, table_format=None):
+    """Write the long table of hits and the wide genome x query presence table."""
     # Save the combined DataFrame to the specified output directory
-    combined_df.to_csv(args.out_long, index=False)
-    print(f"Combined data saved to {args.out_long}")
+    with profiling.stage('write long', rows=len(combined_df)):
+        write_table(combined_df, out_long, table_format, index=False)
+    print(f"Combined data saved to {out_long}")
 
     # Make a wide format DataFrame with gtdbId (species) as index and SearchId as columns
     # values are boolean indicating presence of the gene
-
-    # Drop duplicates first to ensure unique index/column pairs for pivot
-    # This is fine because we are binarizing the presence of genes in the end anyway
-    combined_df_nodup = combined_df.drop_duplicates(subset=['gtdbId', 'SearchId'])
-    wide_df = combined_df_nodup.pivot(index='gtdbId', columns='SearchId', values='geneId').notnull()
-    wide_df.reset_index(inplace=True)
+    with profiling.stage('pivot', rows=presence.n_genomes):
+        wide_df = presence.to_dataframe(index_name='gtdbId')
+        wide_df.reset_index(inplace=True)
 
     # Save the wide format DataFrame to the specified output directory
-    wide_df.to_csv(args.out_wide, index=False)
-    print(f"Wide format data saved to {args.out_wide}")
+    with profiling.stage('write wide', rows=len(wide_df)):
+        write_table(wide_df, out_wide, table_format, index=False)
+    print(f"Wide format data saved to {out_wide}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate PI functions by organism from the manifest file.")
+    parser.add_argument('--manifest', type=str, required=True, help='Path to the annotree manifest file')
+    parser.add_argument('--out_long', type=str, default='genes_long.csv',
+                        help='Path to the long-format output file.')
+    parser.add_argument('--out_wide', type=str, default='genes_by_organism.csv',
+                        help='Path to the wide-format output file.')
+    parser.add_argument('--out_matrix', type=str, default=None,
+                        help='Optional path to also save the presence data as a bit-packed matrix (.npz).')
+    parser.add_argument('--out_counts', type=str, default=None,
+                        help='Optional path to also save the number of hits (gene copies) of each '
+                             'query in each genome, for quantitative expression evaluation.')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of per-query files to read in parallel.')
+    add_format_argument(parser)
+    add_stage_cache_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    profiling.start('tabulate_genes_by_organism', args.profile_out, args.cprofile_out)
+
+    outdir = path.dirname(args.out_wide)
+    print(f"Will write ancillary files to {outdir}")
+    if not path.exists(outdir):
+        print(f"Creating output directory: {outdir}")
+        os.makedirs(outdir, exist_ok=True)
+
+    manifest = read_manifest(args.manifest)
+
+    # read all the per-query files in parallel and combine them into a single long table
+    combined_df = read_manifest_hits(manifest, args.workers, open_stage_cache(args))
+
+    # check for duplicate geneId values
+    report_duplicates(combined_df, manifest, outdir)
+
+    # Presence is set straight from the genome and query codes of the hits, so
+    # duplicate hits need no special handling and no dense pivot is built
+    with profiling.stage('build presence', rows=len(combined_df)) as st:
+        presence = presence_from_hits(combined_df)
+        st.info.update(genomes=presence.n_genomes, queries=presence.n_genes)
+
+    if args.out_matrix:
+        with profiling.stage('write matrix', rows=presence.n_genomes):
+            presence.save(args.out_matrix)
+        print(f"Packed presence matrix saved to {args.out_matrix}")
+
+    if args.out_counts:
+        with profiling.stage('write counts', rows=presence.n_genomes):
+            write_table(counts_from_hits(combined_df), args.out_counts, args.table_format)
+        print(f"Gene copy numbers saved to {args.out_counts}")
+
+    write_gene_tables(combined_df, presence, args.out_long, args.out_wide, args.table_format)
+    profiling.finish()
 
 
 if __name__ == "__main__":